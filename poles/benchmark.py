@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import cluster
+import mapping
+import particlefilter
+import poles
+import synthetic
+import util
+
+
+repeat = 5
+mapextent = np.array([30.0, 30.0, 5.0])
+mapsize = np.full(3, 0.2)
+mapshape = np.array(mapextent / mapsize, dtype=int)
+sensorheight = 2.0
+globalmapextent = 500.0
+globalmappoles = 2000
+runs = 4
+polevar = 1.5
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Every benchmark prepares its input for the given size and returns the
+# function to time.
+def bench_detect_poles(npoles):
+    poleparams = synthetic.pole_field(npoles, mapextent[0])
+    ogm = synthetic.occupancy_grid(poleparams, mapshape, mapsize)
+    return lambda: poles.detect_poles(ogm, mapsize)
+
+
+def bench_occupancymap(nscans):
+    poleparams = synthetic.pole_field(30, mapextent[0])
+    start = util.xyp2ht(np.array([5.0, 0.5 * mapextent[1], 0.0]))
+    start[2, 3] = sensorheight
+    T_m_s, _ = synthetic.trajectory(nscans, step=0.5, start=start)
+    scans = [util.xyzi2pc(synthetic.scan(poleparams, T, nazimuth=900)) \
+        for T in T_m_s]
+    return lambda: mapping.occupancymap(scans, T_m_s, mapshape, mapsize)
+
+
+def bench_cluster_boxes(nboxes):
+    rng = np.random.RandomState(0)
+    poleparams = synthetic.pole_field(nboxes // 3 + 1, globalmapextent)
+    poleparams = np.repeat(poleparams, 3, axis=0)[:nboxes]
+    xy = poleparams[:, :2] + rng.normal(0.0, 0.05, [nboxes, 2])
+    a = poleparams[:, [4]]
+    boxes = np.hstack([xy - 0.5 * a, xy + 0.5 * a])
+    return lambda: list(cluster.cluster_boxes(boxes))
+
+
+# Sets up a filter of count particles, or a batch filter with runs runs,
+# together with one motion and one pole measurement.
+def get_filter(count, batch):
+    polemeans = synthetic.pole_field(globalmappoles, globalmapextent)
+    start = util.xyp2ht(np.array([0.5 * globalmapextent] * 2 + [0.0]))
+    if batch:
+        filter = particlefilter.batchparticlefilter(runs, count, start,
+            2.5, np.radians(5.0), polemeans[:, :2], polevar)
+    else:
+        filter = particlefilter.particlefilter(count, start,
+            2.5, np.radians(5.0), polemeans[:, :2], polevar)
+    near = np.linalg.norm(polemeans[:, :2] - start[:2, 3], axis=1) < 30.0
+    polepos_r = util.invert_ht(start).dot(np.hstack([polemeans[near, :2],
+        np.zeros([np.sum(near), 1]), np.ones([np.sum(near), 1])]).T)[:2].T
+    return filter, polemeans, start, polepos_r
+
+
+def bench_filter(operation, batch=False):
+    def bench(count):
+        filter, polemeans, start, polepos_r = get_filter(count, batch)
+        if operation == 'init':
+            if batch:
+                return lambda: particlefilter.batchparticlefilter(runs, count,
+                    start, 2.5, np.radians(5.0), polemeans[:, :2], polevar)
+            return lambda: particlefilter.particlefilter(count, start,
+                2.5, np.radians(5.0), polemeans[:, :2], polevar)
+        if operation == 'update_motion':
+            return lambda: filter.update_motion(
+                np.array([0.1, 0.0, 0.0]), np.diag([0.01, 0.01, 0.001]))
+        if operation == 'update_measurement':
+            return lambda: filter.update_measurement(polepos_r, resample=False)
+        if operation == 'resample':
+            return filter.resample
+        if operation == 'estimate_pose':
+            return filter.estimate_pose
+    return bench
+
+
+benchmarks = [
+    ('poles.detect_poles', bench_detect_poles, [5, 20, 80]),
+    ('mapping.occupancymap', bench_occupancymap, [1, 5, 20]),
+    ('cluster.cluster_boxes', bench_cluster_boxes, [100, 1000, 10000])]
+for batch, prefix in [(False, 'particlefilter'),
+        (True, 'batchparticlefilter')]:
+    for operation in ['init', 'update_motion', 'update_measurement',
+            'resample', 'estimate_pose']:
+        benchmarks.append(('{}.{}'.format(prefix, operation),
+            bench_filter(operation, batch), [1000, 5000, 20000]))
+
+
+# Times all benchmarks whose name contains one of the given names, each
+# repeat times after one warm-up call, and writes the results to outputfile.
+def run(names=None, repeat=repeat, outputfile=None):
+    results = []
+    for name, bench, sizes in benchmarks:
+        if names is not None and not any(n in name for n in names):
+            continue
+        for size in sizes:
+            func = bench(size)
+            func()
+            times = []
+            for _ in range(repeat):
+                t_start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - t_start)
+            results.append({'name': name, 'size': size, 'times': times,
+                'min': min(times), 'median': float(np.median(times))})
+            print('{:40s} {:8d} {:10.6f} s'.format(
+                name, size, results[-1]['median']))
+    report = {'revision': get_revision(), 'python': platform.python_version(),
+        'numpy': np.__version__, 'time': time.time(), 'repeat': repeat,
+        'results': results}
+    if outputfile is not None:
+        with open(outputfile, 'w') as file:
+            json.dump(report, file, indent=1)
+    return report
+
+
+# Prints the ratio of the median times of two reports for all benchmarks
+# they have in common, above 1 meaning that the second one is slower.
+def compare(baselinefile, resultfile):
+    with open(baselinefile) as file:
+        baseline = {(r['name'], r['size']): r for r in json.load(file)['results']}
+    with open(resultfile) as file:
+        results = json.load(file)['results']
+    for result in results:
+        key = (result['name'], result['size'])
+        if key in baseline:
+            print('{:40s} {:8d} {:10.6f} s {:10.6f} s {:6.2f}'.format(
+                key[0], key[1], baseline[key]['median'], result['median'],
+                result['median'] / baseline[key]['median']))
+
+
+if __name__ == '__main__':
+    outputfile = sys.argv[1] if len(sys.argv) > 1 else 'benchmark.json'
+    run(outputfile=outputfile)
+    if len(sys.argv) > 2:
+        compare(sys.argv[2], outputfile)
@@ -3,19 +3,24 @@
 import networkx as nx
 import numpy as np
 
+import instrumentation
+
 
 def cluster_boxes(boxes):
     graph = nx.Graph()
+    span = instrumentation.start('clustering', boxes=boxes.shape[0])
+    instrumentation.count('boxes', boxes.shape[0])
     for i in range(boxes.shape[0]):
         ioverlap = np.where(np.logical_and(
             np.all(boxes[i, :2] <= boxes[i+1:, 2:], axis=1),
             np.all(boxes[i, 2:] >= boxes[i+1:, :2], axis=1)))[0] + i + 1
         if ioverlap.size > 0:
             ebunch = np.stack(
-                [i * np.ones(ioverlap.size, dtype=np.int), ioverlap]).T
+                [np.full(ioverlap.size, i), ioverlap]).T
             graph.add_edges_from(ebunch)
         else:
             graph.add_node(i)
+    instrumentation.stop(span)
 
     return nx.connected_components(graph)
 
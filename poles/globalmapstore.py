@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import warnings
+
+import numpy as np
+import scipy.spatial
+
+import cluster
+import pipeline
+import util
+
+
+clusterfile = 'clusters.npz'
+sessiondir = 'sessions'
+
+
+def get_boxes(poleparams):
+    xy = poleparams[:, :2]
+    a = poleparams[:, [4]]
+    return np.hstack([xy - 0.5 * a, xy + 0.5 * a])
+
+
+# Returns the mean of the detections of one cluster, weighted by their score,
+# together with their mean score.
+def get_cluster_mean(poleparams):
+    return np.hstack([np.average(poleparams[:, :-1], axis=0,
+        weights=poleparams[:, -1]), np.mean(poleparams[:, -1])])
+
+
+def get_session_hash(session):
+    sha1 = hashlib.sha1()
+    for name in ['windows', 'offsets', 'poleparams']:
+        sha1.update(np.ascontiguousarray(session[name]).tobytes())
+    return sha1.hexdigest()
+
+
+def savez_atomic(filename, **arrays):
+    with open(filename + '.tmp', 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(filename + '.tmp', filename)
+
+
+class globalmapstore:
+    """
+        Persistent global map that keeps the pole detections of every
+        session, grouped by the window they were detected in, in a file per
+        session, and labels every detection with the cluster it belongs to.
+        Setting the windows of a session or retiring it only reclusters the
+        detections whose boxes are connected to the added or removed ones,
+        and only the means of these clusters are recomputed. The store is
+        reset when the detection parameters change.
+    """
+    def __init__(self, dir, params, mindetections):
+        self.dir = dir
+        self.key = pipeline.get_hash(params)
+        self.mindetections = mindetections
+        self.sessions = {}
+        self.means = {}
+        self.nextlabel = 0
+        self.changed = set()
+        self.retired = set()
+        try:
+            self.load()
+        except (IOError, OSError, ValueError, KeyError):
+            self.sessions = {}
+            self.means = {}
+            self.nextlabel = 0
+
+    def get_sessionfile(self, sessionname):
+        return os.path.join(self.dir, sessiondir, sessionname + '.npz')
+
+    # Loads all sessions and the cluster state. If the cluster state does not
+    # match the contents of the session files, which happens when a save was
+    # interrupted, all detections are clustered anew.
+    def load(self):
+        with np.load(os.path.join(self.dir, clusterfile)) as data:
+            if str(data['key']) != self.key:
+                raise ValueError('parameters have changed')
+            sessionnames = [str(s) for s in data['sessions']]
+            counts = data['counts']
+            hashes = [str(h) for h in data['hashes']]
+            labels = data['labels']
+            self.means = dict(zip(data['meanlabels'].tolist(), data['means']))
+            self.nextlabel = int(data['nextlabel'])
+        for sessionname in sessionnames:
+            with np.load(self.get_sessionfile(sessionname)) as data:
+                self.sessions[sessionname] = {
+                    'windows': data['windows'], 'offsets': data['offsets'],
+                    'poleparams': data['poleparams']}
+        if [get_session_hash(s) for s in self.sessions.values()] != hashes:
+            warnings.warn('Reclustering {}, whose last save was '
+                'interrupted.'.format(self.dir))
+            self.recluster_all()
+            return
+        for session, label in zip(self.sessions.values(),
+                np.split(labels, np.cumsum(counts)[:-1])):
+            session['labels'] = label
+
+    def save(self):
+        util.makedirs(os.path.join(self.dir, sessiondir))
+        for sessionname in self.changed:
+            session = self.sessions[sessionname]
+            savez_atomic(self.get_sessionfile(sessionname),
+                windows=session['windows'], offsets=session['offsets'],
+                poleparams=session['poleparams'])
+        _, _, labels = self.get_detections()
+        meanlabels = sorted(self.means)
+        savez_atomic(os.path.join(self.dir, clusterfile), key=self.key,
+            sessions=np.array(list(self.sessions), dtype=str),
+            counts=np.array([s['poleparams'].shape[0] \
+                for s in self.sessions.values()], dtype=np.int64),
+            hashes=np.array([get_session_hash(s) \
+                for s in self.sessions.values()], dtype=str),
+            labels=labels, meanlabels=np.array(meanlabels, dtype=np.int64),
+            means=np.array([self.means[l] for l in meanlabels]).reshape(
+                [-1, 6]),
+            nextlabel=self.nextlabel)
+        for sessionname in self.retired - set(self.sessions):
+            if os.path.exists(self.get_sessionfile(sessionname)):
+                os.remove(self.get_sessionfile(sessionname))
+        self.changed.clear()
+        self.retired.clear()
+
+    # Returns the windows (istart, imid, iend) of the given session for which
+    # detections are stored, mapped to these detections.
+    def get_windows(self, sessionname):
+        if sessionname not in self.sessions:
+            return {}
+        session = self.sessions[sessionname]
+        return {tuple(w): session['poleparams'][
+            session['offsets'][i]:session['offsets'][i+1]] \
+                for i, w in enumerate(session['windows'].tolist())}
+
+    def get_detections(self):
+        sessions = list(self.sessions.values())
+        poleparams = np.vstack(
+            [np.empty([0, 6])] + [s['poleparams'] for s in sessions])
+        labels = np.hstack([np.empty(0, dtype=np.int64)]
+            + [s['labels'] for s in sessions])
+        owners = np.repeat(np.arange(len(sessions)),
+            [s['poleparams'].shape[0] for s in sessions])
+        return poleparams, owners, labels
+
+    # Replaces the windows of the given session by the given ones, of which
+    # window i has the detections poleparams[i]. Detections of windows that
+    # the session already has are kept as they are.
+    def set_session(self, sessionname, windows, poleparams):
+        windows = [tuple(w) for w in windows]
+        windowset = set(windows)
+        old = self.sessions.get(sessionname)
+        oldindex = {} if old is None else \
+            {tuple(w): i for i, w in enumerate(old['windows'].tolist())}
+        if set(oldindex) == windowset and len(oldindex) == len(windows):
+            return
+        removed = set()
+        for w, i in oldindex.items():
+            if w not in windowset:
+                removed |= set(old['labels'][
+                    old['offsets'][i]:old['offsets'][i+1]].tolist())
+        sessionpoleparams = []
+        sessionlabels = []
+        for w, p in zip(windows, poleparams):
+            if w in oldindex:
+                i = oldindex[w]
+                span = slice(old['offsets'][i], old['offsets'][i+1])
+                sessionpoleparams.append(old['poleparams'][span])
+                sessionlabels.append(old['labels'][span])
+            else:
+                p = np.reshape(p, [-1, 6])
+                sessionpoleparams.append(p)
+                sessionlabels.append(np.full(p.shape[0], -1, dtype=np.int64))
+        self.sessions[sessionname] = {
+            'windows': np.array(windows, dtype=np.int64).reshape([-1, 3]),
+            'offsets': np.cumsum([0] + [p.shape[0] \
+                for p in sessionpoleparams]).astype(np.int64),
+            'poleparams': np.vstack([np.empty([0, 6])] + sessionpoleparams),
+            'labels': np.hstack(
+                [np.empty(0, dtype=np.int64)] + sessionlabels)}
+        self.changed.add(sessionname)
+        self.retired.discard(sessionname)
+        self.recluster(removed)
+
+    def retire(self, sessionname):
+        if sessionname not in self.sessions:
+            return
+        removed = set(self.sessions.pop(sessionname)['labels'].tolist())
+        self.changed.discard(sessionname)
+        self.retired.add(sessionname)
+        self.recluster(removed)
+
+    # Clusters the new detections, labeled -1, together with all clusters
+    # whose boxes they overlap and the clusters that lost detections. Since
+    # clusters are connected components of overlapping boxes, no other
+    # cluster can change.
+    def recluster(self, removed):
+        poleparams, owners, labels = self.get_detections()
+        boxes = get_boxes(poleparams)
+        new = np.where(labels < 0)[0]
+        affected = set(removed)
+        if new.size > 0 and labels.size > new.size:
+            centers = 0.5 * (boxes[:, :2] + boxes[:, 2:])
+            halfsize = 0.5 * poleparams[:, 4]
+            neighbors = scipy.spatial.cKDTree(centers).query_ball_point(
+                centers[new], halfsize[new] + np.max(halfsize), p=np.inf)
+            for i, ineighbors in zip(new, neighbors):
+                ineighbors = np.array(ineighbors, dtype=np.int64)
+                overlap = np.all(boxes[i, :2] <= boxes[ineighbors, 2:],
+                    axis=1) & np.all(boxes[i, 2:] >= boxes[ineighbors, :2],
+                    axis=1)
+                affected |= set(labels[ineighbors[overlap]].tolist())
+        affected.discard(-1)
+        for label in affected:
+            self.means.pop(label, None)
+        irecluster = np.where(
+            np.isin(labels, list(affected)) | (labels < 0))[0]
+        for ci in cluster.cluster_boxes(boxes[irecluster]):
+            ci = irecluster[sorted(ci)]
+            labels[ci] = self.nextlabel
+            if ci.size >= self.mindetections:
+                self.means[self.nextlabel] = get_cluster_mean(poleparams[ci])
+            self.nextlabel += 1
+        self.set_labels(owners, labels)
+
+    def recluster_all(self):
+        for session in self.sessions.values():
+            session['labels'] = np.full(
+                session['poleparams'].shape[0], -1, dtype=np.int64)
+        self.means = {}
+        self.recluster(set())
+
+    def set_labels(self, owners, labels):
+        for i, session in enumerate(self.sessions.values()):
+            session['labels'] = labels[owners == i]
+
+    # Returns the means of all clusters with at least mindetections
+    # detections, as rows x, y, zstart, zend, a, score.
+    @property
+    def polemeans(self):
+        return np.array([self.means[l] for l in sorted(self.means)]).reshape(
+            [-1, 6])
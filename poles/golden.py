@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+import glob
+import os
+import time
+
+import numpy as np
+import scipy.spatial
+
+import mapping
+import particlefilter
+import poles
+import synthetic
+import util
+
+
+mapextent = np.array([30.0, 30.0, 5.0])
+mapsize = np.full(3, 0.2)
+mapshape = np.array(mapextent / mapsize, dtype=int)
+poleparamnames = ['x', 'y', 'zstart', 'zend', 'a', 'score']
+
+# Maximum absolute deviation per output field. Poles are matched by
+# position, and more than matchdistance apart counts as missing.
+tolerances = {
+    'x': 1e-3, 'y': 1e-3, 'zstart': 1e-3, 'zend': 1e-3, 'a': 1e-3,
+    'score': 1e-6, 'npoles': 0, 'occupancymap': 1e-6,
+    'weights': 1e-9, 'particles': 1e-9, 'pose': 1e-9}
+matchdistance = 0.2
+
+
+# The reference engine. An engine maps the names of the operations to
+# functions that take the inputs of a case and return its outputs.
+def detect_poles(ogm, mapsize):
+    return {'poleparams': poles.detect_poles(ogm, mapsize)}
+
+
+def occupancymap(points, offsets, poses, mapshape, mapsize):
+    scans = [util.xyzi2pc(points[offsets[i]:offsets[i+1]]) \
+        for i in range(offsets.size - 1)]
+    return {'occupancymap':
+        mapping.occupancymap(scans, poses, mapshape, mapsize)}
+
+
+# Pole measurement i consists of measurements[offsets[i]:offsets[i+1]].
+def run_filter(seed, count, start, polemeans, motions, measurements,
+        offsets):
+    np.random.seed(int(seed))
+    filter = particlefilter.particlefilter(int(count), start, 2.5,
+        np.radians(5.0), polemeans, 1.5)
+    for i, motion in enumerate(motions):
+        filter.update_motion(motion, np.diag([0.01, 0.01, 0.001]))
+        filter.update_measurement(measurements[offsets[i]:offsets[i+1]])
+    return {'weights': filter.weights, 'particles': filter.particles,
+        'pose': filter.estimate_pose()}
+
+
+reference = {'detect_poles': detect_poles, 'occupancymap': occupancymap,
+    'particlefilter': run_filter}
+
+
+def save_case(dir, name, operation, inputs, engine=reference):
+    outputs, duration = run_case(engine[operation], inputs)
+    util.makedirs(dir)
+    arrays = {'in_' + k: v for k, v in inputs.items()}
+    arrays.update({'out_' + k: v for k, v in outputs.items()})
+    arrays.update({'param_' + k: v for k, v in poles.get_params().items()})
+    np.savez(os.path.join(dir, name + '.npz'), operation=operation,
+        duration=duration, **arrays)
+
+
+def load_case(filename):
+    with np.load(filename) as data:
+        case = {'operation': str(data['operation']),
+            'duration': float(data['duration'])}
+        for prefix in ['in', 'out', 'param']:
+            case[prefix] = {k[len(prefix)+1:]: data[k] \
+                for k in data.files if k.startswith(prefix + '_')}
+    return case
+
+
+def run_case(func, inputs):
+    t_start = time.perf_counter()
+    outputs = func(**inputs)
+    return outputs, time.perf_counter() - t_start
+
+
+# Records reference outputs for synthetic inputs with fixed seeds.
+def record(dir, seeds=range(3)):
+    for seed in seeds:
+        poleparams = synthetic.pole_field(10 + 20 * seed, mapextent[0], seed)
+        ogm = synthetic.occupancy_grid(poleparams, mapshape, mapsize, seed)
+        save_case(dir, 'detect_poles_{}'.format(seed), 'detect_poles',
+            {'ogm': ogm, 'mapsize': mapsize})
+
+        start = util.xyp2ht(np.array([2.0, 0.5 * mapextent[1], 0.0]))
+        start[2, 3] = 2.0
+        poses, _ = synthetic.trajectory(5, step=1.0, start=start, seed=seed)
+        scans = [synthetic.scan(poleparams, T, nazimuth=900) for T in poses]
+        save_case(dir, 'occupancymap_{}'.format(seed), 'occupancymap',
+            {'points': np.vstack(scans),
+                'offsets': np.cumsum([0] + [s.shape[0] for s in scans]),
+                'poses': poses, 'mapshape': mapshape, 'mapsize': mapsize})
+
+        polemeans = synthetic.pole_field(500, 200.0, seed)[:, :2]
+        poses, relmotion = synthetic.trajectory(20, step=1.0,
+            start=util.xyp2ht(np.array([100.0, 100.0, 0.0])), seed=seed)
+        measurements = []
+        for T in poses[1:]:
+            near = np.linalg.norm(polemeans - T[:2, 3], axis=1) < 20.0
+            polepos_w = np.hstack([polemeans[near],
+                np.zeros([np.sum(near), 1]), np.ones([np.sum(near), 1])]).T
+            measurements.append(util.invert_ht(T).dot(polepos_w)[:2].T)
+        save_case(dir, 'particlefilter_{}'.format(seed), 'particlefilter',
+            {'seed': seed, 'count': 2000, 'start': poses[0],
+                'polemeans': polemeans, 'motions': relmotion,
+                'measurements': np.vstack(measurements),
+                'offsets': np.cumsum(
+                    [0] + [m.shape[0] for m in measurements])})
+
+
+# Returns the maximum absolute deviation per pole parameter between poles
+# matched by position, and the number of unmatched poles.
+def compare_poleparams(ref, new):
+    errors = {name: 0.0 for name in poleparamnames}
+    if ref.shape[0] == 0 or new.shape[0] == 0:
+        errors['npoles'] = max(ref.shape[0], new.shape[0])
+        return errors
+    d, i = scipy.spatial.cKDTree(new[:, :2]).query(ref[:, :2], k=1)
+    matched = d <= matchdistance
+    errors['npoles'] = int(np.sum(~matched)
+        + new.shape[0] - np.unique(i[matched]).size)
+    dev = np.abs(ref[matched] - new[i[matched]])
+    if dev.size > 0:
+        for j, name in enumerate(poleparamnames):
+            errors[name] = float(np.max(dev[:, j]))
+    return errors
+
+
+def compare_outputs(ref, new):
+    errors = {}
+    for name, value in ref.items():
+        if name == 'poleparams':
+            errors.update(compare_poleparams(value, new[name]))
+        else:
+            errors[name] = float(np.max(np.abs(
+                np.asarray(value) - np.asarray(new[name])), initial=0.0))
+    return errors
+
+
+# Runs the given engine on all recorded cases and reports, per case, the
+# deviation of every output field from the reference, whether it is within
+# tolerance, and the speedup over the recorded reference duration.
+def compare(dir, engine=reference):
+    reports = []
+    saved = poles.get_params()
+    try:
+        for filename in sorted(glob.glob(os.path.join(dir, '*.npz'))):
+            case = load_case(filename)
+            if case['operation'] not in engine:
+                continue
+            poles.set_params(case['param'])
+            outputs, duration = run_case(
+                engine[case['operation']], case['in'])
+            errors = compare_outputs(case['out'], outputs)
+            reports.append({'case': os.path.basename(filename)[:-4],
+                'errors': errors,
+                'passed': all(e <= tolerances.get(name, 0.0) \
+                    for name, e in errors.items()),
+                'speedup': case['duration'] / duration})
+    finally:
+        poles.set_params(saved)
+    for report in reports:
+        print('{:24s} {:6s} {:6.2f}x  {}'.format(report['case'],
+            'ok' if report['passed'] else 'FAILED', report['speedup'],
+            ' '.join('{}={:.2g}'.format(k, v) \
+                for k, v in sorted(report['errors'].items()))))
+    return reports
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+import collections
+import contextlib
+import glob
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+
+import psutil
+
+
+# Setting the environment variable POLEX_TRACE to a directory enables the
+# instrumentation in this process and all processes it starts, each of
+# which writes its trace to that directory when it exits.
+tracevariable = 'POLEX_TRACE'
+memoryinterval = 0.05
+
+enabled = False
+events = []
+counters = collections.Counter()
+peakrss = 0
+sampler = None
+t_zero = time.perf_counter()
+
+
+# Spans that are open in the current thread, innermost last.
+openspans = threading.local()
+
+
+def get_open_spans():
+    if not hasattr(openspans, 'stack'):
+        openspans.stack = []
+    return openspans.stack
+
+
+class timedspan:
+    """
+        Records the time spent between enter and exit, together with the
+        counts made meanwhile in the same thread, including those made in
+        nested spans.
+    """
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.counters = collections.Counter()
+
+    def __enter__(self):
+        get_open_spans().append(self)
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        t_end = time.perf_counter()
+        stack = get_open_spans()
+        # Nested spans that an exception skipped are closed, too.
+        if self in stack:
+            del stack[stack.index(self):]
+        if stack:
+            stack[-1].counters.update(self.counters)
+        spanargs = dict(self.args)
+        if self.counters:
+            spanargs['counters'] = dict(self.counters)
+        events.append({'name': self.name, 'ph': 'X', 'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'ts': 1e6 * (self.t_start - t_zero),
+            'dur': 1e6 * (t_end - self.t_start), 'args': spanargs})
+        return False
+
+
+nullspan = contextlib.nullcontext()
+
+
+# Returns a context manager that records the time spent in it. While the
+# instrumentation is disabled, this costs a single function call.
+def span(name, **args):
+    if not enabled:
+        return nullspan
+    return timedspan(name, args)
+
+
+# Starts a span that stop ends, for stages that are not a block of their
+# own. Like span, this costs a single function call while disabled.
+def start(name, **args):
+    if not enabled:
+        return None
+    return timedspan(name, args).__enter__()
+
+
+def stop(span):
+    if span is not None:
+        span.__exit__(None, None, None)
+
+
+# Adds value to the counter of the given name, both to the total of the
+# process and to the innermost open span of the current thread.
+def count(name, value=1):
+    if enabled:
+        counters[name] += value
+        stack = get_open_spans()
+        if stack:
+            stack[-1].counters[name] += value
+
+
+class memorysampler(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.process = psutil.Process()
+
+    def run(self):
+        global peakrss
+        while not self.stopped.wait(self.interval):
+            rss = self.process.memory_info().rss
+            peakrss = max(peakrss, rss)
+            events.append({'name': 'memory', 'ph': 'C', 'pid': os.getpid(),
+                'ts': 1e6 * (time.perf_counter() - t_zero),
+                'args': {'rss': rss}})
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def enable(memory=True, interval=memoryinterval):
+    global enabled, sampler
+    enabled = True
+    if memory and sampler is None:
+        sampler = memorysampler(interval)
+        sampler.start()
+
+
+def disable():
+    global enabled, sampler
+    enabled = False
+    if sampler is not None:
+        sampler.stop()
+        sampler = None
+
+
+def reset():
+    global peakrss
+    del events[:]
+    counters.clear()
+    peakrss = 0
+
+
+# Returns the number of calls, the total and the maximum duration and the
+# summed counters of every span, plus the counters and the peak memory.
+def summary():
+    spans = {}
+    for event in events:
+        if event['ph'] == 'X':
+            stats = spans.setdefault(event['name'],
+                {'count': 0, 'total': 0.0, 'max': 0.0, 'counters': {}})
+            stats['count'] += 1
+            stats['total'] += 1e-6 * event['dur']
+            stats['max'] = max(stats['max'], 1e-6 * event['dur'])
+            for name, value in event['args'].get('counters', {}).items():
+                stats['counters'][name] = \
+                    stats['counters'].get(name, 0) + value
+    return {'pid': os.getpid(), 'spans': spans, 'counters': dict(counters),
+        'peakrss': peakrss}
+
+
+def save_json(filename):
+    with open(filename, 'w') as file:
+        json.dump(summary(), file, indent=1)
+
+
+# Writes a trace that can be opened in chrome://tracing or Perfetto.
+def save_chrome_trace(filename):
+    with open(filename, 'w') as file:
+        json.dump({'traceEvents': list(events),
+            'otherData': {'counters': dict(counters), 'peakrss': peakrss}},
+            file)
+
+
+# Combines the traces that the processes of one run wrote to dir, adding up
+# their counters.
+def merge_traces(dir, filename):
+    traceevents = []
+    totals = collections.Counter()
+    for tracefile in sorted(glob.glob(os.path.join(dir, 'trace_*.json'))):
+        with open(tracefile) as file:
+            trace = json.load(file)
+        traceevents += trace['traceEvents']
+        totals.update(trace['otherData']['counters'])
+    with open(filename, 'w') as file:
+        json.dump({'traceEvents': traceevents,
+            'otherData': {'counters': dict(totals)}}, file)
+
+
+def save_process_trace(dir):
+    disable()
+    save_chrome_trace(os.path.join(dir, 'trace_{}.json'.format(os.getpid())))
+    save_json(os.path.join(dir, 'summary_{}.json'.format(os.getpid())))
+
+
+if os.environ.get(tracevariable):
+    os.makedirs(os.environ[tracevariable], exist_ok=True)
+    enable()
+    # Unlike atexit handlers, multiprocessing finalizers also run when a
+    # worker process exits.
+    multiprocessing.util.Finalize(None, save_process_trace,
+        args=(os.environ[tracevariable],), exitpriority=10)
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
+import datetime
 import os
+import shutil
+import threading
 
 import numpy
 import pykitti
@@ -9,20 +12,199 @@ import kittidrives
 import util
 
 
+resultdir = 'kitti'
+sequencecachefile = 'sequence.npz'
+sequencecacheversion = 1
+velostorefile = 'velodyne.bin'
+velostoreindexfile = 'velodyne_index.npz'
+velodatatype = numpy.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+    ('r', '<f4')])
+scanstorelock = threading.Lock()
+
+
+def get_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+# Concatenates the scan files into one file and saves the point offset of
+# every scan next to it. KITTI scans are already stored as float32 x, y, z,
+# reflectance, so the records can be copied without decoding.
+def pack_scans(velofiles, filename, indexfile):
+    counts = [os.path.getsize(velofile) // velodatatype.itemsize \
+        for velofile in velofiles]
+    offsets = numpy.hstack([0, numpy.cumsum(counts)]).astype(numpy.int64)
+    file, tmpfile = util.open_tempfile(filename)
+    with file:
+        for velofile in velofiles:
+            with open(velofile, 'rb') as scanfile:
+                shutil.copyfileobj(scanfile, file)
+    file, tmpindexfile = util.open_tempfile(indexfile)
+    with file:
+        numpy.savez(file, offsets=offsets,
+            velofiles=numpy.array(velofiles))
+    os.replace(tmpfile, filename)
+    os.replace(tmpindexfile, indexfile)
+
+
+class scanstore:
+    """
+        Memory-mapped view of a file written by pack_scans. Scans are
+        returned as float32 arrays [N, 4] that share memory with the file.
+    """
+    def __init__(self, filename, indexfile):
+        with numpy.load(indexfile) as data:
+            self.offsets = data['offsets']
+            self.velofiles = list(data['velofiles'])
+        if os.path.getsize(filename) \
+                != self.offsets[-1] * velodatatype.itemsize:
+            raise ValueError('{} does not match its index'.format(filename))
+        if self.offsets[-1] > 0:
+            self.points = numpy.memmap(filename, dtype='<f4', mode='r',
+                shape=(int(self.offsets[-1]), 4))
+        else:
+            self.points = numpy.empty([0, 4], dtype='<f4')
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def get(self, i):
+        return self.points[self.offsets[i]:self.offsets[i+1]]
+
+    # Returns the scans istart to iend - 1 at once. Scan i occupies rows
+    # offsets[i - istart] to offsets[i - istart + 1] of the result.
+    def get_range(self, istart, iend):
+        return self.points[self.offsets[istart]:self.offsets[iend]], \
+            self.offsets[istart:iend+1] - self.offsets[istart]
+
+
+class sequence:
+    """
+        Poses, timestamps and scans of one KITTI sequence. Poses and
+        timestamps are parsed by pykitti once and cached, scans are packed
+        into one memory-mapped file. All other attributes are taken from
+        the pykitti dataset, which is only loaded when one of them is used.
+    """
+    def __init__(self, wrapper, i):
+        self.wrapper = wrapper
+        self.i = i
+        self.dir = os.path.join(wrapper.resultdir, '{:03d}'.format(i))
+        self.cachefile = os.path.join(self.dir, sequencecachefile)
+        try:
+            self.open_cache()
+        except (IOError, OSError, ValueError, KeyError):
+            self.parse()
+            self.save_cache()
+
+    def __getattr__(self, name):
+        if name == 'dataset':
+            self.dataset = self.wrapper.load_dataset(self.i)
+            return self.dataset
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def open_cache(self):
+        with numpy.load(self.cachefile) as data:
+            if int(data['version']) != sequencecacheversion:
+                raise ValueError('cache version is outdated')
+            sources = data['sources']
+            stamps = data['stamps']
+            for path, stamp in zip(sources, stamps):
+                if os.path.exists(path) and get_stamp(path) != list(stamp):
+                    raise ValueError('{} has changed'.format(path))
+            self.poses = data['poses']
+            self.t_velo = data['t_velo']
+            self.T_cam0_velo = data['T_cam0_velo']
+            self.velofiles = list(data['velofiles'])
+
+    def parse(self):
+        dataset = self.dataset
+        if 0 <= self.i < 11:
+            self.poses = numpy.array(dataset.poses)
+            self.t_velo = numpy.array(
+                [t.total_seconds() for t in dataset.timestamps])
+        else:
+            T_imu_cam0 = util.invert_ht(dataset.calib.T_cam0_imu)
+            self.poses = numpy.matmul(
+                numpy.array([oxts.T_w_imu for oxts in dataset.oxts]),
+                T_imu_cam0)
+            self.t_velo = numpy.array([t.replace(
+                tzinfo=datetime.timezone.utc).timestamp() \
+                    for t in dataset.timestamps])
+        self.T_cam0_velo = numpy.array(dataset.calib.T_cam0_velo)
+        self.velofiles = sorted(dataset.velo_files)
+
+    def get_sourcefiles(self):
+        if not self.velofiles:
+            return []
+        return [os.path.dirname(self.velofiles[0])]
+
+    def save_cache(self):
+        util.makedirs(self.dir)
+        sources = [path for path in self.get_sourcefiles() \
+            if os.path.exists(path)]
+        with open(self.cachefile + '.tmp', 'wb') as file:
+            numpy.savez(file, version=sequencecacheversion,
+                poses=self.poses, t_velo=self.t_velo,
+                T_cam0_velo=self.T_cam0_velo,
+                velofiles=numpy.array(self.velofiles),
+                sources=numpy.array(sources, dtype=str),
+                stamps=numpy.array([get_stamp(path) for path in sources],
+                    dtype=float).reshape([-1, 2]))
+        os.replace(self.cachefile + '.tmp', self.cachefile)
+
+    # The scans are packed on first use, only once per process. Processes
+    # that pack at the same time write their own temporary files.
+    @property
+    def scans(self):
+        if 'scanstore' not in self.__dict__:
+            with scanstorelock:
+                if 'scanstore' not in self.__dict__:
+                    self.scanstore = self.open_scanstore()
+        return self.scanstore
+
+    def open_scanstore(self):
+        filename = os.path.join(self.dir, velostorefile)
+        indexfile = os.path.join(self.dir, velostoreindexfile)
+        try:
+            store = scanstore(filename, indexfile)
+            if store.velofiles != self.velofiles:
+                raise ValueError('{} is outdated'.format(indexfile))
+        except (IOError, OSError, ValueError, KeyError):
+            pack_scans(self.velofiles, filename, indexfile)
+            store = scanstore(filename, indexfile)
+        return store
+
+    def __len__(self):
+        return self.poses.shape[0]
+
+    def get_velo(self, i):
+        return self.scans.get(i)
+
+    def get_velo_range(self, istart, iend):
+        return self.scans.get_range(istart, iend)
+
+
 class kittiwrapper:
-    def __init__(self, datadir):
+    """
+        Opens KITTI odometry sequences 0 to 10 and, from index 11 on, the
+        raw drives listed in kittidrives. Sequences are kept open, so that
+        repeated calls return the same object.
+    """
+    def __init__(self, datadir, resultdir=resultdir):
         self.ododir = os.path.join(datadir, 'odometry')
         self.rawdir = os.path.join(datadir, 'raw_data')
+        self.resultdir = resultdir
+        self.sequences = {}
 
-    def sequence(self, i):
+    def load_dataset(self, i):
         if 0 <= i < 11:
-            sequence = pykitti.odometry(self.ododir, '{:02d}'.format(i))
-            sequence.poses = numpy.array(sequence.poses)
-        else:
-            drive = kittidrives.drives[i - 11]
-            sequence = pykitti.raw(self.rawdir, drive['date'], drive['drive'])
-            T_imu_cam0 = util.invert_ht(sequence.calib.T_cam0_imu)
-            sequence.poses = numpy.array(
-                [numpy.matmul(oxts.T_w_imu, T_imu_cam0) \
-                    for oxts in sequence.oxts])
-        return sequence
+            return pykitti.odometry(self.ododir, '{:02d}'.format(i))
+        drive = kittidrives.drives[i - 11]
+        return pykitti.raw(self.rawdir, drive['date'], drive['drive'])
+
+    def sequence(self, i):
+        if i not in self.sequences:
+            self.sequences[i] = sequence(self, i)
+        return self.sequences[i]
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy as np
+
+
+fps = 10.0
+maxparticles = 1000
+viewoffset = 25.0
+queuesize = 2
+startmethod = 'spawn'
+
+
+def render(snapshots, polemeans, trajectory, output, fps):
+    import matplotlib
+    if output is not None:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figure = plt.figure()
+    mapaxes = figure.add_subplot(1, 1, 1)
+    mapaxes.set_aspect('equal')
+    mapaxes.scatter(polemeans[:, 0], polemeans[:, 1], s=5, c='b', marker='s')
+    mapaxes.plot(trajectory[:, 0], trajectory[:, 1], 'g')
+    particles = mapaxes.scatter([], [], s=1, c='r')
+    arrow = mapaxes.arrow(0.0, 0.0, 1.0, 0.0, length_includes_head=True,
+        head_width=0.7, head_length=1.0, color='k')
+    arrowdata = np.hstack(
+        [arrow.get_xy(), np.zeros([8, 1]), np.ones([8, 1])]).T
+    locpoles = mapaxes.scatter([], [], s=30, c='k', marker='x')
+
+    writer = None
+    if output is None:
+        plt.ion()
+        plt.show()
+    elif output.endswith('.mp4'):
+        import matplotlib.animation
+        writer = matplotlib.animation.FFMpegWriter(fps=fps)
+        writer.setup(figure, output)
+    else:
+        os.makedirs(output, exist_ok=True)
+
+    iframe = 0
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+        xy, T_w_r, polepos_w = snapshot
+        particles.set_offsets(xy)
+        arrow.set_xy(T_w_r.dot(arrowdata)[:2].T)
+        if polepos_w is not None:
+            locpoles.set_offsets(polepos_w)
+        x, y = T_w_r[:2, 3]
+        mapaxes.set_xlim(left=x - viewoffset, right=x + viewoffset)
+        mapaxes.set_ylim(bottom=y - viewoffset, top=y + viewoffset)
+        if output is None:
+            figure.canvas.draw_idle()
+            figure.canvas.flush_events()
+        elif writer is not None:
+            writer.grab_frame()
+        else:
+            figure.savefig(
+                os.path.join(output, 'frame_{:06d}.png'.format(iframe)))
+        iframe += 1
+    if writer is not None:
+        writer.finish()
+    plt.close(figure)
+
+
+class liveplot:
+    """
+        Shows the state of a particle filter on a separate process. update
+        hands over at most fps snapshots per second, each with at most
+        maxparticles particles, and drops snapshots while the renderer is
+        busy, so that plotting never stalls the filter. output selects a
+        window (None), a directory of PNG frames or an MP4 video.
+    """
+    def __init__(self, polemeans, trajectory, output=None, fps=fps,
+            maxparticles=maxparticles):
+        self.interval = 1.0 / fps
+        self.maxparticles = maxparticles
+        self.t_last = -np.inf
+        self.polepos_w = None
+        context = multiprocessing.get_context(startmethod)
+        self.snapshots = context.Queue(maxsize=queuesize)
+        self.process = context.Process(target=render, args=(self.snapshots,
+            np.asarray(polemeans)[:, :2], np.asarray(trajectory)[:, :2],
+            output, fps))
+        self.process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Takes the particle positions [N, 2], the estimated pose and, whenever
+    # poles were observed, their positions [K, 2], which are shown until the
+    # next observation.
+    def update(self, xy, T_w_r, polepos_w=None, force=False):
+        if polepos_w is not None:
+            self.polepos_w = np.array(polepos_w)
+        t_now = time.time()
+        if not force and t_now - self.t_last < self.interval:
+            return
+        step = max(1, int(np.ceil(xy.shape[0] / float(self.maxparticles))))
+        snapshot = (np.array(xy[::step]), np.array(T_w_r), self.polepos_w)
+        try:
+            self.snapshots.put_nowait(snapshot)
+            self.t_last = t_now
+        except queue.Full:
+            pass
+
+    # Waits for the renderer to finish the queued snapshots, unless it has
+    # already exited.
+    def close(self):
+        while self.process.is_alive():
+            try:
+                self.snapshots.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        else:
+            self.snapshots.cancel_join_thread()
+        self.process.join()
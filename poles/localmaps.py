@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import os
+
+import numpy as np
+
+import util
+
+
+poleparamfile = 'poleparams.bin'
+mapfile = 'maps.bin'
+nparams = 6
+maptype = np.dtype([('T_w_m', '<f8', (4, 4)), ('istart', '<i8'),
+    ('imid', '<i8'), ('iend', '<i8'), ('poleend', '<i8')])
+paramsize = nparams * np.dtype('<f8').itemsize
+
+
+class localmapwriter:
+    """
+        Appends local maps to a directory that holds the parameters of all
+        poles in one flat file and one fixed-size record per map. The record
+        of a map is written after its poles, so a map becomes visible to
+        readers only once it is complete. With append=True, an existing
+        directory is continued after its last complete map.
+    """
+    def __init__(self, dir, append=False):
+        self.dir = dir
+        util.makedirs(self.dir)
+        polepath = os.path.join(self.dir, poleparamfile)
+        mappath = os.path.join(self.dir, mapfile)
+        self.nmaps = 0
+        self.npoles = 0
+        if append and os.path.exists(mappath) and os.path.exists(polepath):
+            self.nmaps = os.path.getsize(mappath) // maptype.itemsize
+            if self.nmaps > 0:
+                last = np.fromfile(mappath, dtype=maptype, count=1,
+                    offset=(self.nmaps - 1) * maptype.itemsize)
+                self.npoles = int(last['poleend'][0])
+        for path, size in [(mappath, self.nmaps * maptype.itemsize),
+                (polepath, self.npoles * paramsize)]:
+            with open(path, 'ab') as file:
+                file.truncate(size)
+        self.polefile = open(polepath, 'ab')
+        self.mapfile = open(mappath, 'ab')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.nmaps
+
+    def append(self, poleparams, T_w_m, istart, imid, iend):
+        poleparams = np.reshape(
+            np.asarray(poleparams, dtype='<f8'), [-1, nparams])
+        record = np.zeros(1, dtype=maptype)
+        record['T_w_m'] = T_w_m
+        record['istart'] = istart
+        record['imid'] = imid
+        record['iend'] = iend
+        record['poleend'] = self.npoles + poleparams.shape[0]
+        poleparams.tofile(self.polefile)
+        self.polefile.flush()
+        record.tofile(self.mapfile)
+        self.mapfile.flush()
+        self.npoles += poleparams.shape[0]
+        self.nmaps += 1
+
+    def close(self):
+        self.polefile.close()
+        self.mapfile.close()
+
+
+class localmapreader:
+    """
+        Memory-maps the local maps written by localmapwriter. T_w_m, istart,
+        imid and iend hold one entry per map, and the poles of map i are
+        poleparams[offsets[i]:offsets[i+1]].
+    """
+    def __init__(self, dir):
+        self.dir = dir
+        maps = memmap(os.path.join(self.dir, mapfile), maptype)
+        self.T_w_m = maps['T_w_m']
+        self.istart = maps['istart']
+        self.imid = maps['imid']
+        self.iend = maps['iend']
+        self.offsets = np.hstack([0, maps['poleend']]).astype(np.int64)
+        poleparams = memmap(os.path.join(self.dir, poleparamfile),
+            np.dtype(('<f8', (nparams,))))
+        self.poleparams = poleparams[:self.offsets[-1]]
+
+    def __len__(self):
+        return self.istart.size
+
+    def get_poleparams(self, i):
+        return self.poleparams[self.offsets[i]:self.offsets[i+1]]
+
+    # Returns the poles of maps istart to iend together with their offsets
+    # relative to the first of these maps.
+    def get_range(self, istart, iend):
+        offsets = self.offsets[istart:iend+1]
+        return self.poleparams[offsets[0]:offsets[-1]], offsets - offsets[0]
+
+
+# Maps the complete records of a file, which is empty while no record has
+# been written yet.
+def memmap(filename, dtype):
+    count = os.path.getsize(filename) // dtype.itemsize
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(count,))
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+import asyncio
+import json
+import socket
+import time
+
+import numpy as np
+
+import particlefilter
+import util
+
+
+queuesize = 64
+outboxsize = 1024
+particlecount = 5000
+posrange = 2.5
+angrange = np.radians(5.0)
+polevar = 1.5
+
+
+# Composes two relative odometry measurements given as x, y, phi together
+# with their covariances to first order.
+def compose_odometry(mean0, cov0, mean1, cov1):
+    c = np.cos(mean0[2])
+    s = np.sin(mean0[2])
+    rot = np.array([[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]])
+    mean = util.ht2xyp(util.xyp2ht(mean0).dot(util.xyp2ht(mean1)))
+    jac = np.identity(3)
+    jac[:2, 2] = [-s * mean1[0] - c * mean1[1], c * mean1[0] - s * mean1[1]]
+    cov = jac.dot(cov0).dot(jac.T) + rot.dot(cov1).dot(rot.T)
+    return mean, cov
+
+
+# Returns the arrays carried by a request of the given type, and raises
+# ValueError if they are missing or malformed.
+def parse_request(type, request):
+    try:
+        if type == 'init':
+            return np.reshape(np.array(request['pose'], dtype=np.float64), 3)
+        if type == 'odometry':
+            mean = np.array(request['mean'], dtype=np.float64)
+            cov = np.array(request['cov'], dtype=np.float64)
+            return np.reshape(mean, 3), np.reshape(cov, [3, 3])
+        if type == 'poles':
+            return np.reshape(
+                np.array(request['poles'], dtype=np.float64), [-1, 2])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError('invalid {} request: {!r}'.format(type, e))
+    return None
+
+
+class locservice:
+    """
+        Streaming particle filter localization. Clients send newline-delimited
+        JSON requests of the types init, odometry, poles and stats, and
+        receive one JSON reply per request, which for odometry and poles
+        carries the current pose estimate and the request latency.
+    """
+    def __init__(self, polemeans, T_w_o=np.identity(4), count=particlecount,
+            maxqueue=queuesize):
+        self.polemeans = polemeans
+        self.T_w_o = T_w_o
+        self.count = count
+        self.maxqueue = maxqueue
+        self.filter = None
+        self.queue = None
+        self.outboxes = {}
+        self.latencies = []
+        self.ncoalesced = 0
+
+    def init_filter(self, xyp):
+        self.filter = particlefilter.particlefilter(self.count,
+            util.xyp2ht(xyp), posrange, angrange,
+            self.polemeans, polevar, T_w_o=self.T_w_o)
+
+    # Runs the filter on a batch of requests. Consecutive odometry requests
+    # are merged into a single motion update. Replies are returned in the
+    # order of the requests.
+    def process(self, requests):
+        replies = []
+        pending = []
+        mean = np.zeros(3)
+        cov = np.zeros([3, 3])
+        for request, writer, t_received in requests + [(None, None, None)]:
+            type = request.get('type') if request is not None else None
+            if pending and type != 'odometry':
+                self.filter.update_motion(mean, cov)
+                self.ncoalesced += len(pending) - 1
+                for reply in pending:
+                    reply[3] = len(pending)
+                pending = []
+                mean = np.zeros(3)
+                cov = np.zeros([3, 3])
+            if type is None:
+                break
+            reply = [request, writer, t_received, 1]
+            replies.append(reply)
+            try:
+                data = parse_request(type, request)
+            except ValueError as e:
+                reply[3] = str(e)
+                continue
+            if type == 'init':
+                self.init_filter(data)
+            elif self.filter is None and type in ['odometry', 'poles']:
+                reply[3] = 'filter not initialized'
+            elif type == 'odometry':
+                mean, cov = compose_odometry(mean, cov, *data)
+                pending.append(reply)
+            elif type == 'poles':
+                poleparams = data
+                if poleparams.shape[0] > 0:
+                    self.filter.update_measurement(poleparams)
+            else:
+                reply[3] = 'unknown request type {}'.format(type)
+
+        pose = None
+        if self.filter is not None:
+            pose = util.ht2xyp(self.filter.estimate_pose()).tolist()
+        messages = []
+        for request, writer, t_received, status in replies:
+            reply = {'id': request.get('id'), 'type': request.get('type')}
+            if isinstance(status, str):
+                reply['error'] = status
+            else:
+                latency = time.time() - t_received
+                self.latencies.append(latency)
+                reply.update({'pose': pose, 'latency': latency,
+                    'coalesced': status})
+            messages.append((writer, reply))
+        return messages
+
+    def get_stats(self):
+        latencies = np.array(self.latencies[-10000:])
+        stats = {'requests': len(self.latencies),
+            'coalesced': self.ncoalesced,
+            'queued': self.queue.qsize() if self.queue else 0}
+        if latencies.size > 0:
+            stats.update({'latency_mean': float(np.mean(latencies)),
+                'latency_max': float(np.max(latencies)),
+                'latency_p95': float(np.percentile(latencies, 95))})
+        return stats
+
+    async def handle_client(self, reader, writer):
+        outbox = asyncio.Queue(maxsize=outboxsize)
+        self.outboxes[writer] = outbox
+        sender = asyncio.ensure_future(self.write_replies(writer, outbox))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode())
+                except ValueError:
+                    request = None
+                if not isinstance(request, dict):
+                    self.send(writer, {'error': 'invalid request'})
+                    continue
+                if request.get('type') == 'stats':
+                    self.send(writer, {'id': request.get('id'),
+                        'type': 'stats', 'stats': self.get_stats()})
+                    continue
+                await self.queue.put((request, writer, time.time()))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.send(writer, None)
+            await sender
+
+    # Writes the replies to one client in order until it gets None. A client
+    # that disconnects only loses its own replies.
+    async def write_replies(self, writer, outbox):
+        try:
+            while True:
+                reply = await outbox.get()
+                if reply is None:
+                    break
+                writer.write((json.dumps(reply) + '\n').encode())
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.outboxes.pop(writer, None)
+            writer.close()
+
+    # Queues a reply to the given client without waiting for it to be
+    # written. A client that leaves outboxsize replies unread is dropped.
+    def send(self, writer, reply):
+        outbox = self.outboxes.get(writer)
+        if outbox is None:
+            return
+        try:
+            outbox.put_nowait(reply)
+        except asyncio.QueueFull:
+            del self.outboxes[writer]
+            writer.transport.abort()
+
+    # Takes everything that has queued up while the filter was busy and
+    # processes it in one batch in a worker thread. If the batch fails, all
+    # its requests receive an error and the service keeps running.
+    async def run_filter(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            while not self.queue.empty():
+                requests.append(self.queue.get_nowait())
+            try:
+                messages = await loop.run_in_executor(
+                    None, self.process, requests)
+            except Exception as e:
+                messages = [(writer, {'id': request.get('id'),
+                    'type': request.get('type'),
+                    'error': 'processing failed: {!r}'.format(e)}) \
+                        for request, writer, _ in requests]
+            for writer, reply in messages:
+                self.send(writer, reply)
+
+    async def serve(self, path=None, host='127.0.0.1', port=0):
+        self.queue = asyncio.Queue(maxsize=self.maxqueue)
+        if path is None:
+            server = await asyncio.start_server(
+                self.handle_client, host=host, port=port)
+        else:
+            server = await asyncio.start_unix_server(
+                self.handle_client, path=path)
+        self.address = server.sockets[0].getsockname()
+        worker = asyncio.ensure_future(self.run_filter())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+
+
+class client:
+    """
+        Blocking client for locservice.
+    """
+    def __init__(self, address):
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        self.file = self.socket.makefile('rw')
+        self.id = 0
+
+    def send(self, request):
+        self.id += 1
+        request = dict(request, id=self.id)
+        self.file.write(json.dumps(request) + '\n')
+        self.file.flush()
+        return self.id
+
+    def receive(self):
+        return json.loads(self.file.readline())
+
+    def init(self, xyp):
+        self.send({'type': 'init', 'pose': list(xyp)})
+        return self.receive()
+
+    def odometry(self, t, mean, cov):
+        return self.send({'type': 'odometry', 't': t,
+            'mean': np.asarray(mean).tolist(),
+            'cov': np.asarray(cov).tolist()})
+
+    def poles(self, t, polepos_r):
+        return self.send({'type': 'poles', 't': t,
+            'poles': np.asarray(polepos_r)[:, :2].tolist()})
+
+    def stats(self):
+        self.send({'type': 'stats'})
+        return self.receive()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def serve(globalmapfile, path=None, host='127.0.0.1', port=0,
+        T_w_o=np.identity(4)):
+    with np.load(globalmapfile) as data:
+        polemeans = data['polemeans'][:, :2]
+    service = locservice(polemeans, T_w_o=T_w_o)
+    asyncio.run(service.serve(path=path, host=host, port=port))
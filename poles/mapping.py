@@ -10,6 +10,7 @@ import numpy as np
 import open3d as o3
 import scipy.special
 
+import instrumentation
 import raytracing as rt
 
 
@@ -22,12 +23,16 @@ occupancythreshold = 0.05
 # Poses are specified with respect to the map coordinate frame.
 def occupancymap(scans, poses, mapshape, mapsize):
     map = rt.gridmap(mapshape, mapsize)
+    span = instrumentation.start('raytrace', scans=len(scans))
     for scan, pose in zip(scans, poses):
         scan_map = copy.copy(scan)
         scan_map.transform(pose)
         points = np.asarray(scan_map.points)
         rt.trace3d(np.tile(pose[:3, 3], [points.shape[0], 1]), points, map)
+        instrumentation.count('rays', points.shape[0])
+    instrumentation.stop(span)
 
+    span = instrumentation.start('posterior')
     reflectionmap = map.reflectionmap()
     reflectivity = reflectionmap[np.isfinite(reflectionmap)]
     if reflectivity.size == 0:
@@ -40,6 +45,7 @@ def occupancymap(scans, poses, mapshape, mapsize):
         prior = 1.0 - scipy.special.betainc(alpha, beta, occupancythreshold)
         occupancymap = 1.0 - scipy.special.betainc(
             map.hits + alpha, map.misses + beta, occupancythreshold)
+    instrumentation.stop(span)
         
     return occupancymap
 
@@ -89,6 +95,6 @@ def detect_dynamic_points(scans, poses):
     for i in range(len(scans)):
         scanname = 'scan{:03d}'.format(i)
         maskfilename = os.path.join(tmpdir, maskdir, scanname + '.mask')
-        dynamic.append(np.loadtxt(maskfilename, dtype=np.bool))
+        dynamic.append(np.loadtxt(maskfilename, dtype=bool))
 
     return dynamic
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
+import concurrent.futures
 import copy
 import datetime
 import multiprocessing
 import os
 import shutil
+import time
+import warnings
 
 import matplotlib.patches
 import matplotlib.pyplot as plt
@@ -12,14 +15,26 @@ import numpy as np
 import open3d as o3
 import progressbar
 import scipy.interpolate
+import scipy.spatial
 import scipy.special
 
 import cluster
+import globalmapstore
+import golden
+import instrumentation
+import liveplot
+import localmaps
 import mapping
 import ndshow
+import parallel
 import particlefilter
+import pipeline
 import poles
 import pynclt
+import relocalization
+import scanprovider
+import sharedarena
+import tiledmap
 import util
 
 
@@ -31,13 +46,14 @@ params = {'text.usetex': True,
 
 mapextent = np.array([30.0, 30.0, 5.0])
 mapsize = np.full(3, 0.2)
-mapshape = np.array(mapextent / mapsize, dtype=np.int)
+mapshape = np.array(mapextent / mapsize, dtype=int)
 mapinterval = 1.5
 mapdistance = 1.5
 remapdistance = 10.0
 n_mapdetections = 3
 n_locdetections = 2
 n_localmaps = 3
+trajectoryspacing = 1.0
 
 poles.minscore = 0.6
 poles.minheight = 1.0
@@ -58,13 +74,25 @@ def get_globalmapname():
         n_mapdetections, 10 * poles.minscore, poles.polesides[-1])
 
 
+def get_globalmaptiledir():
+    return os.path.join('nclt', get_globalmapname() + '_tiles')
+
+
+def get_globalmapindexfile():
+    return os.path.join('nclt', get_globalmapname() + '_index.npz')
+
+
+def get_globalmapstoredir():
+    return os.path.join('nclt', get_globalmapname() + '_store')
+
+
 def get_locfileprefix():
     return 'localization_{:.0f}_{:.0f}_{:.0f}'.format(
         n_mapdetections, 10 * poles.minscore, poles.polesides[-1])
 
 
-def get_localmapfile():
-    return 'localmaps_{:.0f}_{:.0f}.npz'.format(
+def get_localmapdir():
+    return 'localmaps_{:.0f}_{:.0f}'.format(
         10 * poles.minscore, poles.polesides[-1])
 
 
@@ -73,70 +101,90 @@ def get_evalfile():
         10 * poles.minscore, poles.polesides[-1])
 
 
+# Returns the index at which the k-th window boundary is reached for all k,
+# that is, the first index whose distance is at least (side='left') or
+# greater than (side='right') k * mapinterval + offset. Since every index
+# passes at most one boundary, the k-th boundary lies no earlier than index k.
+def get_window_bounds(distance, offset, side):
+    k = np.arange(distance.size)
+    ifirst = np.searchsorted(distance, k * mapinterval + offset, side=side)
+    bounds = k + np.maximum.accumulate(ifirst - k)
+    return bounds[bounds < distance.size]
+
+
 def get_map_indices(session):
     distance = np.hstack([0.0, np.cumsum(np.linalg.norm(
         np.diff(session.T_w_r_gt_velo[:, :3, 3], axis=0), axis=1))])
-    istart = []
-    imid = []
-    iend = []
-    i = 0
-    j = 0
-    k = 0
-    for id, d in enumerate(distance):
-        if d >= i * mapinterval:
-            istart.append(id)
-            i += 1
-        if d >= j * mapinterval + 0.5 * mapdistance:
-            imid.append(id)
-            j += 1
-        if d > k * mapinterval + mapdistance:
-            iend.append(id)
-            k += 1
-    return istart[:len(iend)], imid[:len(iend)], iend
-
-
-def save_global_map():
+    istart = get_window_bounds(distance, 0.0, 'left')
+    imid = get_window_bounds(distance, 0.5 * mapdistance, 'left')
+    iend = get_window_bounds(distance, mapdistance, 'right')
+    n = iend.size
+    return istart[:n].tolist(), imid[:n].tolist(), iend.tolist()
+
+
+# Selects the windows of all sessions that contribute to the global map:
+# every window of the first session, and of each further session those
+# whose center is more than remapdistance from all windows selected so far.
+def plan_global_map(sessionnames=pynclt.sessions):
     globalmappos = np.empty([0, 2])
-    mapfactors = np.full(len(pynclt.sessions), np.nan)
-    poleparams = np.empty([0, 6])
-    for isession, s in enumerate(pynclt.sessions):
-        print(s)
-        session = pynclt.session(s)
+    mapfactors = np.full(len(sessionnames), np.nan)
+    windows = []
+    for isession, sessionname in enumerate(sessionnames):
+        session = get_session(sessionname)
         istart, imid, iend = get_map_indices(session)
         localmappos = session.T_w_r_gt_velo[imid, :2, 3]
-        if globalmappos.size == 0:
-            imaps = range(localmappos.shape[0])
-        else:
-            imaps = []
-            for imap in range(localmappos.shape[0]):
-                distance = np.linalg.norm(
-                    localmappos[imap] - globalmappos, axis=1).min()
-                if distance > remapdistance:
-                    imaps.append(imap)
+        imaps = np.arange(localmappos.shape[0])
+        if globalmappos.size > 0 and imaps.size > 0:
+            distance, _ = scipy.spatial.cKDTree(globalmappos).query(
+                localmappos, k=1)
+            imaps = imaps[distance > remapdistance]
         globalmappos = np.vstack([globalmappos, localmappos[imaps]])
-        mapfactors[isession] = np.true_divide(len(imaps), len(imid))
-
-        with progressbar.ProgressBar(max_value=len(imaps)) as bar:
-            for iimap, imap in enumerate(imaps):
-                scans = []
-                for iscan in range(istart[imap], iend[imap]):
-                    xyz, _ = session.get_velo(iscan)
-                    scan = o3.PointCloud()
-                    scan.points = o3.Vector3dVector(xyz)
-                    scans.append(scan)
-                
-                T_w_mc = np.identity(4)
-                T_w_mc[:3, 3] = session.T_w_r_gt_velo[imid[imap], :3, 3]
-                T_w_m = T_w_mc.dot(T_mc_m)
-                T_m_w = util.invert_ht(T_w_m)
-                T_m_r = np.matmul(
-                    T_m_w, session.T_w_r_gt_velo[istart[imap]:iend[imap]])
-                occupancymap = mapping.occupancymap(
-                    scans, T_m_r, mapshape, mapsize)
-                localpoleparams = poles.detect_poles(occupancymap, mapsize)
-                localpoleparams[:, :2] += T_w_m[:2, 3]
-                poleparams = np.vstack([poleparams, localpoleparams])
-                bar.update(iimap)
+        mapfactors[isession] = np.true_divide(imaps.size, len(imid))
+        windows.append([(istart[i], imid[i], iend[i]) for i in imaps])
+    return windows, mapfactors, globalmappos
+
+
+def detect_global_poles(session, scans, istart, imid, iend):
+    T_w_mc = np.identity(4)
+    T_w_mc[:3, 3] = session.T_w_r_gt_velo[imid, :3, 3]
+    T_w_m = T_w_mc.dot(T_mc_m)
+    T_m_w = util.invert_ht(T_w_m)
+    T_m_r = np.matmul(T_m_w, session.T_w_r_gt_velo[istart:iend])
+    occupancymap = mapping.occupancymap(scans, T_m_r, mapshape, mapsize)
+    poleparams = poles.detect_poles(occupancymap, mapsize)
+    poleparams[:, :2] += T_w_m[:2, 3]
+    return poleparams
+
+
+# Worker of save_global_map, which processes consecutive selected windows
+# of one session.
+def build_global_map(args):
+    sessionname, windows, params = args
+    poles.set_params(params)
+    session = get_session(sessionname)
+    istart, imid, iend = [list(w) for w in zip(*windows)]
+    poleparams = []
+    with scanprovider.scanprovider(session) as provider:
+        for i in range(len(windows)):
+            with instrumentation.span('window', session=sessionname,
+                    istart=istart[i], iend=iend[i]):
+                scans = get_scans(provider, istart, iend, i)
+                poleparams.append(detect_global_poles(
+                    session, scans, istart[i], imid[i], iend[i]))
+    return poleparams
+
+
+def save_global_map(processes=None, chunksize=16):
+    windows, mapfactors, globalmappos = plan_global_map()
+    jobs = []
+    for sessionname, sessionwindows in zip(pynclt.sessions, windows):
+        print('{}: {} windows'.format(sessionname, len(sessionwindows)))
+        jobs += [(sessionname, c, poles.get_params()) \
+            for c in parallel.chunk(sessionwindows, chunksize)]
+    open_sessions(sorted(set(job[0] for job in jobs)), scans=True)
+    results = parallel.map_ordered(build_global_map, jobs,
+        processes=processes, counts=[len(job[1]) for job in jobs])
+    poleparams = np.vstack([np.empty([0, 6])] + sum(results, []))
 
     xy = poleparams[:, :2]
     a = poleparams[:, [4]]
@@ -151,10 +199,60 @@ def save_global_map():
             poleparams[ci, :-1], axis=0, weights=poleparams[ci, -1])])
         scores.append(np.mean(poleparams[ci, -1]))
     clustermeans = np.hstack([clustermeans, np.array(scores).reshape([-1, 1])])
+    return write_global_map(
+        clustermeans, pynclt.sessions, mapfactors, globalmappos)
+
+
+# Writes the global map. mapfactors[i] is the fraction of the local maps of
+# session sessionnames[i] that went into it.
+def write_global_map(polemeans, sessionnames, mapfactors, globalmappos):
     globalmapfile = os.path.join('nclt', get_globalmapname() + '.npz')
-    np.savez(globalmapfile, 
-        polemeans=clustermeans, mapfactors=mapfactors, mappos=globalmappos)
+    np.savez(globalmapfile, polemeans=polemeans,
+        sessions=np.array(sessionnames, dtype=str), mapfactors=mapfactors,
+        mappos=globalmappos)
+    tiledmap.save_tiled_map(polemeans, get_globalmaptiledir())
+    relocalization.poleindex(polemeans).save(get_globalmapindexfile())
     plot_global_map(globalmapfile)
+    return [globalmapfile, get_globalmaptiledir(), get_globalmapindexfile()]
+
+
+# Updates the global map in the persistent store to the given sessions.
+# Sessions that are no longer given are retired, and only the windows that
+# the plan selects anew, for example all windows of an added session or
+# those that a retired session covered before, are ray-traced. The store
+# reclusters only the detections connected to the changed windows.
+def update_global_map(sessionnames=pynclt.sessions, processes=None,
+        chunksize=16):
+    store = globalmapstore.globalmapstore(get_globalmapstoredir(),
+        get_mapping_params(), n_mapdetections)
+    for sessionname in list(store.sessions):
+        if sessionname not in sessionnames:
+            store.retire(sessionname)
+    windows, mapfactors, globalmappos = plan_global_map(sessionnames)
+    jobs = []
+    for sessionname, sessionwindows in zip(sessionnames, windows):
+        stored = store.get_windows(sessionname)
+        missing = [w for w in sessionwindows if tuple(w) not in stored]
+        print('{}: {} windows, {} new'.format(
+            sessionname, len(sessionwindows), len(missing)))
+        jobs += [(sessionname, c, poles.get_params()) \
+            for c in parallel.chunk(missing, chunksize)]
+    open_sessions(sorted(set(job[0] for job in jobs)), scans=True)
+    results = parallel.map_ordered(build_global_map, jobs,
+        processes=processes, counts=[len(job[1]) for job in jobs])
+    detections = {}
+    for job, result in zip(jobs, results):
+        detections.update(zip(
+            [(job[0],) + tuple(w) for w in job[1]], result))
+    for sessionname, sessionwindows in zip(sessionnames, windows):
+        stored = store.get_windows(sessionname)
+        store.set_session(sessionname, sessionwindows,
+            [stored[tuple(w)] if tuple(w) in stored \
+                else detections[(sessionname,) + tuple(w)] \
+                    for w in sessionwindows])
+    store.save()
+    return write_global_map(
+        store.polemeans, sessionnames, mapfactors, globalmappos)
 
 
 def plot_global_map(globalmapfile):
@@ -167,35 +265,143 @@ def plot_global_map(globalmapfile):
     plt.ylabel('y [m]')
     plt.savefig(globalmapfile[:-4] + '.svg')
     plt.savefig(globalmapfile[:-4] + '.pgf')
-    print(data['mapfactors'])
-
-
-def save_local_maps(sessionname, visualize=False):
+    print(get_mapfactors(data))
+
+
+# Returns the map factors of a global map file by session name. Maps written
+# without session names were built from all sessions.
+def get_mapfactors(mapdata):
+    sessionnames = pynclt.sessions
+    if 'sessions' in mapdata.files:
+        sessionnames = mapdata['sessions'].tolist()
+    return dict(zip(sessionnames, mapdata['mapfactors'].tolist()))
+
+
+sessioncache = {}
+sharedarrays = {}
+
+
+# Returns the session with the given name, opening it only once per process.
+# Workers memory-map the session cache, which the parent creates before
+# starting them, so its pages are shared through the page cache.
+def get_session(sessionname):
+    if sessionname not in sessioncache:
+        sessioncache[sessionname] = pynclt.session(sessionname)
+    return sessioncache[sessionname]
+
+
+# Initializer of pool workers, which attach to the arrays that the parent
+# published in a shared memory arena instead of loading them again.
+def attach_arena(spec):
+    sharedarrays.update(sharedarena.attach(spec))
+
+
+# Opens the given sessions, which creates their caches if necessary, so that
+# pool workers do not parse the same session concurrently. With scans=True,
+# their scans are packed as well.
+def open_sessions(sessionnames, scans=False):
+    for sessionname in sessionnames:
+        session = get_session(sessionname)
+        if scans:
+            session.scans
+
+
+def get_scans(provider, istart, iend, i):
+    scans = []
+    span = instrumentation.start('get_scans', scans=iend[i] - istart[i])
+    for xyz, _ in provider.get_window(istart, iend, i):
+        scan = o3.PointCloud()
+        scan.points = o3.Vector3dVector(xyz)
+        scans.append(scan)
+    instrumentation.stop(span)
+    return scans
+
+
+def detect_local_poles(session, scans, istart, imid, iend):
+    T_w_mc = util.project_xy(session.T_w_r_odo_velo[imid].dot(T_r_mc))
+    T_w_m = T_w_mc.dot(T_mc_m)
+    T_m_w = util.invert_ht(T_w_m)
+    T_m_r = np.matmul(T_m_w, session.T_w_r_odo_velo[istart:iend])
+    occupancymap = mapping.occupancymap(scans, T_m_r, mapshape, mapsize)
+    return poles.detect_poles(occupancymap, mapsize), T_w_m
+
+
+# Worker of save_local_maps_parallel, which processes consecutive windows
+# of one session.
+def build_local_maps(args):
+    sessionname, windows, params = args
+    poles.set_params(params)
+    session = get_session(sessionname)
+    istart, imid, iend = [list(w) for w in zip(*windows)]
+    maps = []
+    with scanprovider.scanprovider(session) as provider:
+        for i in range(len(windows)):
+            with instrumentation.span('window', session=sessionname,
+                    istart=istart[i], iend=iend[i]):
+                scans = get_scans(provider, istart, iend, i)
+                poleparams, T_w_m = detect_local_poles(
+                    session, scans, istart[i], imid[i], iend[i])
+            maps.append({'poleparams': poleparams, 'T_w_m': T_w_m,
+                'istart': istart[i], 'imid': imid[i], 'iend': iend[i]})
+    return maps
+
+
+# Records golden cases for occupancymap and detect_poles from count windows
+# evenly spaced over the given session.
+def record_golden_windows(dir, sessionname, count=5):
+    session = get_session(sessionname)
+    istart, imid, iend = get_map_indices(session)
+    for i in np.linspace(0, len(iend) - 1, count).astype(int):
+        xyz, _, offsets = session.get_velo_range(istart[i], iend[i])
+        T_w_mc = util.project_xy(session.T_w_r_odo_velo[imid[i]].dot(T_r_mc))
+        T_m_w = util.invert_ht(T_w_mc.dot(T_mc_m))
+        T_m_r = np.matmul(T_m_w, session.T_w_r_odo_velo[istart[i]:iend[i]])
+        inputs = {'points': xyz.astype(np.float64), 'offsets': offsets,
+            'poses': T_m_r, 'mapshape': mapshape, 'mapsize': mapsize}
+        name = '{}_{}'.format(sessionname, i)
+        golden.save_case(dir, 'occupancymap_' + name, 'occupancymap', inputs)
+        golden.save_case(dir, 'detect_poles_' + name, 'detect_poles',
+            {'ogm': golden.occupancymap(**inputs)['occupancymap'],
+                'mapsize': mapsize})
+
+
+def save_local_maps_parallel(sessionnames=pynclt.sessions, processes=None,
+        chunksize=16):
+    jobs = []
+    for sessionname in sessionnames:
+        windows = list(zip(*get_map_indices(get_session(sessionname))))
+        jobs += [(sessionname, c, poles.get_params()) \
+            for c in parallel.chunk(windows, chunksize)]
+    open_sessions(sessionnames, scans=True)
+    results = parallel.map_ordered(build_local_maps, jobs,
+        processes=processes, counts=[len(job[1]) for job in jobs])
+    for sessionname in sessionnames:
+        session = get_session(sessionname)
+        with localmaps.localmapwriter(
+                os.path.join(session.dir, get_localmapdir())) as writer:
+            for job, result in zip(jobs, results):
+                if job[0] == sessionname:
+                    for map in result:
+                        writer.append(**map)
+
+
+# With resume=True, continues after the last map that was completely
+# written by a previous, interrupted call with the same parameters.
+def save_local_maps(sessionname, visualize=False, resume=False):
     print(sessionname)
     session = pynclt.session(sessionname)
-    util.makedirs(session.dir)
     istart, imid, iend = get_map_indices(session)
-    maps = []
-    with progressbar.ProgressBar(max_value=len(iend)) as bar:
-        for i in range(len(iend)):
-            scans = []
-            for idx, val in enumerate(range(istart[i], iend[i])):
-                xyz, _ = session.get_velo(val)
-                scan = o3.PointCloud()
-                scan.points = o3.Vector3dVector(xyz)
-                scans.append(scan)
-
-            T_w_mc = util.project_xy(
-                session.T_w_r_odo_velo[imid[i]].dot(T_r_mc))
-            T_w_m = T_w_mc.dot(T_mc_m)
-            T_m_w = util.invert_ht(T_w_m)
-            T_w_r = session.T_w_r_odo_velo[istart[i]:iend[i]]
-            T_m_r = np.matmul(T_m_w, T_w_r)
-
-            occupancymap = mapping.occupancymap(scans, T_m_r, mapshape, mapsize)
-            poleparams = poles.detect_poles(occupancymap, mapsize)
+    localmapdir = os.path.join(session.dir, get_localmapdir())
+    with progressbar.ProgressBar(max_value=len(iend)) as bar, \
+            scanprovider.scanprovider(session) as provider, \
+            localmaps.localmapwriter(localmapdir, append=resume) as writer:
+        for i in range(len(writer), len(iend)):
+            scans = get_scans(provider, istart, iend, i)
+            poleparams, T_w_m = detect_local_poles(
+                session, scans, istart[i], imid[i], iend[i])
 
             if visualize:
+                T_w_r = session.T_w_r_odo_velo[istart[i]:iend[i]]
                 cloud = o3.PointCloud()
                 for T, scan in zip(T_w_r, scans):
                     s = copy.copy(scan)
@@ -214,136 +420,166 @@ def save_local_maps(sessionname, visualize=False):
                     polevis.append(pole)
                 o3.draw_geometries(polevis + [cloud, mapboundsvis])
 
-            map = {'poleparams': poleparams, 'T_w_m': T_w_m,
-                'istart': istart[i], 'imid': imid[i], 'iend': iend[i]}
-            maps.append(map)
+            writer.append(poleparams, T_w_m, istart[i], imid[i], iend[i])
             bar.update(i)
-    np.savez(os.path.join(session.dir, get_localmapfile()), maps=maps)
+    print(provider.stats)
+    return [localmapdir]
 
 
 def view_local_maps(sessionname):
     sessiondir = os.path.join('nclt', sessionname)
     session = pynclt.session(sessionname)
-    maps = np.load(os.path.join(sessiondir, get_localmapfile()))['maps']
-    for i, map in enumerate(maps):
-        print('Map #{}'.format(i))
-        mapboundsvis = util.create_wire_box(mapextent, [0.0, 0.0, 1.0])
-        mapboundsvis.transform(map['T_w_m'])
-        polevis = []
-        for poleparams in map['poleparams']:
-            x, y, zs, ze, a = poleparams[:5]
-            pole = util.create_wire_box(
-                [a, a, ze - zs], color=[1.0, 1.0, 0.0])
-            T_m_p = np.identity(4)
-            T_m_p[:3, 3] = [x - 0.5 * a, y - 0.5 * a, zs]
-            pole.transform(map['T_w_m'].dot(T_m_p))
-            polevis.append(pole)
-
-        accucloud = o3.PointCloud()
-        for j in range(map['istart'], map['iend']):
-            points, intensities = session.get_velo(j)
-            cloud = o3.PointCloud()
-            cloud.points = o3.Vector3dVector(points)
-            cloud.colors = o3.Vector3dVector(
-                util.intensity2color(intensities / 255.0))
-            cloud.transform(session.T_w_r_odo_velo[j])
-            accucloud.points.extend(cloud.points)
-            accucloud.colors.extend(cloud.colors)
-
-        o3.draw_geometries([accucloud, mapboundsvis] + polevis)
+    maps = localmaps.localmapreader(
+        os.path.join(sessiondir, get_localmapdir()))
+    with scanprovider.scanprovider(session) as provider:
+        for i in range(len(maps)):
+            print('Map #{}'.format(i))
+            mapboundsvis = util.create_wire_box(mapextent, [0.0, 0.0, 1.0])
+            mapboundsvis.transform(maps.T_w_m[i])
+            polevis = []
+            for poleparams in maps.get_poleparams(i):
+                x, y, zs, ze, a = poleparams[:5]
+                pole = util.create_wire_box(
+                    [a, a, ze - zs], color=[1.0, 1.0, 0.0])
+                T_m_p = np.identity(4)
+                T_m_p[:3, 3] = [x - 0.5 * a, y - 0.5 * a, zs]
+                pole.transform(maps.T_w_m[i].dot(T_m_p))
+                polevis.append(pole)
+
+            accucloud = o3.PointCloud()
+            scans = provider.get_window(maps.istart, maps.iend, i)
+            for j, (points, intensities) in zip(
+                    range(maps.istart[i], maps.iend[i]), scans):
+                cloud = o3.PointCloud()
+                cloud.points = o3.Vector3dVector(points)
+                cloud.colors = o3.Vector3dVector(
+                    util.intensity2color(intensities / 255.0))
+                cloud.transform(session.T_w_r_odo_velo[j])
+                accucloud.points.extend(cloud.points)
+                accucloud.colors.extend(cloud.colors)
+
+            o3.draw_geometries([accucloud, mapboundsvis] + polevis)
 
 
 def evaluate_matches():
-    mapdata = np.load(os.path.join('nclt', get_globalmapname() + '.npz'))
-    polemap = mapdata['polemeans'][:, :2]
-    kdtree = scipy.spatial.cKDTree(polemap[:, :2], leafsize=10)
+    kdtree = tiledmap.tiledmap(get_globalmaptiledir())
+    polemap = kdtree.all_polemeans()
     maxdist = 0.5
     n_matches = np.zeros(len(pynclt.sessions))
     n_all = np.zeros(len(pynclt.sessions))
     for i, sessionname in enumerate(pynclt.sessions):
         sessiondir = os.path.join('nclt', sessionname)
         session = pynclt.session(sessionname)
-        maps = np.load(os.path.join(sessiondir, get_localmapfile()))['maps']
-        for map in maps:
-            n = map['poleparams'].shape[0]
+        maps = localmaps.localmapreader(
+            os.path.join(sessiondir, get_localmapdir()))
+        for imap in range(len(maps)):
+            poleparams = maps.get_poleparams(imap)
+            n = poleparams.shape[0]
             n_all[i] += n
             polepos_m = np.hstack(
-                [map['poleparams'][:, :2], np.zeros([n, 1]), np.ones([n, 1])]).T
-            T_w_m = session.T_w_r_gt_velo[map['imid']].dot(T_r_m)
+                [poleparams[:, :2], np.zeros([n, 1]), np.ones([n, 1])]).T
+            T_w_m = session.T_w_r_gt_velo[maps.imid[imap]].dot(T_r_m)
             polepos_w = T_w_m.dot(polepos_m)
-            
+
+            dist, _ = kdtree.query(
+                polepos_w[:2].T, k=1, distance_upper_bound=maxdist)
+
             plt.scatter(polemap[:, 0], polemap[:, 1], color='k')
             plt.scatter(polepos_w[0,:], polepos_w[1,:], color='r')
             plt.show()
-            
-            dist, _ = kdtree.query(
-                polepos_w[:2].T, k=1, distance_upper_bound=maxdist)
             n_matches[i] += np.sum(np.isfinite(dist))
         print('{}: {}'.format(
             sessionname, np.true_divide(n_matches[i], n_all[i])))
 
 
-def localize(sessionname, visualize=False):
+# Returns the relocalization index over the global map, taken from the shared
+# memory arena if it was published there.
+def get_pole_index():
+    if 'poleindex/pairs' in sharedarrays:
+        return relocalization.poleindex(sharedarrays['globalmap'],
+            pairs=sharedarrays['poleindex/pairs'],
+            distances=sharedarrays['poleindex/distances'])
+    return relocalization.load_index(get_globalmapindexfile())
+
+
+# Returns the start pose found from the first local map whose poles match
+# the global map unambiguously, or the given start pose if there is none.
+def relocalize(session, maps, polepos_m, t_start, T_w_r_start):
+    index = get_pole_index()
+    T_mc_r_odo_start = util.project_xy(
+        session.get_T_w_r_odo(t_start).dot(T_r_mc))
+    for imap in range(len(maps)):
+        if polepos_m[imap].shape[1] < relocalization.mininliers:
+            continue
+        T_w_mc_odo = util.project_xy(session.get_T_w_r_odo(
+            session.t_velo[maps.imid[imap]]).dot(T_r_mc))
+        polepos_mc = T_mc_m.dot(polepos_m[imap])
+        T_w_mc = index.locate(np.hstack([polepos_mc[:2].T,
+            maps.get_poleparams(imap)[:, 2:]]))
+        if T_w_mc is not None:
+            T_mc_start = util.invert_ht(T_w_mc_odo).dot(T_mc_r_odo_start)
+            return T_w_mc.dot(T_mc_start.dot(T_mc_r))
+    warnings.warn('Global relocalization of session {} failed, starting '
+        'from the given pose.'.format(session.session))
+    return T_w_r_start
+
+
+# polemap may be a KD-tree over the global map that was built beforehand.
+# With firstrun > 0, the result files are numbered from firstrun on. With
+# visualize=True, the first run is shown in a window or, if visoutput is
+# given, written to a directory of frames or a video.
+def localize(sessionname, visualize=False, nruns=1, tiled=False,
+        relocalize_start=False, polemap=None, firstrun=0, visoutput=None):
     print(sessionname)
-    mapdata = np.load(os.path.join('nclt', get_globalmapname() + '.npz'))
-    polemap = mapdata['polemeans'][:, :2]
+    if polemap is None and tiled:
+        polemap = tiledmap.tiledmap(get_globalmaptiledir())
+    elif polemap is None:
+        mapdata = np.load(os.path.join('nclt', get_globalmapname() + '.npz'))
+        polemap = mapdata['polemeans'][:, :2]
     polevar = 1.50
-    session = pynclt.session(sessionname)
-    locdata = np.load(os.path.join(session.dir, get_localmapfile()))['maps']
-    polepos_m = []
-    polepos_w = []
-    for i in range(len(locdata)):
-        n = locdata[i]['poleparams'].shape[0]
-        pad = np.hstack([np.zeros([n, 1]), np.ones([n, 1])])
-        polepos_m.append(np.hstack([locdata[i]['poleparams'][:, :2], pad]).T)
-        polepos_w.append(locdata[i]['T_w_m'].dot(polepos_m[i]))
+    session = get_session(sessionname)
+    maps = localmaps.localmapreader(
+        os.path.join(session.dir, get_localmapdir()))
+    n = maps.poleparams.shape[0]
+    polepos_m = np.hstack(
+        [maps.poleparams[:, :2], np.zeros([n, 1]), np.ones([n, 1])])
+    polepos_w = np.einsum('nij,nj->ni', np.repeat(
+        maps.T_w_m, np.diff(maps.offsets), axis=0), polepos_m)
+    polepos_m = [p.T for p in np.split(polepos_m, maps.offsets[1:-1])]
+    polepos_w = [p.T for p in np.split(polepos_w, maps.offsets[1:-1])]
     istart = 0
     # igps = np.searchsorted(session.t_gps, session.t_relodo[istart]) + [-4, 1]
     # igps = np.clip(igps, 0, session.gps.shape[0] - 1)
     # T_w_r_start = pynclt.T_w_o
     # T_w_r_start[:2, 3] = np.mean(session.gps[igps], axis=0)
-    T_w_r_start = util.project_xy(
-        session.get_T_w_r_gt(session.t_relodo[istart]).dot(T_r_mc)).dot(T_mc_r)
-    filter = particlefilter.particlefilter(5000, 
+    T_w_r_start = util.project_xy(session.get_T_w_r_gt(
+        session.t_relodo[istart]).dot(T_r_mc)).dot(T_mc_r)
+    if relocalize_start:
+        T_w_r_start = relocalize(session, maps, polepos_m,
+            session.t_relodo[istart], T_w_r_start)
+    filter = particlefilter.batchparticlefilter(nruns, 5000, 
         T_w_r_start, 2.5, np.radians(5.0), polemap, polevar, T_w_o=T_mc_r)
     filter.estimatetype = 'best'
     filter.minneff = 0.5
 
     if visualize:
-        plt.ion()
-        figure = plt.figure()
-        nplots = 1
-        mapaxes = figure.add_subplot(nplots, 1, 1)
-        mapaxes.set_aspect('equal')
-        mapaxes.scatter(polemap[:, 0], polemap[:, 1], s=5, c='b', marker='s')
-        x_gt, y_gt = session.T_w_r_gt[::20, :2, 3].T
-        mapaxes.plot(x_gt, y_gt, 'g')
-        particles = mapaxes.scatter([], [], s=1, c='r')
-        arrow = mapaxes.arrow(0.0, 0.0, 1.0, 0.0, length_includes_head=True, 
-            head_width=0.7, head_length=1.0, color='k')
-        arrowdata = np.hstack(
-            [arrow.get_xy(), np.zeros([8, 1]), np.ones([8, 1])]).T
-        locpoles = mapaxes.scatter([], [], s=30, c='k', marker='x')
-        viewoffset = 25.0
-
-        # weightaxes = figure.add_subplot(nplots, 1, 2)
-        # gridsize = 50
-        # offset = 5.0
-        # visfilter = particlefilter.particlefilter(gridsize**2, 
-        #     np.identity(4), 0.0, 0.0, polemap, 
-        #     polevar, T_w_o=pynclt.T_w_o)
-        # gridcoord = np.linspace(-offset, offset, gridsize)
-        # x, y = np.meshgrid(gridcoord, gridcoord)
-        # dxy = np.hstack([x.reshape([-1, 1]), y.reshape([-1, 1])])
-        # weightimage = weightaxes.matshow(np.zeros([gridsize, gridsize]), 
-        #     extent=(-offset, offset, -offset, offset))
-        # histaxes = figure.add_subplot(nplots, 1, 3)
+        if isinstance(polemap, tiledmap.tiledmap):
+            with np.load(os.path.join(
+                    'nclt', get_globalmapname() + '.npz')) as data:
+                xy = data['polemeans'][:, :2]
+        elif isinstance(polemap, scipy.spatial.cKDTree):
+            xy = polemap.data
+        else:
+            xy = polemap
+        trajectory = session.T_w_r_gt[:, :2, 3]
+        plot = liveplot.liveplot(xy, trajectory[util.decimate_trajectory(
+            trajectory, trajectoryspacing)], output=visoutput)
 
     imap = 0
-    while imap < locdata.shape[0] - 1 and \
-            session.t_velo[locdata[imap]['iend']] < session.t_relodo[istart]:
+    while imap < len(maps) - 1 and \
+            session.t_velo[maps.iend[imap]] < session.t_relodo[istart]:
         imap += 1
-    T_w_r_est = np.full([session.t_relodo.size, 4, 4], np.nan)
+    T_w_r_est = np.full([nruns, session.t_relodo.size, 4, 4], np.nan)
     with progressbar.ProgressBar(max_value=session.t_relodo.size) as bar:
         for i in range(istart, session.t_relodo.size):
             relodocov = np.empty([3, 3])
@@ -351,15 +587,16 @@ def localize(sessionname, visualize=False):
             relodocov[:, 2] = session.relodocov[i, [0, 1, 5], 5]
             relodocov[2, :] = session.relodocov[i, 5, [0, 1, 5]]
             filter.update_motion(session.relodo[i], relodocov * 2.0**2)
-            T_w_r_est[i] = filter.estimate_pose()
+            T_w_r_est[:, i] = filter.estimate_pose()
             t_now = session.t_relodo[i]
-            if imap < locdata.shape[0]:
-                t_end = session.t_velo[locdata[imap]['iend']]
+            polepos_w_est = None
+            if imap < len(maps):
+                t_end = session.t_velo[maps.iend[imap]]
                 if t_now >= t_end:
                     imaps = range(imap, np.clip(imap-n_localmaps, -1, None), -1)
                     xy = np.hstack([polepos_w[j][:2] for j in imaps]).T
-                    a = np.vstack([ld['poleparams'][:, [4]] \
-                        for ld in locdata[imaps]])
+                    a = np.vstack(
+                        [maps.get_poleparams(j)[:, [4]] for j in imaps])
                     boxes = np.hstack([xy - 0.5 * a, xy + 0.5 * a])
                     ipoles = set(range(polepos_w[imap].shape[1]))
                     iactive = set()
@@ -370,7 +607,7 @@ def localize(sessionname, visualize=False):
                     # print('{}.'.format(
                     #     len(iactive) - polepos_w[imap].shape[1]))
                     if iactive:
-                        t_mid = session.t_velo[locdata[imap]['imid']]
+                        t_mid = session.t_velo[maps.imid[imap]]
                         T_w_r_mid = util.project_xy(session.get_T_w_r_odo(
                             t_mid).dot(T_r_mc)).dot(T_mc_r)
                         T_w_r_now = util.project_xy(session.get_T_w_r_odo(
@@ -379,43 +616,112 @@ def localize(sessionname, visualize=False):
                         polepos_r_now = T_r_now_r_mid.dot(T_r_m).dot(
                             polepos_m[imap][:, iactive])
                         filter.update_measurement(polepos_r_now[:2].T)
-                        T_w_r_est[i] = filter.estimate_pose()
+                        T_w_r_est[:, i] = filter.estimate_pose()
                         if visualize:
-                            polepos_w_est = T_w_r_est[i].dot(polepos_r_now)
-                            locpoles.set_offsets(polepos_w_est[:2].T)
-
-                            # T_w_r_gt_now = session.get_T_w_r_gt(t_now)
-                            # T_w_r_gt_now = np.tile(
-                            #     T_w_r_gt_now, [gridsize**2, 1, 1])
-                            # T_w_r_gt_now[:, :2, 3] += dxy
-                            # visfilter.particles = T_w_r_gt_now
-                            # visfilter.weights[:] = 1.0 / visfilter.count
-                            # visfilter.update_measurement(
-                            #     polepos_r_now[:2].T, resample=False)
-                            # weightimage.set_array(np.flipud(
-                            #     visfilter.weights.reshape(
-                            #         [gridsize, gridsize])))
-                            # weightimage.autoscale()
+                            polepos_w_est = T_w_r_est[0, i].dot(
+                                polepos_r_now)[:2].T
                     imap += 1
             
             if visualize:
-                particles.set_offsets(filter.particles[:, :2, 3])
-                arrow.set_xy(T_w_r_est[i].dot(arrowdata)[:2].T)
-                x, y = T_w_r_est[i, :2, 3]
-                mapaxes.set_xlim(left=x - viewoffset, right=x + viewoffset)
-                mapaxes.set_ylim(bottom=y - viewoffset, top=y + viewoffset)
-                # histaxes.cla()
-                # histaxes.hist(filter.weights, 
-                #     bins=50, range=(0.0, np.max(filter.weights)))
-                figure.canvas.draw_idle()
-                figure.canvas.flush_events()
+                plot.update(filter.particles[0, :, :2, 3], T_w_r_est[0, i],
+                    polepos_w_est)
             bar.update(i)
+    if visualize:
+        plot.close()
     filename = os.path.join(session.dir, get_locfileprefix() \
-        + datetime.datetime.now().strftime('_%Y-%m-%d_%H-%M-%S.npz'))
-    np.savez(filename, T_w_r_est=T_w_r_est)
-
-
-def plot_trajectories():
+        + datetime.datetime.now().strftime('_%Y-%m-%d_%H-%M-%S'))
+    filenames = []
+    for irun in range(nruns):
+        suffix = '_{:02d}.npz'.format(firstrun + irun) \
+            if nruns > 1 or firstrun > 0 else '.npz'
+        tmpfile = filename + suffix + '.tmp'
+        with open(tmpfile, 'wb') as file:
+            np.savez(file, T_w_r_est=T_w_r_est[irun])
+        os.replace(tmpfile, filename + suffix)
+        filenames.append(filename + suffix)
+    return filenames
+
+
+globalmap = None
+
+
+# Returns the KD-tree over the global map in the shared memory arena. Each
+# worker builds it once on top of the shared pole positions.
+def get_global_map():
+    global globalmap
+    if globalmap is None:
+        globalmap = scipy.spatial.cKDTree(
+            sharedarrays['globalmap'], leafsize=3)
+    return globalmap
+
+
+def localize_runs(args):
+    sessionname, nruns, firstrun, relocalize_start = args
+    return localize(sessionname, nruns=nruns, polemap=get_global_map(),
+        firstrun=firstrun, relocalize_start=relocalize_start)
+
+
+# Localizes every session nruns times on a process pool, with at most
+# runsperjob runs of a session sharing one batch particle filter. The global
+# map and its relocalization index are published once in shared memory, to
+# which the workers attach, while the sessions are memory-mapped from their
+# caches.
+def localize_batch(sessionnames=pynclt.sessions, nruns=1, runsperjob=4,
+        processes=None, relocalize_start=False):
+    mapdata = np.load(os.path.join('nclt', get_globalmapname() + '.npz'))
+    arrays = {'globalmap': mapdata['polemeans'][:, :2]}
+    if relocalize_start:
+        index = relocalization.load_index(get_globalmapindexfile())
+        arrays.update({'poleindex/pairs': index.pairs,
+            'poleindex/distances': index.distances})
+    jobs = [(s, min(runsperjob, nruns - i), i, relocalize_start) \
+        for s in sessionnames for i in range(0, nruns, runsperjob)]
+    open_sessions(sessionnames)
+    t_start = time.time()
+    with sharedarena.arena(arrays) as arena:
+        results = parallel.map_ordered(localize_runs, jobs,
+            processes=processes, initializer=attach_arena,
+            initargs=(arena.spec,))
+    duration = time.time() - t_start
+    files = {s: [] for s in sessionnames}
+    for job, filenames in zip(jobs, results):
+        files[job[0]] += filenames
+    print('{} sessions, {} runs in {:.0f} s: {:.1f} sessions per hour'.format(
+        len(sessionnames), len(sessionnames) * nruns, duration,
+        3600.0 * len(sessionnames) / duration))
+    return files
+
+
+def plot_session_trajectories(args):
+    sessionname, trajectorydir, pgfdir, polemap, spacing = args
+    plt.rcParams.update(params)
+    session = pynclt.session(sessionname)
+    files = [file for file \
+        in os.listdir(os.path.join(pynclt.resultdir, sessionname)) \
+            if file.startswith('localization_3_6_7_2019-07')]
+            # if file.startswith(get_locfileprefix())]
+    xy_gt = session.T_w_r_gt[:, :2, 3]
+    xy_gt = xy_gt[util.decimate_trajectory(xy_gt, spacing)]
+    for file in files:
+        xy_est = np.load(os.path.join(
+            pynclt.resultdir, sessionname, file))['T_w_r_est'][:, :2, 3]
+        xy_est = xy_est[util.decimate_trajectory(xy_est, spacing)]
+        plt.clf()
+        plt.scatter(polemap[:, 0], polemap[:, 1], s=1, c='b', marker='.')
+        plt.plot(xy_gt[:, 0], xy_gt[:, 1], color=(0.5, 0.5, 0.5))
+        plt.plot(xy_est[:, 0], xy_est[:, 1], 'r')
+        plt.xlabel('x [m]')
+        plt.ylabel('y [m]')
+        plt.gcf().subplots_adjust(
+            bottom=0.13, top=0.98, left=0.145, right=0.98)
+        filename = sessionname + file[18:-4]
+        plt.savefig(os.path.join(trajectorydir, filename + '.svg'))
+        plt.savefig(os.path.join(pgfdir, filename + '.pgf'))
+
+
+# Plots the trajectories of all sessions in parallel, drawing one pose per
+# spacing meters of trajectory.
+def plot_trajectories(spacing=trajectoryspacing, processes=None):
     trajectorydir = os.path.join(
         pynclt.resultdir, 'trajectories_est_{:.0f}_{:.0f}_{:.0f}'.format(
             n_mapdetections, 10 * poles.minscore, poles.polesides[-1]))
@@ -423,91 +729,103 @@ def plot_trajectories():
     util.makedirs(trajectorydir)
     util.makedirs(pgfdir)
     mapdata = np.load(os.path.join('nclt', get_globalmapname() + '.npz'))
-    polemap = mapdata['polemeans']
-    plt.rcParams.update(params)
-    for sessionname in pynclt.sessions:
-        try:
-            session = pynclt.session(sessionname)
-            files = [file for file \
+    polemap = mapdata['polemeans'][:, :2]
+    parallel.map_ordered(plot_session_trajectories,
+        [(s, trajectorydir, pgfdir, polemap, spacing) \
+            for s in pynclt.sessions], processes=processes)
+
+
+def load_estimate(filename):
+    with np.load(filename) as data:
+        return data['T_w_r_est']
+
+
+# Computes the errors of all given localization results of one session at
+# points spaced 1 m apart along the ground truth trajectory.
+def evaluate_session(args):
+    sessionname, files = args
+    session = get_session(sessionname)
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        T_w_r_est = np.stack(list(executor.map(load_estimate, files)))
+    cumdist = np.hstack([0.0, np.cumsum(np.linalg.norm(np.diff(
+        session.T_w_r_gt[:, :3, 3], axis=0), axis=1))])
+    t_eval = scipy.interpolate.interp1d(
+        cumdist, session.t_gt)(np.arange(0.0, cumdist[-1], 1.0))
+    T_w_r_gt = np.matmul(util.project_xy(
+        np.matmul(session.get_T_w_r_gt(t_eval), T_r_mc)), T_mc_r)
+    T_gt_est = np.matmul(util.invert_ht(T_w_r_gt),
+        util.interpolate_ht(T_w_r_est, session.t_relodo, t_eval))
+    poserrors = np.linalg.norm(T_gt_est[..., :2, 3], axis=-1)
+    angerrors = np.degrees(np.abs(
+        np.arctan2(T_gt_est[..., 1, 0], T_gt_est[..., 0, 0])))
+    return {'session': sessionname,
+        'lonerror': np.mean(np.mean(np.abs(T_gt_est[..., 0, 3]), axis=-1)),
+        'laterror': np.mean(np.mean(np.abs(T_gt_est[..., 1, 3]), axis=-1)),
+        'poserror': np.mean(np.mean(poserrors, axis=-1)),
+        'posrmse': np.mean(np.sqrt(np.mean(poserrors**2, axis=-1))),
+        'angerror': np.mean(np.mean(angerrors, axis=-1)),
+        'angrmse': np.mean(np.sqrt(np.mean(angerrors**2, axis=-1))),
+        'T_gt_est': T_gt_est}
+
+
+# Evaluates the given localization result files per session, by default
+# those found in the session directories.
+def evaluate(files=None, processes=None):
+    if files is None:
+        files = {}
+        for sessionname in pynclt.sessions:
+            files[sessionname] = sorted([os.path.join(
+                pynclt.resultdir, sessionname, file) for file \
                 in os.listdir(os.path.join(pynclt.resultdir, sessionname)) \
-                    if file.startswith('localization_3_6_7_2019-07')]
+                    if file.startswith('localization_3_6_7_2019-07')])
                     # if file.startswith(get_locfileprefix())]
-            for file in files:
-                T_w_r_est = np.load(os.path.join(
-                    pynclt.resultdir, sessionname, file))['T_w_r_est']
-                plt.clf()
-                plt.scatter(polemap[:, 0], polemap[:, 1], 
-                    s=1, c='b', marker='.')
-                plt.plot(session.T_w_r_gt[::20, 0, 3], 
-                    session.T_w_r_gt[::20, 1, 3], color=(0.5, 0.5, 0.5))
-                plt.plot(T_w_r_est[::20, 0, 3], T_w_r_est[::20, 1, 3], 'r')
-                plt.xlabel('x [m]')
-                plt.ylabel('y [m]')
-                plt.gcf().subplots_adjust(
-                    bottom=0.13, top=0.98, left=0.145, right=0.98)
-                filename = sessionname + file[18:-4]
-                plt.savefig(os.path.join(trajectorydir, filename + '.svg'))
-                plt.savefig(os.path.join(pgfdir, filename + '.pgf'))
-        except:
-            pass
-
-
-def evaluate():
-    stats = []
-    for sessionname in pynclt.sessions:
-        files = [file for file \
-            in os.listdir(os.path.join(pynclt.resultdir, sessionname)) \
-                if file.startswith('localization_3_6_7_2019-07')]
-                # if file.startswith(get_locfileprefix())]
-        files.sort()
-        session = pynclt.session(sessionname)
-        cumdist = np.hstack([0.0, np.cumsum(np.linalg.norm(np.diff(
-            session.T_w_r_gt[:, :3, 3], axis=0), axis=1))])
-        t_eval = scipy.interpolate.interp1d(
-            cumdist, session.t_gt)(np.arange(0.0, cumdist[-1], 1.0))
-        T_w_r_gt = np.stack([util.project_xy(
-                session.get_T_w_r_gt(t).dot(T_r_mc)).dot(T_mc_r) \
-                    for t in t_eval])
-        T_gt_est = []
-        for file in files:
-            T_w_r_est = np.load(os.path.join(
-                pynclt.resultdir, sessionname, file))['T_w_r_est']
-            T_w_r_est_interp = np.empty([len(t_eval), 4, 4])
-            iodo = 1
-            for ieval in range(len(t_eval)):
-                while session.t_relodo[iodo] < t_eval[ieval]:
-                    iodo += 1
-                T_w_r_est_interp[ieval] = util.interpolate_ht(
-                    T_w_r_est[iodo-1:iodo+1], 
-                    session.t_relodo[iodo-1:iodo+1], t_eval[ieval])
-            T_gt_est.append(
-                np.matmul(util.invert_ht(T_w_r_gt), T_w_r_est_interp))
-        T_gt_est = np.stack(T_gt_est)
-        lonerror = np.mean(np.mean(np.abs(T_gt_est[..., 0, 3]), axis=-1))
-        laterror = np.mean(np.mean(np.abs(T_gt_est[..., 1, 3]), axis=-1))
-        poserrors = np.linalg.norm(T_gt_est[..., :2, 3], axis=-1)
-        poserror = np.mean(np.mean(poserrors, axis=-1))
-        posrmse = np.mean(np.sqrt(np.mean(poserrors**2, axis=-1)))
-        angerrors = np.degrees(np.abs(
-            np.array([util.ht2xyp(T)[:, 2] for T in T_gt_est])))
-        angerror = np.mean(np.mean(angerrors, axis=-1))
-        angrmse = np.mean(np.sqrt(np.mean(angerrors**2, axis=-1)))
-        stats.append({'session': sessionname, 'lonerror': lonerror, 
-            'laterror': laterror, 'poserror': poserror, 'posrmse': posrmse,
-            'angerror': angerror, 'angrmse': angrmse, 'T_gt_est': T_gt_est})
-    np.savez(os.path.join(pynclt.resultdir, get_evalfile()), stats=stats)
+    jobs = [(s, files[s]) for s in pynclt.sessions if s in files]
+    open_sessions([job[0] for job in jobs])
+    stats = parallel.map_ordered(evaluate_session, jobs, processes=processes)
+    evalfile = os.path.join(pynclt.resultdir, get_evalfile())
+    np.savez(evalfile, stats=stats)
     
-    mapdata = np.load(os.path.join('nclt', get_globalmapname() + '.npz'))
+    mapfactors = get_mapfactors(
+        np.load(os.path.join('nclt', get_globalmapname() + '.npz')))
     print('session \t f\te_pos \trmse_pos \te_ang \te_rmse')
     row = '{session} \t{f} \t{poserror} \t{posrmse} \t{angerror} \t{angrmse}'
     for i, stat in enumerate(stats):
         print(row.format(
             session=stat['session'],
-            f=mapdata['mapfactors'][i] * 100.0,
+            f=mapfactors.get(stat['session'], np.nan) * 100.0,
             poserror=stat['poserror'],
             posrmse=stat['posrmse'],
             angerror=stat['angerror'],
             angrmse=stat['angrmse']))
+    return evalfile
+
+
+def get_mapping_params():
+    return dict(poles.get_params(), mapextent=mapextent.tolist(),
+        mapsize=mapsize.tolist(), mapinterval=mapinterval,
+        mapdistance=mapdistance)
+
+
+# Runs all stages from the global map to the evaluation, skipping the
+# sessions whose results are up to date.
+def run_pipeline(sessionnames=pynclt.sessions, nruns=1):
+    runner = pipeline.pipeline(os.path.join('nclt', 'pipeline.json'))
+    mappingparams = get_mapping_params()
+    runner.run('globalmap', lambda unit, resume: update_global_map(),
+        dict(mappingparams, remapdistance=remapdistance,
+            n_mapdetections=n_mapdetections, sessions=list(pynclt.sessions)))
+    runner.run('localmaps',
+        lambda unit, resume: save_local_maps(unit, resume=resume),
+        mappingparams, units=sessionnames)
+    runner.run('localization',
+        lambda unit, resume: localize(unit, nruns=nruns),
+        {'n_locdetections': n_locdetections, 'n_localmaps': n_localmaps,
+            'nruns': nruns},
+        units=sessionnames, deps=['globalmap', 'localmaps'])
+    files = {s: runner.manifest['localization'][s]['outputs'] \
+        for s in sessionnames}
+    runner.run('evaluation', lambda unit, resume: [evaluate(files)],
+        {'sessions': list(sessionnames)}, deps=['localization'])
 
 
 if __name__ == '__main__':
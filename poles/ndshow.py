@@ -6,76 +6,109 @@ import numpy as np
 import torch
 
 
-def _take(data, index):
-    slice = data
-    for i in range(len(index)):
-        slice = np.take(slice, min(slice.shape[0]-1, index[i]), axis=0)
-
-    return slice
-
-
-def matshow(data, matnames=[], dimnames=[]):
+# Number of elements from which the value range of a matrix is estimated,
+# and the maximum number of pixels shown along each side of a slice.
+rangesamples = 2**22
+maxdisplaysize = 1024
+
+
+# Accepts arrays, memory maps, tensors and the names of .npy files, which
+# are memory-mapped so that only the displayed slices are read.
+def _open(data):
+    if isinstance(data, str):
+        return np.load(data, mmap_mode='r')
+    if type(data) is torch.Tensor:
+        return data.detach().cpu().numpy()
+    return np.asanyarray(data)
+
+
+# Returns the value range of data. Large arrays are subsampled with the same
+# step along every axis instead of being read completely.
+def get_range(data, samples=rangesamples):
+    if data.size > samples:
+        step = int(np.ceil((data.size / float(samples))**(1.0 / data.ndim)))
+        data = data[(slice(None, None, step),) * data.ndim]
+    data = np.asarray(data)
+    if data.size == 0:
+        return 0.0, 1.0
+    return float(np.nanmin(data)), float(np.nanmax(data))
+
+
+# Returns the 2D slice at the given indices of the leading axes, which are
+# clipped to the shape of data, taking every step-th pixel.
+def _take(data, index, step=1):
+    index = tuple(min(data.shape[i] - 1, index[i]) for i in range(len(index)))
+    return np.asarray(data[index + (slice(None, None, step),) * 2])
+
+
+def matshow(data, matnames=[], dimnames=[], ranges=[],
+        maxdisplaysize=maxdisplaysize):
     if not isinstance(data, list):
         data = [data]
-
-    for i in range(len(data)):
-        if type(data[i]) is torch.Tensor:
-            data[i] = data[i].numpy()
+    data = [_open(d) for d in data]
 
     ndim = max([d.ndim for d in data])
-
-    for i in range(len(data)):
-        while data[i].ndim < ndim:
-            data[i] = np.expand_dims(data[i], axis=0)
+    # Adding leading axes creates views, so memory maps stay unread.
+    data = [d.reshape((1,) * (ndim - d.ndim) + d.shape) for d in data]
 
     shape = []
     for dim in range(ndim - 2):
         shape.append(max(d.shape[dim] for d in data))
 
+    steps = [max(1, int(np.ceil(max(d.shape[-2:]) / float(maxdisplaysize)))) \
+        for d in data]
+    ranges = list(ranges) + [get_range(d) for d in data[len(ranges):]]
+
     figure, axes = plt.subplots(
         1, len(data), sharex=True, sharey=True, squeeze=False)
 
     for i in range(len(data)):
-        axes[0,i].imshow(_take(data[i], [0] * (ndim-2)), 
-            vmin=np.amin(data[i]), vmax=np.amax(data[i]),
+        axes[0,i].imshow(_take(data[i], [0] * (ndim-2), steps[i]),
+            vmin=ranges[i][0], vmax=ranges[i][1],
             interpolation=None, origin='lower',
             extent=[0.0, data[i].shape[-1], 0.0, data[i].shape[-2]])
 
     for i in range(min(len(data), len(matnames))):
         axes[0,i].set_title(matnames[i])
 
+    # Only matrices whose clipped indices changed are sliced again.
+    shown = [tuple([0] * (ndim-2))] * len(data)
+
+    def update(val):
+        indices = [int(slider.val) for slider in sliders]
+        for j in range(axes.size):
+            index = tuple(min(data[j].shape[k] - 1, indices[k]) \
+                for k in range(len(indices)))
+            if index != shown[j]:
+                axes[0,j].images[0].set_array(
+                    _take(data[j], index, steps[j]))
+                shown[j] = index
+        figure.canvas.draw_idle()
+
     sliders = []
-    updatefuncs = []
     bottom = np.linspace(0.0, 0.1, ndim)[1:-1]
     for i in range(len(shape)):
-        sliderax = plt.axes([0.2, bottom[i], 0.6, 0.02], 
+        sliderax = plt.axes([0.2, bottom[i], 0.6, 0.02],
             facecolor='lightgoldenrodyellow')
 
         if i < len(dimnames):
             label = dimnames[i]
         else:
             label = 'Axis {}'.format(i)
-        sliders.append(Slider(sliderax, label=label, 
+        sliders.append(Slider(sliderax, label=label,
             valmin=0, valmax=shape[i]-1, valinit=0, valstep=1))
-
-        def update(val):
-            indices = [int(slider.val) for slider in sliders]
-            for j in range(axes.size):
-                axes[0,j].images[0].set_array(_take(data[j], indices))
-            figure.canvas.draw_idle()
-        updatefuncs.append(update)
-
-        sliders[i].on_changed(updatefuncs[i])
+        sliders[i].on_changed(update)
 
     plt.show()
 
 
 if __name__ == '__main__':
     matshow(np.random.rand(100, 15, 25, 64, 64))
-    matshow(np.random.rand(100, 15, 25, 64, 64), 
-        matnames=['Matrix A', 'Matrix B'], 
+    matshow(np.random.rand(100, 15, 25, 64, 64),
+        matnames=['Matrix A', 'Matrix B'],
         dimnames=['depth', 'height', 'width'])
     matshow([np.random.rand(64, 64, 64), np.random.rand(10, 10, 64)])
-    matshow([np.random.rand(9, 11), np.random.rand(12, 12, 6)], 
+    matshow([np.random.rand(9, 11), np.random.rand(12, 12, 6)],
         matnames=['9x11', '12x12x6'])
     matshow(np.random.rand(100, 100, 100))
+    matshow(np.random.rand(4, 4000, 3000), ranges=[(0.0, 1.0)])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import concurrent.futures
+import multiprocessing
+import warnings
+
+import progressbar
+
+
+maxretries = 2
+# Workers are spawned rather than forked, since a forked child cannot use
+# CUDA once the parent has initialized it.
+startmethod = 'spawn'
+
+
+def chunk(items, size):
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+def map_ordered(func, items, processes=None, counts=None,
+        retries=maxretries, initializer=None, initargs=()):
+    """
+        Applies func to all items on a process pool and returns the results
+        in the order of the items. Items that raise or whose worker dies are
+        resubmitted to a fresh pool up to retries times. The progress bar
+        advances by counts[i] when item i is done, by one by default.
+    """
+    if counts is None:
+        counts = [1] * len(items)
+    results = [None] * len(items)
+    attempts = [0] * len(items)
+    todo = list(range(len(items)))
+    done = 0
+    context = multiprocessing.get_context(startmethod)
+    with progressbar.ProgressBar(max_value=sum(counts)) as bar:
+        while todo:
+            failed = []
+            executor = concurrent.futures.ProcessPoolExecutor(processes,
+                mp_context=context, initializer=initializer,
+                initargs=initargs)
+            try:
+                futures = {executor.submit(func, items[i]): i for i in todo}
+                for future in concurrent.futures.as_completed(futures):
+                    i = futures[future]
+                    try:
+                        results[i] = future.result()
+                    except Exception as e:
+                        attempts[i] += 1
+                        if attempts[i] > retries:
+                            raise
+                        warnings.warn('Retrying item {} after {!r}.'.format(
+                            i, e))
+                        failed.append(i)
+                        continue
+                    done += counts[i]
+                    bar.update(done)
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+            todo = sorted(failed)
+    return results
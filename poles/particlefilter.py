@@ -5,6 +5,7 @@ import warnings
 import numpy as np
 import scipy
 
+import tiledmap
 import util
 
 
@@ -23,7 +24,8 @@ class particlefilter:
             angle = #count times a random angle -pi -> pi
             xy = the angles multiplied by distance (radius)
             dxyp = xy and #count random angles from the anglerange
-            particles = #count points in 2D-space and an angle phi
+            particles = #count points in 2D-space and an angle phi, spread
+                evenly over the start poses if several are given
             weights = starts with uniform weight
 
         """
@@ -32,11 +34,17 @@ class particlefilter:
         xy = r * np.hstack([np.cos(angle), np.sin(angle)])
         dxyp = np.hstack([xy, np.random.uniform(
             low=-angrange, high=angrange, size=[self.count, 1])])
-        self.particles = np.matmul(start, util.xyp2ht(dxyp))
+        start = np.reshape(start, [-1, 4, 4])
+        self.particles = np.matmul(start[np.arange(self.count) % start.shape[0]],
+            util.xyp2ht(dxyp))
         self.weights = np.full(self.count, 1.0 / self.count)
         self.polemeans = polemeans
         self.poledist = scipy.stats.norm(loc=0.0, scale=np.sqrt(polevar))
-        self.kdtree = scipy.spatial.cKDTree(polemeans[:, :2], leafsize=3)
+        if isinstance(polemeans,
+                (tiledmap.tiledmap, scipy.spatial.cKDTree)):
+            self.kdtree = polemeans
+        else:
+            self.kdtree = scipy.spatial.cKDTree(polemeans[:, :2], leafsize=3)
         self.T_w_o = T_w_o
         self.T_o_w = util.invert_ht(self.T_w_o)
 
@@ -94,7 +102,7 @@ class particlefilter:
     def resample(self):
         cumsum = np.cumsum(self.weights)
         pos = np.random.rand() / self.count
-        idx = np.empty(self.count, dtype=np.int)
+        idx = np.empty(self.count, dtype=np.int64)
         ics = 0
         for i in range(self.count):
             while cumsum[ics] < pos:
@@ -103,3 +111,109 @@ class particlefilter:
             pos += 1.0 / self.count
         self.particles = self.particles[idx]
         self.weights[:] = 1.0 / self.count
+
+
+class batchparticlefilter:
+    """
+        Runs several independent particle filters as one [runs, count]
+        particle array, so that odometry, measurements and map lookups are
+        shared between the runs.
+    """
+    def __init__(self, runs, count, start, posrange, angrange,
+            polemeans, polevar, T_w_o=np.identity(4)):
+        self.p_min = 0.01
+        self.d_max = np.sqrt(-2.0 * polevar * np.log(
+            np.sqrt(2.0 * np.pi * polevar) * self.p_min))
+        self.minneff = 0.5
+        self.estimatetype = 'best'
+        self.runs = runs
+        self.count = count
+
+        size = [self.runs * self.count, 1]
+        r = np.random.uniform(low=0.0, high=posrange, size=size)
+        angle = np.random.uniform(low=-np.pi, high=np.pi, size=size)
+        xy = r * np.hstack([np.cos(angle), np.sin(angle)])
+        dxyp = np.hstack([xy, np.random.uniform(
+            low=-angrange, high=angrange, size=size)])
+        start = np.reshape(start, [-1, 4, 4])
+        istart = np.tile(np.arange(self.count) % start.shape[0], self.runs)
+        self.particles = np.matmul(start[istart], util.xyp2ht(dxyp)).reshape(
+            [self.runs, self.count, 4, 4])
+        self.weights = np.full([self.runs, self.count], 1.0 / self.count)
+        self.polemeans = polemeans
+        self.poledist = scipy.stats.norm(loc=0.0, scale=np.sqrt(polevar))
+        if isinstance(polemeans,
+                (tiledmap.tiledmap, scipy.spatial.cKDTree)):
+            self.kdtree = polemeans
+        else:
+            self.kdtree = scipy.spatial.cKDTree(polemeans[:, :2], leafsize=3)
+        self.T_w_o = T_w_o
+        self.T_o_w = util.invert_ht(self.T_w_o)
+
+    @property
+    def neff(self):
+        return 1.0 / (np.sum(self.weights**2.0, axis=1) * self.count)
+
+    def update_motion(self, mean, cov):
+        T_r0_r1 = util.xyp2ht(np.random.multivariate_normal(
+            mean, cov, self.runs * self.count))
+        self.particles = np.matmul(self.particles,
+            T_r0_r1.reshape([self.runs, self.count, 4, 4]))
+
+    def update_measurement(self, poleparams, resample=True):
+        n = poleparams.shape[0]
+        polepos_r = np.hstack(
+            [poleparams[:, :2], np.zeros([n, 1]), np.ones([n, 1])]).T
+        polepos_w = np.matmul(self.particles[..., :2, :], polepos_r)
+        d, _ = self.kdtree.query(
+            np.swapaxes(polepos_w, -1, -2).reshape([-1, 2]),
+            k=1, distance_upper_bound=self.d_max)
+        d = d.reshape([self.runs, self.count, n])
+        self.weights *= np.prod(
+            self.poledist.pdf(np.clip(d, 0.0, self.d_max)) + 0.1, axis=2)
+        self.weights /= np.sum(self.weights, axis=1, keepdims=True)
+
+        if resample:
+            iruns = np.where(self.neff < self.minneff)[0]
+            if iruns.size > 0:
+                self.resample(iruns)
+
+    def estimate_pose(self):
+        if self.estimatetype == 'max':
+            return self.particles[
+                np.arange(self.runs), np.argmax(self.weights, axis=1)]
+        if self.estimatetype == 'mean':
+            particles = self.particles
+            weights = self.weights
+        if self.estimatetype == 'best':
+            k = int(0.1 * self.count)
+            i = np.argsort(self.weights, axis=1)[:, -k:]
+            particles = np.take_along_axis(
+                self.particles, i[..., np.newaxis, np.newaxis], axis=1)
+            weights = np.take_along_axis(self.weights, i, axis=1)
+        xyp = util.ht2xyp(np.matmul(self.T_o_w, particles.reshape(
+            [-1, 4, 4]))).reshape([self.runs, -1, 3])
+        weights = weights / np.sum(weights, axis=1, keepdims=True)
+        mean = np.empty([self.runs, 3])
+        mean[:, :2] = np.sum(xyp[..., :2] * weights[..., np.newaxis], axis=1)
+        mean[:, 2] = np.arctan2(
+            np.sum(np.sin(xyp[..., 2]) * weights, axis=1),
+            np.sum(np.cos(xyp[..., 2]) * weights, axis=1))
+        return np.matmul(self.T_w_o, util.xyp2ht(mean).reshape([-1, 4, 4]))
+
+    def resample(self, iruns=None):
+        """
+            Low-variance resampling of the given runs, equivalent to
+            particlefilter.resample applied to each run separately.
+        """
+        if iruns is None:
+            iruns = np.arange(self.runs)
+        offset = np.arange(iruns.size).reshape([-1, 1])
+        cumsum = np.cumsum(self.weights[iruns], axis=1) + offset
+        pos = np.random.rand(iruns.size, 1) / self.count \
+            + np.arange(self.count) / float(self.count) + offset
+        idx = np.searchsorted(cumsum.ravel(), pos.ravel()).reshape(pos.shape)
+        idx = np.minimum(idx - offset * self.count, self.count - 1)
+        self.particles[iruns] = np.take_along_axis(
+            self.particles[iruns], idx[..., np.newaxis, np.newaxis], axis=1)
+        self.weights[iruns] = 1.0 / self.count
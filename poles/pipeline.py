@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+
+import util
+
+
+def get_hash(obj):
+    return hashlib.sha1(
+        json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+# Returns a hash of the sizes and modification times of the given files and
+# of all files below the given directories.
+def get_stamp(paths):
+    stamps = []
+    for path in sorted(paths):
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, file) \
+                for root, _, files in os.walk(path) for file in files)
+        else:
+            files = [path]
+        for file in files:
+            if not os.path.exists(file):
+                return None
+            stat = os.stat(file)
+            stamps.append([file, stat.st_size, stat.st_mtime_ns])
+    return get_hash(stamps)
+
+
+class pipeline:
+    """
+        Runs stages of units, typically sessions, and records for every unit
+        the key of its inputs and a stamp of its outputs in a manifest. The
+        key covers the stage parameters, the unit and the output stamps of
+        the upstream stages, so a unit is recomputed only if one of these
+        changed or its outputs were modified. The manifest is rewritten
+        after every unit, and a unit that was interrupted is resumed if its
+        key is unchanged.
+    """
+    def __init__(self, manifestfile):
+        self.manifestfile = manifestfile
+        try:
+            with open(self.manifestfile) as file:
+                self.manifest = json.load(file)
+        except (IOError, ValueError):
+            self.manifest = {}
+
+    def save(self):
+        util.makedirs(os.path.dirname(self.manifestfile) or '.')
+        tmpfile = self.manifestfile + '.tmp'
+        with open(tmpfile, 'w') as file:
+            json.dump(self.manifest, file, indent=1, sort_keys=True)
+        os.replace(tmpfile, self.manifestfile)
+
+    # Upstream units with the same name as the given unit are matched one to
+    # one, otherwise the unit depends on all units of the upstream stage.
+    def get_upstream(self, deps, unit):
+        upstream = {}
+        for dep in deps:
+            entries = self.manifest.get(dep, {})
+            if str(unit) in entries:
+                entries = {str(unit): entries[str(unit)]}
+            upstream[dep] = {u: e.get('stamp') for u, e in entries.items()}
+        return upstream
+
+    def is_current(self, entry, key):
+        return entry is not None and entry['key'] == key \
+            and entry['complete'] \
+            and get_stamp(entry['outputs']) == entry['stamp']
+
+    # Calls func(unit, resume) for every unit that is out of date. func
+    # returns the paths of the files and directories it produced. Returns
+    # the units that were computed.
+    def run(self, name, func, params, units=[None], deps=[]):
+        entries = self.manifest.setdefault(name, {})
+        computed = []
+        for unit in units:
+            key = get_hash({'params': params, 'unit': unit,
+                'upstream': self.get_upstream(deps, unit)})
+            entry = entries.get(str(unit))
+            if self.is_current(entry, key):
+                print('{} {}: up to date'.format(name, unit))
+                continue
+            resume = entry is not None and entry['key'] == key \
+                and not entry['complete']
+            print('{} {}: {}'.format(
+                name, unit, 'resuming' if resume else 'running'))
+            entries[str(unit)] = {'key': key, 'complete': False,
+                'outputs': [], 'stamp': None}
+            self.save()
+            outputs = list(func(unit, resume))
+            entries[str(unit)] = {'key': key, 'complete': True,
+                'outputs': outputs, 'stamp': get_stamp(outputs)}
+            self.save()
+            computed.append(unit)
+        return computed
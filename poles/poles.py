@@ -6,6 +6,8 @@ import skimage.feature
 import skimage.measure
 import torch
 
+import instrumentation
+
 
 device = torch.device('cuda')
 polesides = range(1, 5+1)
@@ -16,10 +18,26 @@ dstop = 1.0e-3
 normstd = 0.2
 
 
+# Returns the detection parameters as plain values, so that they can be
+# handed to worker processes or stored next to results.
+def get_params():
+    return {'minscore': minscore, 'minheight': minheight,
+        'freelength': freelength, 'polesides': list(polesides)}
+
+
+def set_params(params):
+    global minscore, minheight, freelength, polesides
+    minscore = float(params['minscore'])
+    minheight = float(params['minheight'])
+    freelength = float(params['freelength'])
+    polesides = [int(a) for a in params['polesides']]
+
+
 def detect_poles(occupancymap, mapsize):
     f = int(np.round(freelength / mapsize[0]))
     polemapshape = occupancymap.shape - np.array([2*f, 2*f, 0])
     
+    span = instrumentation.start('pole_scoring')
     ogm = torch.tensor(
         occupancymap, device=device).permute([2, 0, 1]).unsqueeze(1)
     accuscores = torch.zeros(
@@ -64,7 +82,9 @@ def detect_poles(occupancymap, mapsize):
     accuscore = accuscore.cpu().numpy()
     hmax = hmax.cpu().numpy()
     zmax = zmax.cpu().numpy()
+    instrumentation.stop(span)
 
+    span = instrumentation.start('poleness')
     ix, iy = np.where(hmax >= minheight / mapsize[2])
     poleness = np.zeros(polemapshape[:2])
     if ix.size > 0:
@@ -72,17 +92,20 @@ def detect_poles(occupancymap, mapsize):
             h = hmax[iix, iiy]
             z = zmax[iix, iiy]
             poleness[iix, iiy] = np.mean(accuscore[z:z+h, iix, iiy])
+    instrumentation.stop(span)
 
+    span = instrumentation.start('pole_refinement')
     peaks = skimage.feature.peak_local_max(
         poleness, min_distance=f, exclude_border=False, indices=False)
     label = skimage.measure.label(peaks, neighbors=8, background=False)
     regions = skimage.measure.regionprops(label, coordinates='rc')
     centroids = np.array([r.centroid for r in regions]) + 0.5
+    instrumentation.count('pole_candidates', centroids.shape[0])
 
     normdist = scipy.stats.norm(0.0, normstd / mapsize[0])
     cellcoords = np.meshgrid(
         range(polemapshape[0]), range(polemapshape[1]), indexing='ij')
-    cellcoords = np.stack(cellcoords, axis=2).astype(np.float) + 0.5
+    cellcoords = np.stack(cellcoords, axis=2).astype(float) + 0.5
     
     poleparams = np.empty([centroids.shape[0], 6])
     optcentroids = centroids.copy()
@@ -97,10 +120,10 @@ def detect_poles(occupancymap, mapsize):
             optcentroids[ic] = np.average(
                 cellcoords, weights=weights, axis=(0, 1))
 
-        ix, iy = np.floor(optcentroids[ic]).astype(np.int)
+        ix, iy = np.floor(optcentroids[ic]).astype(int)
         if hmax[ix, iy] < minheight / mapsize[2]:
             optcentroids[ic] = centroids[ic]
-            ix, iy = np.floor(centroids[ic]).astype(np.int)
+            ix, iy = np.floor(centroids[ic]).astype(int)
         
         h = hmax[ix, iy]
         z = zmax[ix, iy]
@@ -129,6 +152,8 @@ def detect_poles(occupancymap, mapsize):
         poleparams = np.delete(
             poleparams, np.where(d < freelength)[0] + ip + 1, axis=0)
         ip += 1
+    instrumentation.count('poles', poleparams.shape[0])
+    instrumentation.stop(span)
 
     return poleparams
     
\ No newline at end of file
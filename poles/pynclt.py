@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 
+import json
+import multiprocessing
 import os
+import shutil
+import tempfile
+import threading
 import warnings
 
 import open3d as o3
 import matplotlib.pyplot as plt
 import numpy as np
 import progressbar
-import pyquaternion as pq
 import transforms3d as t3
 
+import instrumentation
+import parallel
+import snapshot
 import util
 
 
@@ -19,10 +26,18 @@ T_o_w = util.invert_ht(T_w_o)
 eulerdef = 'sxyz'
 
 csvdelimiter = ','
+csvchunksize = 2**24
 datadir = '/mnt/data/datasets/nclt'
 resultdir = 'nclt'
-snapshotfile = 'snapshot.npz'
-sessionfile = 'sessiondata.npz'
+snapshotdir = 'snapshot'
+velostorefile = 'velodyne_sync.bin'
+velostoreindexfile = 'velodyne_sync_index.npz'
+sessioncachedir = 'sessiondata'
+sessioncacheversion = 2
+sessionfields = ['velofiles', 't_velo', 't_rawvelo', 'i_rawvelo',
+    't_gt', 'T_w_r_gt', 'T_w_r_gt_velo', 't_cov_gt', 'cov_gt',
+    't_odo', 'T_w_r_odo', 'T_w_r_odo_velo', 't_relodo', 'relodo', 'relodocov',
+    't_gps', 'gps']
 sessions = [
     '2012-01-08',
     '2012-01-15',
@@ -74,34 +89,126 @@ velodatatype = np.dtype({
     'i': ('u1', 6),
     'l': ('u1', 7)})
 velodatasize = 8
+velomagic = 0xad9cad9cad9cad9c
+velorawchunksize = 2**24
 
+# Indices of the upper triangle entries of a 6x6 covariance matrix within a
+# row of the NCLT covariance files, which start with a timestamp.
+covindices = np.array([
+    1,  2,  3,  4,  5,  6,
+    2,  7,  8,  9, 10, 11,
+    3,  8, 12, 13, 14, 15,
+    4,  9, 13, 16, 17, 18,
+    5, 10, 14, 17, 19, 20,
+    6, 11, 15, 18, 20, 21])
 
-def load_snapshot(sessionname):
+
+def load_snapshot(sessionname, lod=1.0):
     cloud = o3.PointCloud()
     trajectory = o3.LineSet()
-    with np.load(os.path.join(resultdir, sessionname, snapshotfile)) as data:
-        cloud.points = o3.Vector3dVector(data['points'])
-        cloud.colors = o3.Vector3dVector(
-            util.intensity2color(data['intensities'] / 255.0))
-        
-        trajectory.points = o3.Vector3dVector(data['trajectory'])
-        lines = np.reshape(range(data['trajectory'].shape[0] - 1), [-1, 1]) \
-                + [0, 1]
-        trajectory.lines = o3.Vector2iVector(lines)
-        trajectory.colors = o3.Vector3dVector(
-            np.tile([0.0, 0.5, 0.0], [lines.shape[0], 1]))
+    points, intensities, arrays = snapshot.load(
+        os.path.join(resultdir, sessionname, snapshotdir), lod=lod)
+    cloud.points = o3.Vector3dVector(points)
+    cloud.colors = o3.Vector3dVector(
+        util.intensity2color(intensities / 255.0))
+
+    trajectory.points = o3.Vector3dVector(arrays['trajectory'])
+    lines = np.reshape(range(arrays['trajectory'].shape[0] - 1), [-1, 1]) \
+            + [0, 1]
+    trajectory.lines = o3.Vector2iVector(lines)
+    trajectory.colors = o3.Vector3dVector(
+        np.tile([0.0, 0.5, 0.0], [lines.shape[0], 1]))
     return cloud, trajectory
 
 
-def view_snapshot(sessionname):
-    cloud, trajectory = load_snapshot(sessionname)
+def view_snapshot(sessionname, lod=1.0):
+    cloud, trajectory = load_snapshot(sessionname, lod=lod)
     o3.draw_geometries([cloud, trajectory])
 
 
+# Converts poses x, y, z, roll, pitch, yaw of shape [..., 6] into
+# homogeneous transforms.
 def pose2ht(pose):
-    r, p, y = pose[3:]
-    return t3.affines.compose(
-        pose[:3], t3.euler.euler2mat(r, p, y, eulerdef), np.ones(3))
+    pose = np.asarray(pose)
+    ht = np.empty(pose.shape[:-1] + (4, 4))
+    ht[..., 3, :] = [0.0, 0.0, 0.0, 1.0]
+    ht[..., :3, 3] = pose[..., :3]
+    if eulerdef != 'sxyz':
+        ht[..., :3, :3] = np.reshape([t3.euler.euler2mat(r, p, y, eulerdef)
+            for r, p, y in pose[..., 3:].reshape([-1, 3])], ht[..., :3, :3].shape)
+        return ht
+
+    cr, cp, cy = np.moveaxis(np.cos(pose[..., 3:]), -1, 0)
+    sr, sp, sy = np.moveaxis(np.sin(pose[..., 3:]), -1, 0)
+    ht[..., 0, 0] = cy * cp
+    ht[..., 0, 1] = cy * sp * sr - sy * cr
+    ht[..., 0, 2] = cy * sp * cr + sy * sr
+    ht[..., 1, 0] = sy * cp
+    ht[..., 1, 1] = sy * sp * sr + cy * cr
+    ht[..., 1, 2] = sy * sp * cr - cy * sr
+    ht[..., 2, 0] = -sp
+    ht[..., 2, 1] = cp * sr
+    ht[..., 2, 2] = cp * cr
+    return ht
+
+
+def unpack_cov(cov):
+    return cov[:, covindices].reshape([-1, 6, 6])
+
+
+# Splits a CSV file into byte ranges of roughly csvchunksize bytes that end
+# at line boundaries.
+def get_csv_chunks(filename):
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as file:
+        while bounds[-1] < size:
+            file.seek(bounds[-1] + csvchunksize)
+            file.readline()
+            bounds.append(min(file.tell(), size))
+    return [(filename, start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+# Returns the rows of the given chunk. A chunk without any rows has no
+# columns either, so it is returned as an array [0, 0].
+def parse_csv_chunk(chunk):
+    filename, start, end = chunk
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        text = file.read(end - start).strip()
+    if not text:
+        return np.empty([0, 0])
+    lines = text.split(b'\n')
+    ncols = lines[0].count(b',') + 1
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            data = np.fromstring(
+                text.replace(b'\n', b',').decode(), dtype=np.float64, sep=',')
+    except ValueError:
+        data = np.empty(0)
+    if data.size != len(lines) * ncols:
+        # Empty or malformed fields, which genfromtxt turns into nan.
+        data = np.genfromtxt(lines, delimiter=csvdelimiter)
+    return data.reshape([len(lines), ncols])
+
+
+# Parses several numeric CSV files in parallel and returns one array per file.
+# Inside a pool worker, the chunks are parsed in the worker itself instead of
+# starting another pool.
+def load_csvs(filenames, processes=None):
+    chunks = [get_csv_chunks(filename) for filename in filenames]
+    if multiprocessing.parent_process() is None:
+        data = parallel.map_ordered(parse_csv_chunk, sum(chunks, []),
+            processes=processes)
+    else:
+        data = [parse_csv_chunk(chunk) for chunk in sum(chunks, [])]
+    arrays = []
+    for filechunks in chunks:
+        filedata = [d for d in data[:len(filechunks)] if d.size > 0]
+        arrays.append(np.vstack(filedata) if filedata else np.empty([0, 0]))
+        data = data[len(filechunks):]
+    return arrays
 
 
 def latlon2xy(latlon):
@@ -111,14 +218,163 @@ def latlon2xy(latlon):
         np.sin(lon - lon0) * rew * np.cos(lat0)])
 
 
-def data2xyzi(data):
+def data2xyzi(data, dtype=np.float64):
     xyzil = data.view(velodatatype)
-    xyz = np.hstack(
-        [xyzil[axis].reshape([-1, 1]) for axis in ['x', 'y', 'z']])
-    xyz = xyz * 0.005 - 100.0
+    xyz = np.ndarray(xyzil.shape + (3,), dtype='<u2', buffer=xyzil,
+        offset=0, strides=xyzil.strides + (2,)).astype(dtype)
+    xyz *= dtype(0.005)
+    xyz -= dtype(100.0)
     return xyz, xyzil['i']
 
 
+# Finds the packet headers of a velodyne_hits.bin file. Headers and records
+# are 8-byte multiples, so all headers start at 8-byte aligned offsets and
+# can be located by a chunked search for the magic number. As in a
+# sequential scan, the index ends at the first packet whose successor does
+# not start right after its records.
+def index_raw_packets(filename):
+    size = os.path.getsize(filename) // 8
+    if size == 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    words = np.memmap(filename, dtype='<u8', mode='r', shape=(size,))
+    offsets = [8 * (np.where(words[i:i+velorawchunksize] == velomagic)[0] + i)
+        for i in range(0, size, velorawchunksize)]
+    offsets = np.hstack(offsets).astype(np.int64)
+    offsets = offsets[offsets + veloheadersize <= 8 * size]
+    # The count and the timestamp straddle the second and third header word.
+    lower = np.asarray(words[offsets // 8 + 1])
+    upper = np.asarray(words[offsets // 8 + 2])
+    counts = (lower & np.uint64(0xffffffff)).astype(np.int64)
+    utimes = (lower >> np.uint64(32)) \
+        | ((upper & np.uint64(0xffffffff)) << np.uint64(32))
+    ends = offsets + veloheadersize + counts * velodatasize
+    if offsets.size == 0 or offsets[0] != 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    broken = np.where(offsets[1:] != ends[:-1])[0]
+    n = broken[0] + 1 if broken.size > 0 else offsets.size
+    return utimes[:n], offsets[:n]
+
+
+class rawscans:
+    """
+        Memory-mapped access to the packets of a velodyne_hits.bin file.
+    """
+    def __init__(self, filename, offsets):
+        self.raw = np.memmap(filename, dtype=np.uint8, mode='r')
+        self.offsets = offsets
+
+    def get_header(self, i):
+        offset = self.offsets[i]
+        return self.raw[offset:offset+veloheadersize].view(veloheadertype)[0]
+
+    def get_records(self, i):
+        start = self.offsets[i] + veloheadersize
+        count = int(self.get_header(i)['count'])
+        return self.raw[start:start+count*velodatasize].view(velodatatype)
+
+    def get(self, i):
+        return data2xyzi(self.get_records(i), np.float32)
+
+    # Yields the start time, points, intensities and laser indices of every
+    # full sensor revolution, detected from the accumulated point azimuth,
+    # holding only the packets of the current revolution in memory.
+    def revolutions(self, t_packets, istart=0, iend=None):
+        if iend is None:
+            iend = self.offsets.size
+        parts = []
+        t_start = None
+        angle = 0.0
+        lastazimuth = None
+        for i in range(istart, iend):
+            records = self.get_records(i)
+            if records.size == 0:
+                continue
+            xyz, intensities = data2xyzi(records, np.float32)
+            azimuth = np.arctan2(xyz[:, 1], xyz[:, 0])
+            if lastazimuth is None:
+                lastazimuth = azimuth[0]
+                t_start = t_packets[i]
+            step = np.diff(np.hstack([lastazimuth, azimuth]))
+            step = np.mod(step + np.pi, 2.0 * np.pi) - np.pi
+            angle = angle + np.cumsum(step)
+            lastazimuth = azimuth[-1]
+            isplit = np.where(np.abs(angle) >= 2.0 * np.pi)[0]
+            if isplit.size == 0:
+                parts.append((xyz, intensities, records['l']))
+                angle = angle[-1]
+                continue
+            isplit = isplit[0]
+            parts.append((xyz[:isplit], intensities[:isplit],
+                records['l'][:isplit]))
+            yield t_start, np.vstack([p[0] for p in parts]), \
+                np.hstack([p[1] for p in parts]), \
+                np.hstack([p[2] for p in parts])
+            parts = [(xyz[isplit:], intensities[isplit:],
+                records['l'][isplit:])]
+            angle = angle[-1] - angle[isplit]
+            t_start = t_packets[i]
+        if parts and sum(p[0].shape[0] for p in parts) > 0:
+            yield t_start, np.vstack([p[0] for p in parts]), \
+                np.hstack([p[1] for p in parts]), \
+                np.hstack([p[2] for p in parts])
+
+
+# Concatenates the raw records of the given scan files into one file and
+# saves the record offset and timestamp of every scan next to it.
+def pack_scans(velofiles, t_velo, filename, indexfile):
+    counts = [os.path.getsize(velofile) // velodatasize \
+        for velofile in velofiles]
+    offsets = np.hstack([0, np.cumsum(counts)]).astype(np.int64)
+    file, tmpfile = util.open_tempfile(filename)
+    with file:
+        for velofile in velofiles:
+            with open(velofile, 'rb') as scanfile:
+                shutil.copyfileobj(scanfile, file)
+    file, tmpindexfile = util.open_tempfile(indexfile)
+    with file:
+        np.savez(file, offsets=offsets, t_velo=np.asarray(t_velo))
+    os.replace(tmpfile, filename)
+    os.replace(tmpindexfile, indexfile)
+
+
+class scanstore:
+    """
+        Memory-mapped view of a file written by pack_scans.
+    """
+    def __init__(self, filename, indexfile):
+        with np.load(indexfile) as data:
+            self.offsets = data['offsets']
+            self.t_velo = data['t_velo']
+        if os.path.getsize(filename) != self.offsets[-1] * velodatasize:
+            raise ValueError('{} does not match its index'.format(filename))
+        if self.offsets[-1] > 0:
+            self.records = np.memmap(filename, dtype=velodatatype, mode='r')
+        else:
+            self.records = np.empty(0, dtype=velodatatype)
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def get_records(self, istart, iend):
+        return self.records[self.offsets[istart]:self.offsets[iend]]
+
+    def get(self, i):
+        return data2xyzi(self.get_records(i, i + 1), np.float32)
+
+    # Decodes the scans istart to iend - 1 at once. Scan i occupies rows
+    # offsets[i - istart] to offsets[i - istart + 1] of the result.
+    def get_range(self, istart, iend):
+        xyz, intensities = data2xyzi(
+            self.get_records(istart, iend), np.float32)
+        return xyz, intensities, \
+            self.offsets[istart:iend+1] - self.offsets[istart]
+
+
+def get_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
 def save_trajectories():
     trajectorydir = os.path.join(resultdir, 'trajectories_gt')
     util.makedirs(trajectorydir)
@@ -132,187 +388,205 @@ def save_trajectories():
         plt.savefig(os.path.join(trajectorydir, sessions[i] + '.svg'))
 
 
+scanstorelock = threading.Lock()
+
+
 class session:
+    """
+        Poses, timestamps and file lists of one NCLT session. They are parsed
+        from the dataset once and then cached as one .npy file per field,
+        which is memory-mapped when the field is first accessed.
+    """
     def __init__(self, session):
         self.session = session
         self.dir = os.path.join(resultdir, self.session)
+        self.cachedir = os.path.join(self.dir, sessioncachedir)
+        velodir = os.path.join(datadir, 'velodyne_data', self.session + '_vel')
+        self.velodir = os.path.join(velodir, 'velodyne_sync')
+        self.velorawfile = os.path.join(velodir, 'velodyne_hits.bin')
+        sensordir = os.path.join(datadir, 'sensor_data', self.session + '_sen')
+        self.csvfiles = [
+            os.path.join(datadir, 'ground_truth',
+                'groundtruth_' + self.session + '.csv'),
+            os.path.join(datadir, 'ground_truth_cov',
+                'cov_' + self.session + '.csv'),
+            os.path.join(sensordir, 'odometry_mu_100hz.csv'),
+            os.path.join(sensordir, 'odometry_mu.csv'),
+            os.path.join(sensordir, 'odometry_cov.csv'),
+            os.path.join(sensordir, 'gps.csv')]
 
         try:
-            data = np.load(os.path.join(self.dir, sessionfile))
-            self.velofiles = data['velofiles']
-            self.t_velo = data['t_velo']
-            self.velorawfile = data['velorawfile']
-            self.t_rawvelo = data['t_rawvelo']
-            self.i_rawvelo = data['i_rawvelo']
-            self.t_gt = data['t_gt']
-            self.T_w_r_gt = data['T_w_r_gt']
-            self.T_w_r_gt_velo = data['T_w_r_gt_velo']
-            self.t_cov_gt = data['t_cov_gt']
-            self.cov_gt = data['cov_gt']
-            self.t_odo = data['t_odo']
-            self.T_w_r_odo = data['T_w_r_odo']
-            self.T_w_r_odo_velo = data['T_w_r_odo_velo']
-            self.t_relodo = data['t_relodo']
-            self.relodo = data['relodo']
-            self.relodocov = data['relodocov']
-            self.t_gps = data['t_gps']
-            self.gps = data['gps']
-        except:
-            velodir = os.path.join(datadir, 'velodyne_data', 
-                self.session + '_vel', 'velodyne_sync')
-            self.velofiles = [os.path.join(velodir, file) \
-                for file in os.listdir(velodir) \
-                if os.path.splitext(file)[1] == '.bin']
-            self.velofiles.sort()
-            self.t_velo = np.array([
-                int(os.path.splitext(os.path.basename(velofile))[0]) \
-                    for velofile in self.velofiles])
-
-            self.velorawfile = os.path.join(datadir, 'velodyne_data', 
-                self.session + '_vel', 'velodyne_hits.bin')
-            self.t_rawvelo = []
-            self.i_rawvelo = []
-            with open(self.velorawfile, 'rb') as file:
-                data = np.array(file.read(veloheadersize))
-                while data:
-                    header = data.view(veloheadertype)
-                    if header['magic'] != 0xad9cad9cad9cad9c:
-                        break
-                    self.t_rawvelo.append(header['utime'])
-                    self.i_rawvelo.append(file.tell() - veloheadersize)
-                    file.seek(header['count'] * velodatasize, os.SEEK_CUR)
-                    data = np.array(file.read(veloheadersize))
-            self.t_rawvelo = np.array(self.t_rawvelo)
-            self.i_rawvelo = np.array(self.i_rawvelo)
-
-            posefile = os.path.join(
-                datadir, 'ground_truth', 'groundtruth_' + self.session + '.csv')
-            posedata = np.genfromtxt(posefile, delimiter=csvdelimiter)
-            posedata = posedata[np.logical_not(np.any(np.isnan(posedata), 1))]
-            self.t_gt = posedata[:, 0]
-            self.T_w_r_gt = np.stack([T_w_o.dot(pose2ht(pose_o_r)) \
-                for pose_o_r in posedata[:, 1:]])
-            self.T_w_r_gt_velo = np.stack(
-                [self.get_T_w_r_gt(t) for t in self.t_velo])
-
-            cov_gtfile = os.path.join(
-                datadir, 'ground_truth_cov', 'cov_' + self.session + '.csv')
-            cov_gt = np.genfromtxt(cov_gtfile, delimiter=csvdelimiter)
-            self.t_cov_gt = cov_gt[:, 0]
-            self.cov_gt = np.stack(
-                [np.reshape(roc[[
-                1,  2,  3,  4,  5,  6,
-                2,  7,  8,  9, 10, 11,
-                3,  8, 12, 13, 14, 15,
-                4,  9, 13, 16, 17, 18,
-                5, 10, 14, 17, 19, 20,
-                6, 11, 15, 18, 20, 21
-                ]], [6, 6]) for roc in cov_gt])
-
-            sensordir = os.path.join(
-                datadir, 'sensor_data', self.session + '_sen')
-            odofile = os.path.join(sensordir, 'odometry_mu_100hz.csv')
-            ododata = np.genfromtxt(odofile, delimiter=csvdelimiter)
-            self.t_odo = ododata[:, 0]
-            self.T_w_r_odo = np.stack([T_w_o.dot(pose2ht(pose_o_r)) \
-                for pose_o_r in ododata[:, 1:]])
-            self.T_w_r_odo_velo = np.stack(
-                [self.get_T_w_r_odo(t) for t in self.t_velo])
-
-            relodofile = os.path.join(sensordir, 'odometry_mu.csv')
-            relodo = np.genfromtxt(relodofile, delimiter=csvdelimiter)
-            self.t_relodo = relodo[:, 0]
-            self.relodo = relodo[:, [1, 2, 6]]
-            
-            relodocovfile = os.path.join(sensordir, 'odometry_cov.csv')
-            relodocov = np.genfromtxt(relodocovfile, delimiter=csvdelimiter)
-            self.relodocov = np.stack(
-                [np.reshape(roc[[
-                1,  2,  3,  4,  5,  6,
-                2,  7,  8,  9, 10, 11,
-                3,  8, 12, 13, 14, 15,
-                4,  9, 13, 16, 17, 18,
-                5, 10, 14, 17, 19, 20,
-                6, 11, 15, 18, 20, 21
-                ]], [6, 6]) for roc in relodocov])
-
-            gpsfile = os.path.join(sensordir, 'gps.csv')
-            gps = np.genfromtxt(gpsfile, delimiter=csvdelimiter)[:, [0, 3, 4]]
-            self.t_gps = gps[:, 0]
-            self.gps = latlon2xy(gps[:, 1:])
-            
-            util.makedirs(self.dir)
-            np.savez(os.path.join(self.dir, sessionfile), 
-                velofiles=self.velofiles, 
-                t_velo=self.t_velo, 
-                velorawfile=self.velorawfile,
-                t_rawvelo=self.t_rawvelo,
-                i_rawvelo=self.i_rawvelo,
-                t_gt=self.t_gt, 
-                T_w_r_gt=self.T_w_r_gt,
-                T_w_r_gt_velo=self.T_w_r_gt_velo,
-                t_cov_gt=self.t_cov_gt,
-                cov_gt=self.cov_gt,
-                t_odo=self.t_odo,
-                T_w_r_odo=self.T_w_r_odo,
-                T_w_r_odo_velo=self.T_w_r_odo_velo,
-                t_relodo=self.t_relodo,
-                relodo=self.relodo,
-                relodocov=self.relodocov,
-                t_gps=self.t_gps,
-                gps=self.gps)
+            self.open_cache()
+        except (IOError, OSError, ValueError, KeyError) as e:
+            if os.path.exists(self.cachedir):
+                warnings.warn('Rebuilding cache of session {}: {}'.format(
+                    self.session, e))
+            self.parse()
+            self.save_cache()
+
+    def __getattr__(self, name):
+        if name in sessionfields and 'fieldsizes' in self.__dict__:
+            try:
+                value = np.load(os.path.join(self.cachepath, name + '.npy'),
+                    mmap_mode='r')
+            except (IOError, OSError):
+                # Another process has replaced the cache since it was opened.
+                self.open_cache()
+                value = np.load(os.path.join(self.cachepath, name + '.npy'),
+                    mmap_mode='r')
+            setattr(self, name, value)
+            return value
+        raise AttributeError(name)
+
+    def get_sourcefiles(self):
+        return self.csvfiles + [self.velodir, self.velorawfile]
+
+    # Checks that the cache has the current version, is complete, and was
+    # built from the present dataset files. Dataset files that are not
+    # available are not checked, so that the cache can be used without them.
+    def open_cache(self):
+        cachepath = os.path.realpath(self.cachedir)
+        with open(os.path.join(cachepath, 'manifest.json')) as file:
+            manifest = json.load(file)
+        if manifest['version'] != sessioncacheversion:
+            raise ValueError('cache version {} is outdated'.format(
+                manifest['version']))
+        for path, stamp in manifest['sources'].items():
+            if os.path.exists(path) and get_stamp(path) != stamp:
+                raise ValueError('{} has changed'.format(path))
+        for name in sessionfields:
+            filename = os.path.join(cachepath, name + '.npy')
+            if os.path.getsize(filename) != manifest['fields'][name]:
+                raise ValueError('{} is corrupt'.format(filename))
+        self.cachepath = cachepath
+        self.fieldsizes = manifest['fields']
+
+    def parse(self):
+        self.velofiles = [os.path.join(self.velodir, file) \
+            for file in os.listdir(self.velodir) \
+            if os.path.splitext(file)[1] == '.bin']
+        self.velofiles.sort()
+        self.t_velo = np.array([
+            int(os.path.splitext(os.path.basename(velofile))[0]) \
+                for velofile in self.velofiles])
+
+        self.t_rawvelo, self.i_rawvelo = index_raw_packets(self.velorawfile)
+
+        posedata, cov_gt, ododata, relodo, relodocov, gps = load_csvs(
+            self.csvfiles)
+
+        posedata = posedata[np.logical_not(np.any(np.isnan(posedata), 1))]
+        self.t_gt = posedata[:, 0]
+        self.T_w_r_gt = np.matmul(T_w_o, pose2ht(posedata[:, 1:]))
+        self.T_w_r_gt_velo = self.get_T_w_r_gt(self.t_velo)
+
+        self.t_cov_gt = cov_gt[:, 0]
+        self.cov_gt = unpack_cov(cov_gt)
+
+        self.t_odo = ododata[:, 0]
+        self.T_w_r_odo = np.matmul(T_w_o, pose2ht(ododata[:, 1:]))
+        self.T_w_r_odo_velo = self.get_T_w_r_odo(self.t_velo)
+
+        self.t_relodo = relodo[:, 0]
+        self.relodo = relodo[:, [1, 2, 6]]
+        self.relodocov = unpack_cov(relodocov)
+
+        gps = gps[:, [0, 3, 4]]
+        self.t_gps = gps[:, 0]
+        self.gps = latlon2xy(gps[:, 1:])
+
+    # Writes the cache to a directory of its own and then atomically points
+    # the cache symlink to it, so that other processes see either the old or
+    # the new cache, and concurrent writers cannot fail each other.
+    def save_cache(self):
+        util.makedirs(self.dir)
+        tmpdir = tempfile.mkdtemp(
+            prefix=os.path.basename(self.cachedir) + '.', dir=self.dir)
+        fieldsizes = {}
+        for name in sessionfields:
+            filename = os.path.join(tmpdir, name + '.npy')
+            np.save(filename, np.asarray(getattr(self, name)))
+            fieldsizes[name] = os.path.getsize(filename)
+        manifest = {'version': sessioncacheversion, 'fields': fieldsizes,
+            'sources': {path: get_stamp(path) \
+                for path in self.get_sourcefiles() if os.path.exists(path)}}
+        with open(os.path.join(tmpdir, 'manifest.json'), 'w') as file:
+            json.dump(manifest, file)
+        link = tmpdir + '.link'
+        os.symlink(os.path.basename(tmpdir), link)
+        previous = None
+        if os.path.islink(self.cachedir):
+            previous = os.path.realpath(self.cachedir)
+        elif os.path.isdir(self.cachedir):
+            # Caches written before the symlink was introduced.
+            shutil.rmtree(self.cachedir, ignore_errors=True)
+        os.replace(link, self.cachedir)
+        if previous is not None and previous != tmpdir:
+            shutil.rmtree(previous, ignore_errors=True)
+        self.cachepath = tmpdir
+        self.fieldsizes = fieldsizes
+
+    # The scans are packed on first use, only once per process, even if the
+    # prefetch threads of a scanprovider ask for them at the same time.
+    # Processes that pack at the same time write their own temporary files.
+    @property
+    def scans(self):
+        if 'scanstore' not in self.__dict__:
+            with scanstorelock:
+                if 'scanstore' not in self.__dict__:
+                    self.scanstore = self.open_scanstore()
+        return self.scanstore
+
+    def open_scanstore(self):
+        filename = os.path.join(self.dir, velostorefile)
+        indexfile = os.path.join(self.dir, velostoreindexfile)
+        try:
+            store = scanstore(filename, indexfile)
+            if not np.array_equal(store.t_velo, self.t_velo):
+                raise ValueError('{} is outdated'.format(indexfile))
+        except (IOError, OSError, ValueError, KeyError):
+            pack_scans(self.velofiles, self.t_velo, filename, indexfile)
+            store = scanstore(filename, indexfile)
+        return store
 
     def get_velo(self, i):
-        return data2xyzi(np.fromfile(self.velofiles[i]))
+        with instrumentation.span('load_scan'):
+            return self.scans.get(i)
+
+    def get_velo_range(self, istart, iend):
+        return self.scans.get_range(istart, iend)
+
+    @property
+    def rawscans(self):
+        if 'rawscanfile' not in self.__dict__:
+            self.rawscanfile = rawscans(self.velorawfile, self.i_rawvelo)
+        return self.rawscanfile
 
     def get_velo_raw(self, i):
-        with open(self.velorawfile, 'rb') as file:
-            data = np.array(file.read(veloheadersize))
-            header = data.view(veloheadertype)
-            data = np.fromfile(file, count=header['count']).view(velodatatype)
-            xyz = np.empty([data.shape[0], 3])
-            intensities = np.empty([data.shape[0], 1])
-            for i in range(data.shape[0]):
-                xyz[i], intensities[i] = data2xyzi(data[i])
-        return xyz, intensities
-
-    def get_T_w_r_gt(self, t):
-        i = np.clip(np.searchsorted(self.t_gt, t), 1, self.t_gt.size - 1) \
-            + np.array([-1, 0])
-        return util.interpolate_ht(self.T_w_r_gt[i], self.t_gt[i], t)
-
-    def get_T_w_r_odo(self, t):
-        i = np.clip(np.searchsorted(self.t_odo, t), 1, self.t_odo.size - 1) \
-            + np.array([-1, 0])
-        return util.interpolate_ht(self.T_w_r_odo[i], self.t_odo[i], t)
+        return self.rawscans.get(i)
+
+    def get_velo_revolutions(self, istart=0, iend=None):
+        return self.rawscans.revolutions(self.t_rawvelo, istart, iend)
+
+    def get_T_w_r_gt(self, t, out=None):
+        return util.interpolate_ht(self.T_w_r_gt, self.t_gt, t, out=out)
+
+    def get_T_w_r_odo(self, t, out=None):
+        return util.interpolate_ht(self.T_w_r_odo, self.t_odo, t, out=out)
         
-    def save_snapshot(self):
+    def save_snapshot(self, voxelsize=snapshot.voxelsize):
         print(self.session)
-        naccupoints = int(3e7)
         nscans = len(self.velofiles)
-        nmaxpoints = naccupoints / nscans
-        accupoints = np.full([naccupoints, 3], np.nan)
-        accuintensities = np.empty([naccupoints, 1])
-
-        ipstart = 0
+        builder = snapshot.snapshotbuilder(
+            os.path.join(self.dir, snapshotdir), voxelsize=voxelsize)
         with progressbar.ProgressBar(max_value=nscans) as bar:
             for i in range(nscans):
                 points, intensities = self.get_velo(i)
-                npoints = min(points.shape[0], nmaxpoints)
-                ip = np.random.choice(points.shape[0], npoints, replace=False)
-                points = np.hstack([points[ip], np.ones([npoints, 1])]).T
-                points = self.T_w_r_gt_velo[i].dot(points)[:3].T
-                accupoints[ipstart:ipstart+npoints] = points
-                intensities = intensities[ip].reshape([-1, 1])
-                accuintensities[ipstart:ipstart+npoints] = intensities
-                ipstart += npoints
+                T = self.T_w_r_gt_velo[i]
+                points = np.matmul(points, T[:3, :3].T) + T[:3, 3]
+                builder.add(points, intensities)
                 bar.update(i)
-        trajectory = self.T_w_r_gt[:, :3, 3]
-
-        util.makedirs(self.dir)
-        np.savez(os.path.join(self.dir, snapshotfile),
-            points=accupoints, intensities=accuintensities, 
-            trajectory=trajectory)
+        builder.close(trajectory=self.T_w_r_gt[:, :3, 3])
 
 
 if __name__ == '__main__':
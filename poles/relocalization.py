@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import numpy as np
+import scipy.spatial
+
+import util
+
+
+maxpairdistance = 30.0
+distancetolerance = 0.2
+maxlocalpoles = 20
+positionresolution = 1.0
+angleresolution = np.radians(5.0)
+nverify = 20
+inlierdistance = 0.5
+mininliers = 4
+
+
+class poleindex:
+    """
+        Geometric hashing index over all pairs of global map poles that are
+        at most maxpairdistance apart. The pairs are sorted by length, so that
+        all pairs matching a local pair are found with two binary searches.
+    """
+    # Pairs that come with their distances are taken to be sorted already.
+    def __init__(self, polemeans, pairs=None, distances=None):
+        self.polemeans = polemeans[:, :2]
+        self.kdtree = scipy.spatial.cKDTree(self.polemeans, leafsize=10)
+        if distances is not None:
+            self.pairs = pairs
+            self.distances = distances
+            return
+        if pairs is None:
+            pairs = self.kdtree.query_pairs(
+                maxpairdistance, output_type='ndarray')
+            pairs = np.reshape(pairs, [-1, 2])
+        distances = np.linalg.norm(np.diff(
+            self.polemeans[pairs], axis=1), axis=2).ravel()
+        order = np.argsort(distances)
+        self.pairs = pairs[order]
+        self.distances = distances[order]
+
+    def save(self, filename):
+        np.savez(filename, polemeans=self.polemeans, pairs=self.pairs)
+
+    # Returns up to k poses T_w_l that map the given 2-D pole positions,
+    # specified in a local frame l, onto the global map, best first, together
+    # with the number of poles each pose explains.
+    def query(self, poleparams, k=5):
+        if poleparams.shape[1] >= 6:
+            poleparams = poleparams[np.argsort(-poleparams[:, 5])]
+        local = poleparams[:maxlocalpoles, :2]
+        il, jl = np.triu_indices(local.shape[0], 1)
+        dl = np.linalg.norm(local[jl] - local[il], axis=1)
+        keep = dl <= maxpairdistance + distancetolerance
+        il, jl, dl = il[keep], jl[keep], dl[keep]
+        if dl.size == 0:
+            return np.empty([0, 4, 4]), np.empty(0, dtype=np.int64)
+
+        lo = np.searchsorted(self.distances, dl - distancetolerance)
+        hi = np.searchsorted(self.distances, dl + distancetolerance)
+        counts = hi - lo
+        if np.sum(counts) == 0:
+            return np.empty([0, 4, 4]), np.empty(0, dtype=np.int64)
+        ilocal = np.repeat(np.arange(dl.size), counts)
+        iglobal = lo[ilocal] + np.arange(ilocal.size) \
+            - np.repeat(np.cumsum(counts) - counts, counts)
+
+        # Each matching pair yields two hypotheses, one per assignment.
+        la = local[il[ilocal]]
+        lb = local[jl[ilocal]]
+        ga = self.polemeans[self.pairs[iglobal]]
+        la, lb = np.vstack([la, la]), np.vstack([lb, lb])
+        ga, gb = np.vstack([ga[:, 0], ga[:, 1]]), np.vstack([ga[:, 1], ga[:, 0]])
+        vl = lb - la
+        vg = gb - ga
+        phi = np.arctan2(vg[:, 1], vg[:, 0]) - np.arctan2(vl[:, 1], vl[:, 0])
+        c = np.cos(phi)
+        s = np.sin(phi)
+        xy = ga - np.stack(
+            [c * la[:, 0] - s * la[:, 1], s * la[:, 0] + c * la[:, 1]], axis=1)
+
+        # Vote in a discretized pose space and verify the strongest cells.
+        cells = np.hstack([np.floor(xy / positionresolution),
+            np.floor(np.mod(phi, 2.0 * np.pi) / angleresolution)[:, None]])
+        _, icell, votes = np.unique(
+            cells, axis=0, return_inverse=True, return_counts=True)
+        icell = icell.ravel()
+        best = np.argsort(-votes)[:nverify]
+        candidates = np.empty([best.size, 3])
+        for i, ic in enumerate(best):
+            ih = np.where(icell == ic)[0]
+            candidates[i, :2] = np.mean(xy[ih], axis=0)
+            candidates[i, 2] = util.average_angles(phi[ih])
+
+        T_w_l = np.reshape(util.xyp2ht(candidates), [-1, 4, 4])
+        pos_l = np.hstack([poleparams[:, :2],
+            np.zeros([poleparams.shape[0], 1]),
+            np.ones([poleparams.shape[0], 1])]).T
+        scores = np.empty(best.size, dtype=np.int64)
+        for i in range(best.size):
+            d, _ = self.kdtree.query(T_w_l[i].dot(pos_l)[:2].T, k=1,
+                distance_upper_bound=inlierdistance)
+            scores[i] = np.sum(np.isfinite(d))
+
+        # Suppress candidates close to a better one.
+        selected = []
+        for i in np.argsort(-scores, kind='stable'):
+            if len(selected) == k:
+                break
+            duplicate = False
+            for j in selected:
+                dxy = np.linalg.norm(candidates[i, :2] - candidates[j, :2])
+                dphi = np.abs(np.mod(candidates[i, 2] - candidates[j, 2]
+                    + np.pi, 2.0 * np.pi) - np.pi)
+                if dxy < 2.0 * positionresolution \
+                        and dphi < 2.0 * angleresolution:
+                    duplicate = True
+                    break
+            if not duplicate:
+                selected.append(i)
+        return T_w_l[selected], scores[selected]
+
+    # Returns the pose T_w_l that maps the given poles onto the global map,
+    # or None if no pose explains at least mininliers poles or if another
+    # distinct pose explains as many, as happens in repetitive layouts.
+    def locate(self, poleparams):
+        T_w_l, scores = self.query(poleparams)
+        if scores.size == 0 or scores[0] < mininliers:
+            return None
+        if scores.size > 1 and scores[1] >= scores[0]:
+            return None
+        return T_w_l[0]
+
+
+def load_index(filename):
+    with np.load(filename) as data:
+        return poleindex(data['polemeans'], pairs=data['pairs'])
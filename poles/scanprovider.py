@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import collections
+import concurrent.futures
+import threading
+
+import numpy as np
+
+
+cachebytes = 2**30
+prefetchthreads = 4
+prefetchwindows = 2
+
+
+def get_nbytes(scan):
+    return sum(np.asarray(a).nbytes for a in scan)
+
+
+class scanprovider:
+    """
+        Loads the scans of a session through an LRU cache of at most maxbytes
+        decoded bytes. prefetch decodes upcoming scans on background threads,
+        so that loading overlaps with the processing of the current window.
+    """
+    def __init__(self, session, maxbytes=cachebytes, threads=prefetchthreads):
+        self.session = session
+        self.maxbytes = maxbytes
+        self.cache = collections.OrderedDict()
+        self.nbytes = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.hits = 0
+        self.prefetchhits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pending.clear()
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'prefetchhits': self.prefetchhits,
+            'misses': self.misses, 'cachedscans': len(self.cache),
+            'cachedbytes': self.nbytes}
+
+    def prefetch(self, istart, iend):
+        with self.lock:
+            for i in range(istart, iend):
+                if i not in self.cache and i not in self.pending:
+                    self.pending[i] = self.executor.submit(
+                        self.session.get_velo, i)
+
+    def insert(self, i, scan):
+        with self.lock:
+            self.cache[i] = scan
+            self.nbytes += get_nbytes(scan)
+            while self.nbytes > self.maxbytes and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.nbytes -= get_nbytes(evicted)
+
+    def get(self, i):
+        with self.lock:
+            if i in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(i)
+                return self.cache[i]
+            future = self.pending.pop(i, None)
+        if future is not None:
+            scan = future.result()
+            self.prefetchhits += 1
+        else:
+            scan = self.session.get_velo(i)
+            self.misses += 1
+        self.insert(i, scan)
+        return scan
+
+    def get_range(self, istart, iend):
+        return [self.get(i) for i in range(istart, iend)]
+
+    # Returns the scans of window i and prefetches the next windows.
+    def get_window(self, istart, iend, i):
+        for j in range(i + 1, min(i + 1 + prefetchwindows, len(iend))):
+            self.prefetch(istart[j], iend[j])
+        return self.get_range(istart[i], iend[i])
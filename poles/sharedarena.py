@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+alignment = 64
+
+# Blocks this process has attached to, by name. They must stay open as long
+# as arrays view them.
+blocks = {}
+
+
+def get_view(buffer, offset, shape, dtype):
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=buffer,
+        offset=offset)
+
+
+class arena:
+    """
+        Copies named arrays into one shared memory block. Processes attach
+        to the block with attach(spec), where spec is small and picklable,
+        and get read-only views without copying the data. The block is
+        freed by close, so the arena must outlive all processes using it.
+    """
+    def __init__(self, arrays):
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            if array.dtype.hasobject:
+                raise ValueError('{} cannot be shared'.format(name))
+            layout[name] = (offset, array.shape, array.dtype.str)
+            offset += -(-array.nbytes // alignment) * alignment
+        self.block = shared_memory.SharedMemory(create=True,
+            size=max(1, offset))
+        for name, array in arrays.items():
+            get_view(self.block.buf, *layout[name])[...] = array
+        self.spec = (self.block.name, layout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def nbytes(self):
+        return self.block.size
+
+    def close(self):
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+
+# Returns read-only views of the arrays of the arena with the given spec.
+def attach(spec):
+    name, layout = spec
+    if name not in blocks:
+        blocks[name] = shared_memory.SharedMemory(name=name)
+    arrays = {}
+    for arrayname, (offset, shape, dtype) in layout.items():
+        array = get_view(blocks[name].buf, offset, shape, dtype)
+        array.flags.writeable = False
+        arrays[arrayname] = array
+    return arrays
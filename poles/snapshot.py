@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import json
+import os
+
+import numpy as np
+
+import util
+
+
+pointfile = 'points.bin'
+chunkfile = 'chunks.npy'
+metafile = 'meta.json'
+voxelsize = 0.1
+maxvoxels = int(2e7)
+chunkpoints = 2**20
+pointtype = np.dtype([('xyz', '<f4', (3,)), ('i', 'u1')])
+
+keybits = 21
+keyoffset = 2**(keybits - 1)
+
+
+def pack_keys(indices):
+    indices = indices.astype(np.int64) + keyoffset
+    return (indices[:, 0] << (2 * keybits)) | (indices[:, 1] << keybits) \
+        | indices[:, 2]
+
+
+def unpack_keys(keys):
+    mask = 2**keybits - 1
+    return np.stack([keys >> (2 * keybits), (keys >> keybits) & mask,
+        keys & mask], axis=1) - keyoffset
+
+
+class snapshotbuilder:
+    """
+        Accumulates point clouds into a voxel hash that keeps the first point
+        of every voxel. New points are written in shuffled chunks of at most
+        chunkpoints points, so that any prefix of a chunk is a uniform
+        subsample of it. When more than maxvoxels voxels are occupied, the
+        voxel size is doubled for all further points.
+    """
+    def __init__(self, dir, voxelsize=voxelsize, maxvoxels=maxvoxels,
+            chunkpoints=chunkpoints):
+        self.dir = dir
+        self.voxelsize = voxelsize
+        self.maxvoxels = maxvoxels
+        self.chunkpoints = chunkpoints
+        self.keys = np.empty(0, dtype=np.int64)
+        self.pendingkeys = []
+        self.pendingpoints = []
+        self.npending = 0
+        self.offsets = [0]
+        util.makedirs(self.dir)
+        self.file = open(os.path.join(self.dir, pointfile), 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, xyz, intensities):
+        keys = pack_keys(np.floor(xyz / self.voxelsize))
+        keys, ifirst = np.unique(keys, return_index=True)
+        new = np.ones(keys.size, dtype=bool)
+        if self.keys.size > 0:
+            i = np.minimum(np.searchsorted(self.keys, keys), self.keys.size - 1)
+            new &= self.keys[i] != keys
+        for pendingkeys in self.pendingkeys:
+            new &= np.logical_not(np.isin(keys, pendingkeys, assume_unique=True))
+        if not np.any(new):
+            return
+        points = np.empty(np.count_nonzero(new), dtype=pointtype)
+        points['xyz'] = xyz[ifirst[new]]
+        points['i'] = intensities[ifirst[new]]
+        self.pendingkeys.append(keys[new])
+        self.pendingpoints.append(points)
+        self.npending += points.size
+        if self.npending >= self.chunkpoints:
+            self.flush()
+
+    def flush(self):
+        if self.npending == 0:
+            return
+        points = np.hstack(self.pendingpoints)
+        points = points[np.random.permutation(points.size)]
+        points.tofile(self.file)
+        self.offsets.append(self.offsets[-1] + points.size)
+        self.keys = np.union1d(self.keys, np.hstack(self.pendingkeys))
+        self.pendingkeys = []
+        self.pendingpoints = []
+        self.npending = 0
+        while self.keys.size > self.maxvoxels:
+            self.voxelsize *= 2.0
+            self.keys = np.unique(pack_keys(unpack_keys(self.keys) // 2))
+
+    def close(self, **arrays):
+        self.flush()
+        self.file.close()
+        np.save(os.path.join(self.dir, chunkfile), np.array(self.offsets))
+        for name, array in arrays.items():
+            np.save(os.path.join(self.dir, name + '.npy'), array)
+        with open(os.path.join(self.dir, metafile), 'w') as file:
+            json.dump({'voxelsize': self.voxelsize,
+                'npoints': int(self.offsets[-1]),
+                'arrays': sorted(arrays.keys())}, file)
+
+
+# Reads the given fraction of the points of every chunk, which amounts to a
+# uniform subsample of the whole snapshot, plus any extra arrays.
+def load(dir, lod=1.0):
+    offsets = np.load(os.path.join(dir, chunkfile))
+    with open(os.path.join(dir, metafile)) as file:
+        meta = json.load(file)
+    if offsets[-1] > 0:
+        points = np.memmap(
+            os.path.join(dir, pointfile), dtype=pointtype, mode='r')
+    else:
+        points = np.empty(0, dtype=pointtype)
+    counts = np.ceil(lod * np.diff(offsets)).astype(np.int64)
+    points = np.hstack([points[start:start+count] \
+        for start, count in zip(offsets[:-1], counts)] \
+        + [np.empty(0, dtype=pointtype)])
+    arrays = {name: np.load(os.path.join(dir, name + '.npy')) \
+        for name in meta['arrays']}
+    return points['xyz'], points['i'], arrays
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+import util
+
+
+polesides = [0.1, 0.6]
+poleheights = [1.5, 6.0]
+groundoccupancy = 0.02
+noise = 0.02
+lidarlayers = np.radians(np.linspace(-30.0, 10.0, 32))
+maxrange = 50.0
+
+
+# Returns count poles, uniformly placed within a square of the given edge
+# length, as rows x, y, zstart, zend, a, score like detect_poles does.
+def pole_field(count, extent, seed=0):
+    rng = np.random.RandomState(seed)
+    poleparams = np.zeros([count, 6])
+    poleparams[:, :2] = rng.uniform(0.0, extent, [count, 2])
+    poleparams[:, 3] = rng.uniform(*poleheights, size=count)
+    poleparams[:, 4] = rng.uniform(*polesides, size=count)
+    poleparams[:, 5] = 1.0
+    return poleparams
+
+
+# Returns an occupancy map in which the cells covered by the given poles
+# are occupied, on top of an occupied ground layer and uniform noise.
+def occupancy_grid(poleparams, mapshape, mapsize, seed=0):
+    rng = np.random.RandomState(seed)
+    ogm = rng.uniform(0.0, noise, mapshape)
+    ogm[:, :, 0] = np.maximum(ogm[:, :, 0], 1.0 - groundoccupancy)
+    for x, y, zs, ze, a in poleparams[:, :5]:
+        lo = np.floor((np.array([x, y, zs]) - [0.5 * a, 0.5 * a, 0.0]) \
+            / mapsize).astype(int)
+        hi = np.ceil((np.array([x, y, ze]) + [0.5 * a, 0.5 * a, 0.0]) \
+            / mapsize).astype(int)
+        lo = np.clip(lo, 0, mapshape)
+        hi = np.clip(hi, 0, mapshape)
+        ogm[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] = 1.0
+    return ogm
+
+
+# Returns a smooth random trajectory of count poses [count, 4, 4] that
+# advances by step meters per pose, together with the relative motions
+# between consecutive poses as x, y, phi.
+def trajectory(count, step=0.1, start=np.identity(4), seed=0):
+    rng = np.random.RandomState(seed)
+    relmotion = np.zeros([count - 1, 3])
+    relmotion[:, 0] = step
+    if count > 1:
+        relmotion[:, 2] = np.convolve(rng.normal(0.0, 0.05, count - 1),
+            np.full(25, 1.0 / 25.0))[12:12+count-1]
+    poses = np.empty([count, 4, 4])
+    poses[0] = start
+    for i, T in enumerate(np.reshape(util.xyp2ht(relmotion), [-1, 4, 4])):
+        poses[i+1] = poses[i].dot(T)
+    return poses, relmotion
+
+
+# Simulates a scan of a lidar at the pose T_w_s with the given layers and
+# nazimuth beams per layer. Poles are modeled as cylinders of diameter a on
+# a flat ground plane at z = 0, so T_w_s must lie above the ground. Returns
+# the points in the sensor frame.
+def scan(poleparams, T_w_s, nazimuth=1800, layers=lidarlayers,
+        maxrange=maxrange):
+    origin = T_w_s[:3, 3]
+    azimuth = np.linspace(-np.pi, np.pi, nazimuth, endpoint=False)
+    azimuth, elevation = [a.ravel() for a in np.meshgrid(azimuth, layers)]
+    direction = np.stack([np.cos(azimuth), np.sin(azimuth)], axis=1)
+
+    # Ranges in the x-y plane until the ground is hit.
+    tanel = np.tan(elevation)
+    r = np.full(azimuth.size, np.inf)
+    down = tanel < 0.0
+    r[down] = -origin[2] / tanel[down]
+
+    near = np.linalg.norm(poleparams[:, :2] - origin[:2], axis=1) \
+        < maxrange + poleparams[:, 4]
+    for x, y, zs, ze, a in poleparams[near, :5]:
+        c = np.array([x, y]) - origin[:2]
+        b = direction.dot(c)
+        disc = b**2 - c.dot(c) + (0.5 * a)**2
+        hit = disc >= 0.0
+        rpole = np.full(azimuth.size, np.inf)
+        rpole[hit] = b[hit] - np.sqrt(disc[hit])
+        z = origin[2] + rpole * tanel
+        hit &= (rpole > 0.0) & (z >= zs) & (z <= ze) & (rpole < r)
+        r[hit] = rpole[hit]
+
+    valid = r < maxrange
+    r = r[valid]
+    xyz = np.stack([origin[0] + r * direction[valid, 0],
+        origin[1] + r * direction[valid, 1],
+        origin[2] + r * tanel[valid]], axis=1)
+    return util.invert_ht(T_w_s).dot(
+        np.hstack([xyz, np.ones([xyz.shape[0], 1])]).T)[:3].T
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import collections
+import os
+import pickle
+
+import numpy as np
+import scipy.spatial
+
+import util
+
+
+directoryfile = 'tiles.npz'
+tilesize = 100.0
+maxtiles = 64
+
+
+def get_tilefile(dir, key):
+    return os.path.join(dir, 'tile_{:d}_{:d}.npz'.format(*key))
+
+
+def get_tilekeys(xy, size):
+    return np.floor(np.reshape(xy, [-1, 2]) / size).astype(np.int64)
+
+
+# Splits the global map into square tiles of the given edge length. Every
+# tile stores its poles, their indices into polemeans, and a pickled k-d tree.
+def save_tiled_map(polemeans, dir, size=tilesize):
+    util.makedirs(dir)
+    keys = get_tilekeys(polemeans[:, :2], size)
+    tilekeys, itile = np.unique(keys, axis=0, return_inverse=True)
+    itile = itile.ravel()
+    counts = np.zeros(tilekeys.shape[0], dtype=np.int64)
+    for i, key in enumerate(tilekeys):
+        ipoles = np.where(itile == i)[0]
+        counts[i] = ipoles.size
+        kdtree = scipy.spatial.cKDTree(polemeans[ipoles, :2], leafsize=3)
+        np.savez(get_tilefile(dir, key), polemeans=polemeans[ipoles],
+            ipoles=ipoles, kdtree=np.frombuffer(
+                pickle.dumps(kdtree, protocol=2), dtype=np.uint8))
+    np.savez(os.path.join(dir, directoryfile), tilesize=size, keys=tilekeys,
+        counts=counts, npoles=polemeans.shape[0])
+
+
+class tiledmap:
+    """
+        Global pole map that keeps only the tiles around the current queries
+        in memory, at most maxtiles of them. query mirrors cKDTree.query;
+        without a distance bound, only the tiles adjacent to the query
+        points are searched.
+    """
+    def __init__(self, dir, maxtiles=maxtiles):
+        self.dir = dir
+        self.maxtiles = maxtiles
+        with np.load(os.path.join(self.dir, directoryfile)) as data:
+            self.tilesize = float(data['tilesize'])
+            self.keys = set(map(tuple, data['keys']))
+            self.n = int(data['npoles'])
+        self.tiles = collections.OrderedDict()
+
+    @property
+    def polemeans(self):
+        if not self.tiles:
+            return np.empty([0, 6])
+        return np.vstack([tile[0] for tile in self.tiles.values()])
+
+    # Reads every tile file without keeping the tiles in memory and returns
+    # the whole map in the order of the polemeans it was saved from.
+    def all_polemeans(self):
+        polemeans = np.empty([self.n, 6])
+        for key in self.keys:
+            with np.load(get_tilefile(self.dir, key)) as data:
+                polemeans[data['ipoles']] = data['polemeans']
+        return polemeans
+
+    # Returns the given tile, loading it if necessary, and evicts the least
+    # recently used tiles beyond maxtiles.
+    def load_tile(self, key):
+        if key in self.tiles:
+            self.tiles[key] = self.tiles.pop(key)
+        else:
+            with np.load(get_tilefile(self.dir, key)) as data:
+                self.tiles[key] = (data['polemeans'], data['ipoles'],
+                    pickle.loads(data['kdtree'].tobytes()))
+            while len(self.tiles) > self.maxtiles:
+                self.tiles.popitem(last=False)
+        return self.tiles[key]
+
+    # Returns the keys of the existing tiles within margin of any of the
+    # given points.
+    def get_keys(self, xy, margin=0.0):
+        xy = np.reshape(xy, [-1, 2])
+        r = int(np.ceil(margin / self.tilesize))
+        base = np.unique(get_tilekeys(xy, self.tilesize), axis=0)
+        offsets = np.stack(np.meshgrid(np.arange(-r, r + 1),
+            np.arange(-r, r + 1)), axis=-1).reshape([-1, 2])
+        keys = np.unique(np.reshape(
+            base[:, np.newaxis] + offsets, [-1, 2]), axis=0)
+        return [key for key in map(tuple, keys.tolist()) if key in self.keys]
+
+    # Loads the tiles within margin of the given points. If there are more
+    # than maxtiles of them, only the last maxtiles stay in memory.
+    def update(self, xy, margin=0.0):
+        keys = self.get_keys(xy, margin)
+        for key in keys:
+            self.load_tile(key)
+        return keys
+
+    # Queries the tiles one after another, so that at most maxtiles of them
+    # are in memory however far the query points are spread.
+    def query(self, xy, k=1, distance_upper_bound=np.inf):
+        xy = np.reshape(xy, [-1, 2])
+        d = np.full([xy.shape[0], k], np.inf)
+        i = np.full([xy.shape[0], k], self.n, dtype=np.int64)
+        margin = distance_upper_bound if np.isfinite(distance_upper_bound) \
+            else self.tilesize
+        for key in self.get_keys(xy, margin) if xy.shape[0] > 0 else []:
+            _, ipoles, kdtree = self.load_tile(key)
+            lower = np.array(key) * self.tilesize - margin
+            upper = lower + self.tilesize + 2.0 * margin
+            iq = np.where(np.all((xy >= lower) & (xy < upper), axis=1))[0]
+            if iq.size == 0:
+                continue
+            dt, it = kdtree.query(
+                xy[iq], k=k, distance_upper_bound=distance_upper_bound)
+            dt = np.reshape(dt, [-1, k])
+            it = np.reshape(it, [-1, k])
+            it = np.where(it < ipoles.size,
+                ipoles[np.minimum(it, ipoles.size - 1)], self.n)
+            dc = np.hstack([d[iq], dt])
+            ic = np.hstack([i[iq], it])
+            order = np.argsort(dc, axis=1, kind='stable')[:, :k]
+            d[iq] = np.take_along_axis(dc, order, axis=1)
+            i[iq] = np.take_along_axis(ic, order, axis=1)
+        if k == 1:
+            return d[:, 0], i[:, 0]
+        return d, i
@@ -1,18 +1,21 @@
 #!/usr/bin/env python
 
 import os
+import tempfile
 
 import numpy as np
 import open3d as o3
-import transforms3d as t3
-import pyquaternion as pq
 
 
-def invert_ht(ht):
-    ht = np.tile(ht, [1, 1, 1])
-    iht = np.tile(np.identity(4), [ht.shape[0], 1, 1])
-    iht[..., :3, :3] = ht[..., :3, :3].transpose(0, 2, 1)
-    iht[..., :3, [3]] = -np.matmul(iht[..., :3, :3], ht[..., :3, [3]])
+def invert_ht(ht, out=None):
+    ht = np.asarray(ht)
+    iht = np.empty(ht.shape) if out is None else out
+    rot = np.swapaxes(ht[..., :3, :3], -1, -2)
+    iht[..., :3, 3] = -np.matmul(rot, ht[..., :3, 3, np.newaxis])[..., 0]
+    iht[..., :3, :3] = rot
+    iht[..., 3, :] = [0.0, 0.0, 0.0, 1.0]
+    if out is not None:
+        return out
     return iht.squeeze()
 
 
@@ -32,38 +35,138 @@ def intensity2color(intensity):
     return np.tile(np.reshape(intensity * 0.8, [-1, 1]), [1, 3])
 
 
-def xyp2ht(xyp):
-    ht = np.tile(np.identity(4), [xyp.size / 3, 1, 1])
+def xyp2ht(xyp, out=None):
+    xyp = np.asarray(xyp)
+    shape = xyp.shape[:-1]
+    ht = np.empty(shape + (4, 4)) if out is None else out
     cp = np.cos(xyp[..., 2])
     sp = np.sin(xyp[..., 2])
+    ht[...] = np.identity(4)
     ht[..., :2, 3] = xyp[..., :2]
     ht[..., 0, 0] = cp
     ht[..., 0, 1] = -sp
     ht[..., 1, 0] = sp
     ht[..., 1, 1] = cp
+    if out is not None:
+        return out
     return ht.squeeze()
 
 
-def ht2xyp(ht):
-    ht = np.tile(ht, [1, 1, 1])
-    p = np.arctan2(ht[..., 1, 0], ht[..., 0, 0])
-    return np.hstack([ht[..., :2, 3], np.reshape(p, [-1, 1])]).squeeze()
-
-
-def interpolate_ht(ht, t, tq):
-    amount = np.clip((tq - t[0]) / np.diff(t), 0.0, 1.0)
-    pos = ht[0, :3, 3] + amount * np.diff(ht[:, :3, 3], axis=0).squeeze()
-    q = [pq.Quaternion(matrix=m) for m in ht]
-    qq = pq.Quaternion.slerp(q[0], q[1], amount=amount)
-    return t3.affines.compose(pos, qq.rotation_matrix, np.ones(3))
+def ht2xyp(ht, out=None):
+    ht = np.asarray(ht)
+    xyp = np.empty(ht.shape[:-2] + (3,)) if out is None else out
+    xyp[..., :2] = ht[..., :2, 3]
+    xyp[..., 2] = np.arctan2(ht[..., 1, 0], ht[..., 0, 0])
+    if out is not None:
+        return out
+    return xyp.squeeze()
+
+
+def ht2quat(ht):
+    """
+        Converts rotation matrices of shape [..., 4, 4] or [..., 3, 3] into
+        unit quaternions [w, x, y, z] with Shepperd's method.
+    """
+    r = np.asarray(ht)[..., :3, :3]
+    r00, r11, r22 = r[..., 0, 0], r[..., 1, 1], r[..., 2, 2]
+    diag = np.stack([r00 + r11 + r22, r00, r11, r22], axis=-1)
+    imax = np.argmax(diag, axis=-1)
+    q = np.empty(r.shape[:-2] + (4,))
+    w = np.stack([1.0 + r00 + r11 + r22, r[..., 2, 1] - r[..., 1, 2],
+        r[..., 0, 2] - r[..., 2, 0], r[..., 1, 0] - r[..., 0, 1]], axis=-1)
+    x = np.stack([r[..., 2, 1] - r[..., 1, 2], 1.0 + r00 - r11 - r22,
+        r[..., 0, 1] + r[..., 1, 0], r[..., 0, 2] + r[..., 2, 0]], axis=-1)
+    y = np.stack([r[..., 0, 2] - r[..., 2, 0], r[..., 0, 1] + r[..., 1, 0],
+        1.0 - r00 + r11 - r22, r[..., 1, 2] + r[..., 2, 1]], axis=-1)
+    z = np.stack([r[..., 1, 0] - r[..., 0, 1], r[..., 0, 2] + r[..., 2, 0],
+        r[..., 1, 2] + r[..., 2, 1], 1.0 - r00 - r11 + r22], axis=-1)
+    for i, candidate in enumerate([w, x, y, z]):
+        mask = imax == i
+        q[mask] = candidate[mask]
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def quat2rot(q, out=None):
+    w, x, y, z = np.moveaxis(np.asarray(q), -1, 0)
+    rot = np.empty(q.shape[:-1] + (3, 3)) if out is None else out
+    rot[..., 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+    rot[..., 0, 1] = 2.0 * (x * y - w * z)
+    rot[..., 0, 2] = 2.0 * (x * z + w * y)
+    rot[..., 1, 0] = 2.0 * (x * y + w * z)
+    rot[..., 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+    rot[..., 1, 2] = 2.0 * (y * z - w * x)
+    rot[..., 2, 0] = 2.0 * (x * z - w * y)
+    rot[..., 2, 1] = 2.0 * (y * z + w * x)
+    rot[..., 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+    return rot
+
+
+def slerp(q0, q1, amount):
+    """
+        Spherical linear interpolation between arrays of unit quaternions
+        along the shorter arc, as done by pyquaternion.Quaternion.slerp.
+    """
+    amount = np.clip(amount, 0.0, 1.0)[..., np.newaxis]
+    dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+    q0 = np.where(dot < 0.0, -q0, q0)
+    dot = np.abs(dot)
+    linear = dot > 0.9995
+    theta0 = np.arccos(np.clip(dot, -1.0, 1.0))
+    sintheta0 = np.where(linear, 1.0, np.sin(theta0))
+    theta = theta0 * amount
+    s0 = np.where(linear, 1.0 - amount,
+        np.cos(theta) - dot * np.sin(theta) / sintheta0)
+    s1 = np.where(linear, amount, np.sin(theta) / sintheta0)
+    q = s0 * q0 + s1 * q1
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+# Interpolates the poses ht of shape [..., M, 4, 4], given at the sorted
+# times t, at the 1-D query times tq. Query times outside of t are clamped to
+# the first or last pose. Leading dimensions of ht are kept, so several
+# trajectories sharing the same times are interpolated at once.
+def interpolate_ht(ht, t, tq, out=None):
+    ht = np.asarray(ht)
+    tq = np.asarray(tq, dtype=np.float64)
+    i1 = np.clip(np.searchsorted(t, tq), 1, t.size - 1)
+    i0 = i1 - 1
+    amount = np.clip((tq - t[i0]) / (t[i1] - t[i0]), 0.0, 1.0)
+    ht0 = ht[..., i0, :, :]
+    ht1 = ht[..., i1, :, :]
+    iht = np.empty(ht0.shape) if out is None else out
+    iht[..., :3, 3] = ht0[..., :3, 3] \
+        + amount[..., np.newaxis] * (ht1[..., :3, 3] - ht0[..., :3, 3])
+    quat2rot(slerp(ht2quat(ht0), ht2quat(ht1), amount),
+        out=iht[..., :3, :3])
+    iht[..., 3, :] = [0.0, 0.0, 0.0, 1.0]
+    return iht
+
+
+# Projects poses onto the x-y plane, keeping only their heading.
+def project_xy(ht, out=None):
+    ht = np.asarray(ht)
+    htp = np.empty(ht.shape) if out is None else out
+    htp[...] = np.identity(4)
+    xaxis = ht[..., :2, 0] / np.linalg.norm(
+        ht[..., :2, 0], axis=-1, keepdims=True)
+    htp[..., :2, 0] = xaxis
+    htp[..., 0, 1] = -xaxis[..., 1]
+    htp[..., 1, 1] = xaxis[..., 0]
+    htp[..., :2, 3] = ht[..., :2, 3]
+    return htp
 
 
-def project_xy(ht):
-    htp = np.identity(4)
-    htp[:2, 0] = ht[:2, 0] / np.linalg.norm(ht[:2, 0])
-    htp[:2, 1] = [-htp[1, 0], htp[0, 0]]
-    htp[:2, 3] = ht[:2, 3]
-    return htp
+# Returns the indices of the first pose in every segment of the given length
+# along a trajectory of positions [N, 2], plus the index of the last pose.
+# Poses with non-finite positions are skipped.
+def decimate_trajectory(xy, spacing):
+    ivalid = np.where(np.all(np.isfinite(xy), axis=1))[0]
+    if ivalid.size == 0:
+        return ivalid
+    distance = np.hstack([0.0, np.cumsum(
+        np.linalg.norm(np.diff(xy[ivalid], axis=0), axis=1))])
+    _, ifirst = np.unique(np.floor(distance / spacing), return_index=True)
+    return ivalid[np.union1d(ifirst, [ivalid.size - 1])]
 
 
 def xyzi2pc(xyz, intensities=None):
@@ -82,6 +185,17 @@ def average_angles(angles, weights=None):
     return np.arctan2(np.sum(y), np.sum(x))
 
 
+# Creates a uniquely named file next to filename and returns it, opened for
+# binary writing, together with its name. Moving it onto filename with
+# os.replace once it is complete lets several processes write the same file
+# at once without corrupting it.
+def open_tempfile(filename):
+    fd, tmpfile = tempfile.mkstemp(suffix='.tmp',
+        prefix=os.path.basename(filename) + '.',
+        dir=os.path.dirname(filename) or os.curdir)
+    return os.fdopen(fd, 'wb'), tmpfile
+
+
 def makedirs(dir):
     try:
         os.makedirs(dir)
@@ -0,0 +1,9 @@
+import pytest
+
+import benchmark
+
+
+@pytest.mark.parametrize('name, bench, sizes', benchmark.benchmarks,
+    ids=[b[0] for b in benchmark.benchmarks])
+def test_smallest_size(name, bench, sizes):
+    bench(min(sizes))()
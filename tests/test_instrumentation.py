@@ -0,0 +1,57 @@
+import pytest
+
+import instrumentation
+
+
+@pytest.fixture
+def recording():
+    instrumentation.reset()
+    instrumentation.enable(memory=False)
+    yield
+    instrumentation.disable()
+    instrumentation.reset()
+
+
+def get_spans(name):
+    return [event for event in instrumentation.events \
+        if event['ph'] == 'X' and event['name'] == name]
+
+
+def test_counts_are_attributed_to_spans(recording):
+    for rays in [10, 20]:
+        with instrumentation.span('window'):
+            span = instrumentation.start('raytrace')
+            instrumentation.count('rays', rays)
+            instrumentation.stop(span)
+            instrumentation.count('poles', 1)
+    instrumentation.count('rays', 5)
+
+    windows = get_spans('window')
+    assert [w['args']['counters'] for w in windows] \
+        == [{'rays': 10, 'poles': 1}, {'rays': 20, 'poles': 1}]
+    assert [r['args']['counters'] for r in get_spans('raytrace')] \
+        == [{'rays': 10}, {'rays': 20}]
+    summary = instrumentation.summary()
+    assert summary['counters'] == {'rays': 35, 'poles': 2}
+    assert summary['spans']['window']['counters'] == {'rays': 30, 'poles': 2}
+
+
+def test_span_left_open_by_an_exception_is_closed_with_its_parent(recording):
+    with pytest.raises(ValueError):
+        with instrumentation.span('window'):
+            instrumentation.start('raytrace')
+            raise ValueError()
+    assert instrumentation.get_open_spans() == []
+    with instrumentation.span('window'):
+        instrumentation.count('rays', 3)
+    assert get_spans('window')[-1]['args']['counters'] == {'rays': 3}
+
+
+def test_disabled_spans_record_nothing():
+    instrumentation.reset()
+    span = instrumentation.start('raytrace')
+    instrumentation.count('rays', 3)
+    instrumentation.stop(span)
+    assert span is None
+    assert instrumentation.events == []
+    assert instrumentation.summary()['counters'] == {}
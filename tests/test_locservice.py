@@ -0,0 +1,122 @@
+import asyncio
+import json
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import locservice
+
+
+@pytest.fixture
+def address():
+    polemeans = np.random.RandomState(0).uniform(0.0, 50.0, [100, 2])
+    service = locservice.locservice(polemeans, count=200)
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(service.serve())
+
+    def run():
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        tasks = asyncio.all_tasks(loop)
+        for pending in tasks:
+            pending.cancel()
+        loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    while not hasattr(service, 'address'):
+        time.sleep(0.01)
+    yield service.address[:2]
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join()
+    loop.close()
+
+
+def send_raw(client, value):
+    client.file.write(json.dumps(value) + '\n')
+    client.file.flush()
+    return client.receive()
+
+
+def test_bad_requests_do_not_stop_the_service(address):
+    client = locservice.client(address)
+    try:
+        assert send_raw(client, [1, 2])['error'] == 'invalid request'
+        assert send_raw(client, 3)['error'] == 'invalid request'
+        client.send({'type': 'init'})
+        assert 'error' in client.receive()
+        assert 'error' not in client.init([10.0, 10.0, 0.0])
+        client.send({'type': 'odometry', 'mean': [1.0], 'cov': 'x'})
+        assert 'error' in client.receive()
+        client.send({'type': 'poles', 'poles': [[1.0, 2.0, 3.0]]})
+        assert 'error' in client.receive()
+        client.odometry(0.0, [0.1, 0.0, 0.0], np.diag([0.01, 0.01, 0.001]))
+        reply = client.receive()
+        assert 'error' not in reply
+        assert len(reply['pose']) == 3
+    finally:
+        client.close()
+
+
+def test_consecutive_odometry_is_coalesced_in_order():
+    polemeans = np.random.RandomState(0).uniform(0.0, 50.0, [100, 2])
+    service = locservice.locservice(polemeans, count=200)
+    odometry = {'type': 'odometry', 'mean': [0.1, 0.0, 0.0],
+        'cov': np.diag([0.01, 0.01, 0.001]).tolist()}
+    types = [{'type': 'init', 'pose': [10.0, 10.0, 0.0]}, odometry, odometry,
+        {'type': 'odometry'}, odometry, {'type': 'poles', 'poles': []},
+        odometry]
+    requests = [(dict(r, id=i), None, time.time()) \
+        for i, r in enumerate(types)]
+    replies = [reply for _, reply in service.process(requests)]
+    assert [reply['id'] for reply in replies] == list(range(len(types)))
+    assert 'error' in replies[3]
+    assert [reply.get('coalesced') for reply in replies] \
+        == [1, 3, 3, None, 3, 1, 1]
+    assert service.ncoalesced == 2
+
+
+def test_queued_requests_are_answered_in_order(address):
+    client = locservice.client(address)
+    client.socket.settimeout(10.0)
+    try:
+        client.init([10.0, 10.0, 0.0])
+        ids = []
+        for i in range(100):
+            ids.append(client.odometry(
+                i, [0.1, 0.0, 0.0], np.diag([0.01, 0.01, 0.001])))
+            if i % 10 == 0:
+                ids.append(client.poles(i, np.zeros([0, 2])))
+        replies = [client.receive() for _ in ids]
+        assert [reply['id'] for reply in replies] == ids
+        assert all('error' not in reply for reply in replies)
+    finally:
+        client.close()
+
+
+def test_disconnected_client_does_not_stop_the_service(address):
+    for _ in range(3):
+        dropped = locservice.client(address)
+        dropped.init([10.0, 10.0, 0.0])
+        for i in range(200):
+            dropped.odometry(i, [0.1, 0.0, 0.0], np.diag([0.01, 0.01, 0.001]))
+        dropped.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+            struct.pack('ii', 1, 0))
+        dropped.close()
+
+    client = locservice.client(address)
+    client.socket.settimeout(10.0)
+    try:
+        assert 'error' not in client.init([10.0, 10.0, 0.0])
+        client.odometry(0.0, [0.1, 0.0, 0.0], np.diag([0.01, 0.01, 0.001]))
+        assert len(client.receive()['pose']) == 3
+    finally:
+        client.close()
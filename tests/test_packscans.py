@@ -0,0 +1,32 @@
+import concurrent.futures
+import os
+
+import numpy as np
+
+import pynclt
+
+
+def test_concurrent_pack_scans(tmp_path):
+    velofiles = []
+    for i in range(20):
+        velofile = str(tmp_path / 'scan{:02d}.bin'.format(i))
+        with open(velofile, 'wb') as file:
+            file.write(os.urandom(pynclt.velodatasize * 1000 * (i + 1)))
+        velofiles.append(velofile)
+    t_velo = np.arange(len(velofiles))
+    filename = str(tmp_path / pynclt.velostorefile)
+    indexfile = str(tmp_path / pynclt.velostoreindexfile)
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        for future in [executor.submit(pynclt.pack_scans,
+                velofiles, t_velo, filename, indexfile) for _ in range(8)]:
+            future.result()
+
+    store = pynclt.scanstore(filename, indexfile)
+    assert len(store) == len(velofiles)
+    for i, velofile in enumerate(velofiles):
+        with open(velofile, 'rb') as file:
+            assert store.get_records(i, i + 1).tobytes() == file.read()
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        [os.path.basename(f) for f in velofiles]
+        + [pynclt.velostorefile, pynclt.velostoreindexfile])
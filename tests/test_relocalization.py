@@ -0,0 +1,36 @@
+import numpy as np
+
+import relocalization
+import util
+
+
+pattern = np.array([[0.0, 0.0], [7.0, 1.0], [3.0, 9.0], [12.0, 6.0],
+    [5.0, 14.0]])
+
+
+def get_local_poles(T_w_l, polepos_w):
+    polepos_w = np.hstack([polepos_w, np.zeros([polepos_w.shape[0], 1]),
+        np.ones([polepos_w.shape[0], 1])])
+    return util.invert_ht(T_w_l).dot(polepos_w.T)[:2].T
+
+
+def test_locate_unique_layout():
+    T_w_l = util.xyp2ht(np.array([4.0, -3.0, 0.7]))
+    index = relocalization.poleindex(pattern)
+    T_w_l_est = index.locate(get_local_poles(T_w_l, pattern))
+    assert T_w_l_est is not None
+    assert np.allclose(T_w_l_est, T_w_l, atol=0.1)
+
+
+def test_locate_rejects_ambiguous_layout():
+    # Two copies of the same layout far apart match equally well.
+    polemeans = np.vstack([pattern, pattern + [200.0, 0.0]])
+    T_w_l = util.xyp2ht(np.array([4.0, -3.0, 0.7]))
+    index = relocalization.poleindex(polemeans)
+    assert index.locate(get_local_poles(T_w_l, pattern)) is None
+
+
+def test_locate_rejects_too_few_poles():
+    T_w_l = util.xyp2ht(np.array([4.0, -3.0, 0.7]))
+    index = relocalization.poleindex(pattern)
+    assert index.locate(get_local_poles(T_w_l, pattern[:3])) is None
@@ -0,0 +1,11 @@
+import numpy as np
+
+import synthetic
+
+
+def test_trajectory_shorter_than_kernel():
+    for count in [1, 2, 5, 30]:
+        poses, relmotion = synthetic.trajectory(count)
+        assert poses.shape == (count, 4, 4)
+        assert relmotion.shape == (count - 1, 3)
+        assert np.all(np.isfinite(poses))
@@ -0,0 +1,13 @@
+import numpy as np
+
+import tiledmap
+
+
+def test_all_polemeans_covers_tiles_that_are_not_resident(tmp_path):
+    polemeans = np.random.RandomState(0).uniform(-500.0, 500.0, [300, 6])
+    tiledmap.save_tiled_map(polemeans, str(tmp_path))
+    kdtree = tiledmap.tiledmap(str(tmp_path), maxtiles=2)
+    kdtree.update(polemeans[:10, :2])
+    assert kdtree.polemeans.shape[0] < polemeans.shape[0]
+    assert np.array_equal(kdtree.all_polemeans(), polemeans)
+    assert len(kdtree.tiles) <= 2